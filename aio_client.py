@@ -0,0 +1,341 @@
+"""
+Headless asyncio chat client.
+
+Speaks the same protocol as the GUI client (client.py is a view on top of this
+module) without any UI, so bots and bridges can hold hundreds of connections
+from one event loop. Server lines are turned into typed events:
+
+    async def echo_bot():
+        bot = AsyncChatClient("echo")
+        async for event in bot.events():
+            if isinstance(event, PublicMessage) and event.sender != bot.username:
+                bot.send(f"{event.sender} said: {event.text}")
+
+events() connects, yields the history the client has not seen yet and then the
+live events. When the connection is lost it yields Disconnected, backs off
+(see reconnect_delay) and reconnects, resuming from the last message id and
+room, until close() is called. The sending methods only queue the line on the
+transport and must be called from the loop running events().
+
+With compress=True (the default) the client asks for a compressed stream and
+inflates it transparently; servers without compression just answer in plain text.
+"""
+import asyncio
+import random
+from collections import deque, namedtuple
+from datetime import datetime
+from operator import itemgetter
+
+from protocol import (
+    RECV_SIZE, HISTORY_END, HISTORY_RESET, ONLINE_USERS, USER_JOINED, USER_LEFT, PRESENCE, ROOMS, ROOM, DEFAULT_ROOM,
+    HISTORY_PAGE, HISTORY_PAGE_END, DEFLATE, InflatingDecoder, LineDecoder, encode_line, split_tagged,
+)
+
+HOST = '127.0.0.1'
+PORT = 9090
+
+# Reconnection backoff in seconds: the ceiling doubles with every failed attempt up to the maximum
+RECONNECT_BASE_DELAY = 1
+RECONNECT_MAX_DELAY = 60
+
+# Ids of the newest public messages remembered to drop repeats; live ids may arrive out of order
+SEEN_IDS = 1024
+
+# Connection state
+Connected = namedtuple("Connected", "room resumed")  # resumed: only messages after the last one seen follow
+Disconnected = namedtuple("Disconnected", "reason")
+
+# Chat lines. time is the server's "YYYY-MM-DD HH:MM" in the client's timezone; line is the full text.
+PublicMessage = namedtuple("PublicMessage", "id time sender text line")
+PrivateMessage = namedtuple("PrivateMessage", "time sender receiver text line")
+SystemMessage = namedtuple("SystemMessage", "time text line")
+Notice = namedtuple("Notice", "line")  # replies without a timestamp: errors, search results, room lists
+
+# History and rooms
+History = namedtuple("History", "messages")  # replay after joining a room, oldest first, at HISTORY_END
+HistoryReset = namedtuple("HistoryReset", "")  # the replay does not continue what was shown so far
+HistoryPage = namedtuple("HistoryPage", "direction messages more")  # reply to request_page()
+RoomChanged = namedtuple("RoomChanged", "room")  # the new room's History follows
+Roster = namedtuple("Roster", "users")  # online users in join order
+
+
+def reconnect_delay(attempt):
+    """
+    Seconds to wait before reconnection attempt number attempt (0 for the first).
+    Drawn at random below the ceiling, so clients dropped by the same restart
+    spread out instead of all coming back in the same instant.
+    """
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt))
+
+
+def local_utc_offset():
+    return int(datetime.now().astimezone().utcoffset().total_seconds())
+
+
+def parse_chat_line(line, message_id=None):
+    """Turns a line from the server into a PublicMessage, PrivateMessage, SystemMessage or Notice."""
+    if not line.startswith("["):
+        return Notice(line)
+    time_text, found, body = line[1:].partition("] ")
+    if not found:
+        return Notice(line)
+    if body.startswith("System: "):
+        return SystemMessage(time_text, body[8:], line)
+    if body.startswith("(Private) "):
+        names, found, text = body[10:].partition(": ")
+        sender, arrow, receiver = names.partition(" -> ")
+        if not (found and arrow):
+            return Notice(line)
+        return PrivateMessage(time_text, sender, receiver, text, line)
+    sender, found, text = body.partition(": ")
+    if not found:
+        return Notice(line)
+    return PublicMessage(message_id, time_text, sender, text, line)
+
+
+class AsyncChatClient:
+    """One chat connection; see the module docstring."""
+
+    def __init__(self, username, room=DEFAULT_ROOM, host=HOST, port=PORT, utc_offset=None, reconnect=True,
+                 compress=True):
+        self.username = username
+        # Room to join; follows /join and /leave so a reconnect returns to it
+        self.room = room
+        self.host = host
+        self.port = port
+        self.utc_offset = local_utc_offset() if utc_offset is None else utc_offset
+        self.reconnect = reconnect
+        self.compress = compress
+        # Id of the newest public message received; sent on reconnect so only newer ones are replayed
+        self.last_message_id = 0
+        # The last SEEN_IDS public message ids received, as a set and in arrival order
+        self._seen = set()
+        self._seen_order = deque()
+        # Online users in join order (dict used as an ordered set)
+        self.users = {}
+        self.history_loaded = False
+        self._writer = None
+        # Set while the client should be connected; cleared by disconnect()
+        self._wanted = asyncio.Event()
+        self._wanted.set()
+        # Cuts the wait between reconnection attempts short
+        self._wakeup = asyncio.Event()
+        self._closed = False
+        # Reconnection attempts since the client last got through a join
+        self._attempts = 0
+
+    async def events(self):
+        """Yields events until close(), reconnecting as described in the module docstring."""
+        while not self._closed:
+            await self._wanted.wait()
+            if self._closed:
+                break
+            try:
+                reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            except OSError as e:
+                yield Disconnected(f"cannot connect: {e}")
+                if not self.reconnect:
+                    return
+                await self._backoff()
+                continue
+
+            resumed = self.last_message_id > 0
+            capabilities = f"{PRESENCE},{ROOMS},{DEFLATE}" if self.compress else f"{PRESENCE},{ROOMS}"
+            self._writer.write(encode_line(
+                f"{self.username}|{self.utc_offset}|{self.last_message_id}|{capabilities}|{self.room}"))
+            yield Connected(self.room, resumed)
+            reason = "the server closed the connection"
+            try:
+                async for event in self._read(reader):
+                    yield event
+            except (ConnectionError, OSError) as e:
+                reason = str(e) or type(e).__name__
+            finally:
+                self._writer.close()
+                self._writer = None
+                self.history_loaded = False
+            if not self._wanted.is_set():
+                reason = "disconnected"
+            yield Disconnected(reason)
+            if not self.reconnect:
+                return
+            if self._wanted.is_set() and not self._closed:
+                await self._backoff()
+
+    async def _backoff(self):
+        """Sleeps for the next reconnect_delay() or until connect() or close() is called."""
+        delay = reconnect_delay(self._attempts)
+        self._attempts += 1
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _read(self, reader):
+        decoder = InflatingDecoder() if self.compress else LineDecoder()
+        collecting_history = True
+        history = []  # (sort key, event)
+        history_ids = set()
+        sort_key = self.last_message_id
+        page = None  # (direction, events) while a /history page is being received
+
+        while True:
+            data = await reader.read(RECV_SIZE)
+            if not data:
+                return
+            for frame in decoder.feed(data):
+                line = frame.decode('utf-8', errors='replace').strip()
+                if not line:
+                    continue
+
+                if page is not None:
+                    if line.startswith(HISTORY_PAGE_END + "|"):
+                        yield HistoryPage(page[0], page[1], line.endswith("|1"))
+                        page = None
+                    else:
+                        message_id, text = split_tagged(line)
+                        page[1].append(parse_chat_line(text, message_id))
+                    continue
+
+                if line.startswith(HISTORY_PAGE + "|"):
+                    page = (line.split("|")[1], [])
+                    continue
+
+                if line.startswith(ROOM + "|"):
+                    # Switched rooms: the new room's history follows
+                    self.room = line.split("|", 1)[1]
+                    self.last_message_id = 0
+                    self._forget_seen()
+                    self.history_loaded = False
+                    sort_key = 0
+                    history.clear()
+                    history_ids.clear()
+                    collecting_history = True
+                    yield RoomChanged(self.room)
+                    continue
+
+                if line.startswith((ONLINE_USERS + "|", USER_JOINED + "|", USER_LEFT + "|")):
+                    # Presence is live, also while the history is being collected
+                    if self._update_users(line):
+                        yield Roster(tuple(self.users))
+                    continue
+
+                if collecting_history:
+                    if line == HISTORY_END:
+                        # Live messages that arrived during the replay are merged into it by id
+                        history.sort(key=itemgetter(0))
+                        for message_id in sorted(history_ids):
+                            self._remember(message_id)
+                        collecting_history = False
+                        self.history_loaded = True
+                        # Only a completed join resets the backoff; a server that accepts and drops does not
+                        self._attempts = 0
+                        yield History([event for _, event in history])
+                        history = []
+                        history_ids.clear()
+                    elif line == HISTORY_RESET:
+                        self.last_message_id = 0
+                        self._forget_seen()
+                        sort_key = 0
+                        yield HistoryReset()
+                    else:
+                        message_id, text = split_tagged(line)
+                        if message_id is not None:
+                            if message_id <= self.last_message_id or message_id in history_ids:
+                                continue
+                            history_ids.add(message_id)
+                            sort_key = message_id
+                        history.append((sort_key, parse_chat_line(text, message_id)))
+                    continue
+
+                message_id, line = split_tagged(line)
+                if message_id is not None and not self._remember(message_id):
+                    continue
+
+                yield parse_chat_line(line, message_id)
+
+    def _remember(self, message_id):
+        """
+        Records a public message id; False when it was seen already. The resume
+        cursor is the newest id, though older ones may still arrive after it.
+        """
+        if message_id in self._seen:
+            return False
+        if len(self._seen_order) == SEEN_IDS:
+            self._seen.discard(self._seen_order.popleft())
+        self._seen_order.append(message_id)
+        self._seen.add(message_id)
+        self.last_message_id = max(self.last_message_id, message_id)
+        return True
+
+    def _forget_seen(self):
+        self._seen.clear()
+        self._seen_order.clear()
+
+    def _update_users(self, message):
+        """
+        Applies ONLINE_USERS|<number>|<nick1>|... (full list), USER_JOINED|<nick1>|...
+        or USER_LEFT|<nick1>|... to the list of online users.
+        """
+        parts = message.split("|")
+        if len(parts) < 2:
+            return False
+        if parts[0] == USER_JOINED:
+            self.users.update(dict.fromkeys(parts[1:]))
+        elif parts[0] == USER_LEFT:
+            for user in parts[1:]:
+                self.users.pop(user, None)
+        else:
+            self.users = dict.fromkeys(parts[2:])
+        return True
+
+    @property
+    def connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    def send_line(self, text):
+        """Queues one line (a message or a /command) for the server."""
+        if not self.connected:
+            raise ConnectionError("not connected")
+        self._writer.write(encode_line(text))
+
+    def send(self, text):
+        self.send_line(text)
+
+    def private(self, receiver, text):
+        self.send_line(f"/pm {receiver} {text}")
+
+    def join(self, room):
+        self.send_line(f"/join {room}")
+
+    def leave(self):
+        self.send_line("/leave")
+
+    def request_page(self, direction, message_id, count):
+        """Asks for the public messages "before" or "after" message_id; answered by a HistoryPage."""
+        self.send_line(f"/history {direction} {message_id} {count}")
+
+    async def drain(self):
+        """Waits until the transport's buffer is below its high-water mark; for bots that send a lot."""
+        if self._writer is not None:
+            await self._writer.drain()
+
+    def connect(self):
+        """Reconnects after disconnect(), without waiting for the retry delay."""
+        self._attempts = 0
+        self._wanted.set()
+        self._wakeup.set()
+
+    def disconnect(self):
+        """Drops the connection and stays offline until connect()."""
+        self._wanted.clear()
+        if self._writer is not None:
+            self._writer.close()
+
+    def close(self):
+        """Drops the connection for good; events() ends after yielding Disconnected."""
+        self._closed = True
+        self.disconnect()
+        self._wanted.set()
+        self._wakeup.set()
@@ -0,0 +1,334 @@
+"""
+Event-loop server engine.
+
+Serves the same wire protocol as server.py (username|offset handshake, HISTORY_END,
+ONLINE_USERS, /pm; framing lives in protocol.py) from a single asyncio loop instead
+of one thread per client, so one process can hold tens of thousands of idle connections.
+Messages are handled by the same code as in server.py: its handlers yield the
+steps that may block, and run_steps() performs them here without blocking the
+loop, database reads in a small thread pool and writes through the write-behind
+queue.
+
+Run with: python aio_server.py
+"""
+import asyncio
+import functools
+import socket
+import time
+
+import server
+from concurrent.futures import ThreadPoolExecutor
+
+from connections import (
+    OUTBOUND_HIGH_WATER, SLOW_CONSUMER_POLICY, OutboundQueue, SlowConsumer, SEND_SECONDS, SEND_TIMEOUT, compress, count,
+)
+from protocol import RECV_SIZE, FrameTooLarge, DeflateEncoder, decoder_for_first_chunk
+from server import (
+    HOST, PORT, logger, roster, format_offset, parse_handshake, load_recent_messages, register_client, release_live,
+    unregister_client, message_writer, storage, stop_on_sigterm, log_outbound_stats, announce, start_metrics,
+    RECV_PARSE_SECONDS, admission, flood_control, Blocking, Save, Drain, Relay, send_history, send_undelivered,
+    process_message,
+)
+
+# Threads used for database access; SQLite has a single writer, so keep this small
+DB_WORKERS = 2
+
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+
+
+class AsyncClient:
+    """
+    Wraps an asyncio stream pair so the shared helpers in server.py
+    (broadcast, find_client_socket, ...) can address it like a socket.
+    sendall() only queues the data; a writer task per client writes it out.
+    """
+
+    def __init__(self, reader, writer, high_water=OUTBOUND_HIGH_WATER, policy=SLOW_CONSUMER_POLICY):
+        self.reader = reader
+        self.writer = writer
+        self.outbound = OutboundQueue(high_water, policy)
+        self.encoder = None
+        self._ready = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._closing = False
+        self._closed = False
+        self._writer_task = asyncio.get_running_loop().create_task(self._write_loop())
+
+    def sendall(self, data, droppable=False):
+        if self._closing or self._closed:
+            raise ConnectionResetError("connection is closing")
+        try:
+            self.outbound.push(data, droppable)
+        except SlowConsumer:
+            count("evicted")
+            logger.warning("Evicting slow client: %d bytes queued, %d frames dropped so far.",
+                           self.outbound.bytes, self.outbound.dropped)
+            self._closed = True
+            self.writer.transport.abort()
+            self._ready.set()
+            raise
+        self._drained.clear()
+        self._ready.set()
+
+    def start_compression(self):
+        """Compresses everything sent from now on; must come before anything is sent."""
+        self.encoder = DeflateEncoder()
+
+    async def recv(self, size=RECV_SIZE):
+        return await self.reader.read(size)
+
+    async def drain(self):
+        """Waits until everything queued so far has been written to the transport."""
+        await self._drained.wait()
+
+    def depth(self):
+        return self.outbound.bytes
+
+    def close(self):
+        """Closes the connection once the queued data has been written."""
+        self._closing = True
+        self._ready.set()
+
+    async def _write_loop(self):
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                if self._closed:
+                    break
+                if len(self.outbound):
+                    data = compress(self.encoder, self.outbound.take())
+                    started = time.perf_counter()
+                    self.writer.write(data)
+                    await asyncio.wait_for(self.writer.drain(), SEND_TIMEOUT)
+                    SEND_SECONDS.observe(time.perf_counter() - started)
+                if not len(self.outbound):
+                    self._drained.set()
+                    if self._closing:
+                        break
+                else:
+                    self._ready.set()
+        except asyncio.TimeoutError:
+            # Same limit as the threaded engine's blocking sends; aborting also ends the reader
+            logger.debug("Writer stopped: no data accepted for %s seconds", SEND_TIMEOUT)
+            self.writer.transport.abort()
+        except (ConnectionError, OSError) as e:
+            logger.debug("Writer stopped: %s", e)
+        finally:
+            self._closed = True
+            self._drained.set()
+            self.writer.close()
+
+
+async def run_db(func, *args):
+    """Runs func(*args), which reads or writes storage, in the database thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args))
+
+
+async def run_steps(steps):
+    """Runs the steps of a handler from server.py on the loop; blocking calls go to the database pool."""
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as done:
+            return done.value
+        if isinstance(step, Blocking):
+            result = await run_db(step.func, *step.args)
+        elif isinstance(step, Save):
+            # Only this client waits while the writer's queue is full
+            await message_writer.submit_async(step.record)
+            result = step.record
+        elif isinstance(step, Drain):
+            await step.client.drain()
+            result = None
+        elif isinstance(step, Relay):
+            result = await asyncio.wrap_future(step.future)
+        else:
+            await asyncio.sleep(step.seconds)
+            result = None
+
+
+async def read_handshake(client):
+    """First chunk from a new connection, or b"" if none came within HANDSHAKE_TIMEOUT. Frees the handshake slot."""
+    try:
+        return await asyncio.wait_for(client.recv(), server.HANDSHAKE_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("No handshake within %s seconds. Closing connection.", server.HANDSHAKE_TIMEOUT)
+        return b""
+    finally:
+        admission.count("handshakes", -1)
+        admission.handshake_slots.release()
+
+
+async def handle_client(client):
+    username = None
+    try:
+        # Read data for user identification (username and timezone offset)
+        data = await read_handshake(client)
+        if not data:
+            logger.warning("No data received for user identification. Closing connection.")
+            return
+
+        decoder = decoder_for_first_chunk(data)
+        frames = decoder.feed_text(data)
+        username, offset_seconds, last_id, capabilities, room = parse_handshake(frames[0].strip() if frames else "")
+        pending = frames[1:]
+
+        if not username:
+            logger.warning("Username is empty. Closing connection.")
+            return
+
+        register_client(client, username, offset_seconds,
+                        resumable=last_id is not None, capabilities=capabilities, room=room)
+
+        logger.info("New client connected: '%s' (UTC%s)", username,
+                    format_offset(offset_seconds) if offset_seconds is not None else "")
+
+        # Send the public chat history the client is missing, once a join slot is free
+        admission.count("waiting", 1)
+        async with admission.join_slots:
+            admission.count("waiting", -1)
+            replayed = await run_steps(send_history(client, last_id, room))
+            logger.debug("Chat history sent to client '%s' (%d messages)", username, replayed)
+
+            stored = await run_steps(send_undelivered(client, username))
+            if stored:
+                logger.debug("Delivered %d stored private messages to '%s'", stored, username)
+
+        announce(f'==> "{username}" joined the chat')
+        client.sendall(roster.snapshot_for(client))
+        release_live(client)
+        roster.changed()
+
+        logger.info("User '%s' joined the chat.", username)
+
+        while True:
+            for frame in pending:
+                message_text = frame.strip()
+                if message_text:
+                    await run_steps(process_message(client, username, message_text))
+
+            data = await client.recv()
+            if not data:
+                logger.info("Client '%s' disconnected.", username)
+                break
+            started = time.perf_counter()
+            pending = decoder.feed_text(data)
+            RECV_PARSE_SECONDS.observe(time.perf_counter() - started)
+
+    except FrameTooLarge as e:
+        logger.warning("Closing connection of '%s': %s", username or "Unknown", e)
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        logger.info("Connection with '%s' lost: %s", username or "Unknown", e)
+    except Exception as e:
+        logger.error("Error in handle_client (user='%s'): %s", username or "Unknown", e, exc_info=True)
+    finally:
+        client.close()
+        left_user = unregister_client(client)
+        if left_user is not None:
+            announce(f'==> "{left_user}" left the chat')
+            roster.changed()
+
+            logger.info("Client '%s' removed from list after disconnection.", left_user)
+            log_outbound_stats()
+
+
+async def _on_connect(conn, addr):
+    """Serves an accepted socket; its handshake slot is already taken."""
+    try:
+        reader, writer = await asyncio.open_connection(sock=conn)
+    except OSError as e:
+        admission.count("handshakes", -1)
+        admission.handshake_slots.release()
+        conn.close()
+        logger.error("Error setting up connection %s: %s", addr, e)
+        return
+    logger.info("New connection: %s", addr)
+    await handle_client(AsyncClient(reader, writer))
+
+
+async def accept_clients(listen_sock):
+    """
+    Accepts connections until cancelled, each only once a handshake slot is free,
+    like the threaded engine: during a connect storm the rest wait in the backlog.
+    """
+    loop = asyncio.get_running_loop()
+    connections = set()
+    while True:
+        await admission.handshake_slots.acquire()
+        try:
+            conn, addr = await loop.sock_accept(listen_sock)
+        except OSError as e:
+            admission.handshake_slots.release()
+            logger.error("Error accepting new connection: %s", e, exc_info=True)
+            continue
+        admission.count("handshakes", 1)
+        # The loop keeps only weak references to tasks
+        task = loop.create_task(_on_connect(conn, addr))
+        connections.add(task)
+        task.add_done_callback(connections.discard)
+
+
+def raise_nofile_limit():
+    """Lifts the soft open-files limit to the hard limit so we can hold many sockets."""
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows, where the limit is not a concern
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            logger.info("Raised open files limit from %s to %s", soft, hard)
+        except (ValueError, OSError) as e:
+            logger.warning("Could not raise open files limit: %s", e)
+
+
+async def serve(host=HOST, port=PORT, sock=None, reuse_port=None):
+    """
+    Accepts clients until cancelled. Cluster workers pass either reuse_port=True,
+    so each binds its own socket to the shared port, or an already listening sock.
+    """
+    loop = asyncio.get_running_loop()
+    # Roster updates are coalesced on the loop instead of timer threads
+    roster.schedule = loop.call_later
+    # Clients wait for handshake and join slots on the loop instead of blocking it
+    admission.handshake_slots = asyncio.Semaphore(server.MAX_HANDSHAKES)
+    admission.join_slots = asyncio.Semaphore(server.JOIN_CONCURRENCY)
+    flood_control.configure(server.USER_MESSAGE_RATE, server.USER_MESSAGE_BURST,
+                            server.GLOBAL_MESSAGE_RATE, server.GLOBAL_MESSAGE_BURST)
+    if sock is None:
+        sock = socket.create_server((host, port), backlog=server.ACCEPT_BACKLOG, reuse_port=bool(reuse_port))
+    sock.setblocking(False)
+    logger.info("Async server running on %s:%s. Waiting for clients...", host, port)
+    try:
+        await accept_clients(sock)
+    finally:
+        sock.close()
+
+
+def main():
+    stop_on_sigterm()
+    raise_nofile_limit()
+    load_recent_messages()
+    message_writer.start()
+    start_metrics(server.METRICS_PORT)
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        logger.info("Server stopped.")
+    except OSError as e:
+        logger.error("Error binding to port %s: %s", PORT, e)
+    finally:
+        db_executor.shutdown(wait=True)
+        # Commit whatever is still queued before exiting
+        message_writer.stop()
+        storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Archive of messages past the retention window, written by "python maintenance.py archive".
+
+Each table has one gzip-compressed JSONL file per month of message timestamps in
+ARCHIVE_DIRECTORY (chat_messages-2026-01.jsonl.gz), rows in id order as the
+dicts of encode_row(). Every archived batch is appended as a gzip member of its
+own, so a file is never rewritten.
+
+Rows are archived in id order, so the archive of a table holds exactly the rows
+with ids up to its "archived_through" in manifest.json. The manifest also keeps,
+per partition, the committed file size, id range, row count and the rooms
+(public) or users (private) it contains, which lets readers skip partitions
+without opening them. A batch is appended and synced, then the manifest is
+replaced, and only then are the rows deleted from the database: a crash leaves
+at most an uncommitted tail, which readers ignore and the next append cuts off.
+
+The SQL backend reads the archive once a room's or conversation's rows in the
+database run out (storage.SQLStorage). A page of archived history decompresses
+the partitions it needs; the manifest is reloaded when the archiver changed it.
+"""
+import gzip
+import json
+import os
+import threading
+from collections import deque
+from datetime import datetime
+
+from models import ChatMessage, PrivateMessage
+from persistence import PublicRecord, PrivateRecord
+
+ARCHIVE_DIRECTORY = "archive"
+MANIFEST_FILE = "manifest.json"
+
+PUBLIC_TABLE = ChatMessage.__tablename__
+PRIVATE_TABLE = PrivateMessage.__tablename__
+RECORDS = {PUBLIC_TABLE: PublicRecord, PRIVATE_TABLE: PrivateRecord}
+
+
+def partition_key(timestamp):
+    """Month of a timestamp: "2026-01"."""
+    return f"{timestamp.year:04d}-{timestamp.month:02d}"
+
+
+def encode_row(row):
+    """Plain dict of a public or private row, with the timestamp in ISO format."""
+    data = row._asdict()
+    data["timestamp"] = data["timestamp"].isoformat()
+    return data
+
+
+def decode_row(table, data):
+    data["timestamp"] = datetime.fromisoformat(data["timestamp"])
+    return RECORDS[table](**data)
+
+
+def row_names(table, row):
+    """Room of a public row, sender and receiver of a private one."""
+    if table == PUBLIC_TABLE:
+        return (row.room,)
+    return (row.sender, row.receiver)
+
+
+class Archive:
+    """The archive files in a directory; see the module docstring. Safe to use from several threads."""
+
+    def __init__(self, directory=ARCHIVE_DIRECTORY):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_FILE)
+        self._manifest = {}
+        # (mtime, size) of the manifest loaded
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Reloads the manifest if it changed since it was read."""
+        try:
+            stat = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self._manifest = json.load(f)
+            self._stamp = stamp
+
+    def archived_through(self, table):
+        """Id up to which the table's rows are archived; 0 when none are."""
+        with self._lock:
+            return self._manifest.get(table, {}).get("archived_through", 0)
+
+    def partitions(self, table):
+        """(key, info) of the table's partitions, oldest month first."""
+        with self._lock:
+            return sorted(self._manifest.get(table, {}).get("partitions", {}).items())
+
+    def path(self, table, key):
+        return os.path.join(self.directory, f"{table}-{key}.jsonl.gz")
+
+    def append(self, table, rows):
+        """Archives rows (id order, all newer than archived_through) and commits them to the manifest."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            state = self._manifest.setdefault(table, {"archived_through": 0, "partitions": {}})
+            batches = {}
+            for row in rows:
+                batches.setdefault(partition_key(row.timestamp), []).append(row)
+            for key, batch in batches.items():
+                info = state["partitions"].setdefault(
+                    key, {"bytes": 0, "first_id": batch[0].id, "last_id": 0, "rows": 0, "names": {}})
+                data = gzip.compress("".join(
+                    json.dumps(encode_row(row), ensure_ascii=False, separators=(",", ":")) + "\n"
+                    for row in batch).encode('utf-8'))
+                with open(self.path(table, key), "ab") as f:
+                    # Drops the tail of an append that crashed before the manifest recorded it
+                    f.truncate(info["bytes"])
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                info["bytes"] += len(data)
+                info["last_id"] = max(info["last_id"], batch[-1].id)
+                info["rows"] += len(batch)
+                for row in batch:
+                    for name in row_names(table, row):
+                        info["names"][name] = info["names"].get(name, 0) + 1
+            state["archived_through"] = max(state["archived_through"], rows[-1].id)
+            self._save_manifest()
+
+    def _save_manifest(self):
+        temporary = self.manifest_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.manifest_path)
+        stat = os.stat(self.manifest_path)
+        self._stamp = (stat.st_mtime_ns, stat.st_size)
+
+    def read(self, table, key):
+        """Yields the committed rows of one partition in id order."""
+        through = self.archived_through(table)
+        with gzip.open(self.path(table, key), "rt", encoding="utf-8") as f:
+            for line in f:
+                data = json.loads(line)
+                if data["id"] > through:
+                    return
+                yield decode_row(table, data)
+
+    def rows(self, table, since=None, until=None):
+        """Yields the archived rows with since <= timestamp < until, partition by partition."""
+        self.refresh()
+        first = since and partition_key(since)
+        last = until and partition_key(until)
+        for key, _ in self.partitions(table):
+            if (first and key < first) or (last and key > last):
+                continue
+            for row in self.read(table, key):
+                if (since is None or row.timestamp >= since) and (until is None or row.timestamp < until):
+                    yield row
+
+    def newest(self, table, names, before_id=None, limit=1):
+        """The newest limit rows involving all of names with ids below before_id, oldest first."""
+        self.refresh()
+        rows = []
+        for key, info in sorted(self.partitions(table), key=lambda item: item[1]["last_id"], reverse=True):
+            if len(rows) >= limit and info["last_id"] < rows[0].id:
+                break
+            if (before_id is not None and info["first_id"] >= before_id
+                    or not all(name in info["names"] for name in names)):
+                continue
+            found = deque((row for row in self.read(table, key)
+                           if (before_id is None or row.id < before_id) and self._involves(table, row, names)),
+                          maxlen=limit)
+            rows = sorted(rows + list(found), key=lambda row: row.id)[-limit:]
+        return rows
+
+    def oldest(self, table, names, after_id=None, limit=1):
+        """The oldest limit rows involving all of names with ids above after_id, oldest first."""
+        self.refresh()
+        rows = []
+        for key, info in sorted(self.partitions(table), key=lambda item: item[1]["first_id"]):
+            if len(rows) >= limit and info["first_id"] > rows[-1].id:
+                break
+            if (after_id is not None and info["last_id"] <= after_id
+                    or not all(name in info["names"] for name in names)):
+                continue
+            found = []
+            for row in self.read(table, key):
+                if (after_id is None or row.id > after_id) and self._involves(table, row, names):
+                    found.append(row)
+                    if len(found) == limit:
+                        break
+            rows = sorted(rows + found, key=lambda row: row.id)[:limit]
+        return rows
+
+    @staticmethod
+    def _involves(table, row, names):
+        row_name_set = row_names(table, row)
+        return all(name in row_name_set for name in names)
@@ -0,0 +1,546 @@
+"""
+Headless load generator and latency benchmark for the chat server.
+
+Simulated users speak the normal handshake and line protocol from one asyncio
+loop. Every message they send carries the send time, so receivers can measure
+end-to-end delivery latency (the monotonic clock is shared by all processes of
+one machine). A run has two phases:
+
+  joins - the history is grown to each of --history-sizes messages and
+          --join-samples cold joins are timed from connect to HISTORY_END,
+  load  - --users users send --rate messages per second each for --duration
+          seconds, a --pm-ratio share of them as /pm, while --churn users per
+          second disconnect and reconnect. With --flood N one more user pastes
+          N messages at once; the server's flood control should hold it to its
+          per-user rate while the others' latency stays put.
+
+History is seeded by many short-lived users, SEED_BATCH messages each, so the
+seeding stays within the server's per-user burst.
+
+With --deflate the simulated users ask for compression (protocol.DEFLATE) and
+the joins report the bytes the replay took on the wire.
+
+Public latency is sampled on --probes receivers only, so the benchmark itself
+does not become the bottleneck; check client_cpu_seconds against the duration.
+Results, including the server's RSS, are written as JSON to --output.
+
+Examples:
+    python benchmark.py --spawn server.py --users 200 --rate 1 --duration 30
+    python benchmark.py --spawn cluster.py --spawn-args "--workers 4" --output cluster.json
+    python benchmark.py --spawn aio_server.py --join-samples 0 --flood 5000 --output flood.json
+    python benchmark.py --port 9090 --server-pid 12345      (server already running)
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+from collections import deque
+import time
+from datetime import datetime, timezone
+
+from protocol import (
+    HISTORY_END, MAX_FRAME_BYTES, RECV_SIZE, MSG, PRESENCE, ROOMS, DEFLATE, DEFAULT_ROOM, InflatingDecoder,
+    encode_line, split_tagged,
+)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Marker in the text of benchmark messages, followed by the send time in ns
+PUBLIC_MARK = "~b"
+PRIVATE_MARK = "~p"
+FLOOD_MARK = "~f"
+
+# History messages sent per seeding connection, within server.USER_MESSAGE_BURST,
+# and seeding connections open at once
+SEED_BATCH = 20
+SEED_CONNECTIONS = 20
+
+# Seconds to wait for a spawned server to accept connections
+SPAWN_TIMEOUT = 15
+
+# Port the servers listen on; of the spawnable scripts only cluster.py takes --port
+DEFAULT_PORT = 9090
+PORT_ARGUMENT_SCRIPTS = ("cluster.py",)
+
+# Replayed chat lines; HISTORY_RESET, ROOM and the like are not counted
+TAGGED_PREFIX = f"{MSG}|".encode()
+
+
+def percentiles(samples):
+    """Summary of latency samples (seconds) in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def at(fraction):
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "p50": at(0.50), "p90": at(0.90), "p99": at(0.99), "p999": at(0.999),
+        "max": round(ordered[-1] * 1000, 3),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 3),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.public_latency = []
+        self.private_latency = []
+        self.sent = {"public": 0, "private": 0}
+        self.received = 0
+        self.joins = []  # (seconds to HISTORY_END, replayed lines)
+        self.errors = 0
+
+
+class SimUser:
+    """One simulated client connection."""
+
+    def __init__(self, name, room, stats, probe=False, compress=False):
+        self.name = name
+        self.room = room
+        self.stats = stats
+        self.probe = probe
+        self.compress = compress
+        self.reader = None
+        self.writer = None
+        self.decoder = None
+        self._lines = deque()
+        # Bytes received from the server on the current connection
+        self.wire_bytes = 0
+
+    async def connect(self, host, port):
+        """Connects, waits for the history replay and returns (seconds, replayed messages)."""
+        started = time.monotonic()
+        self.reader, self.writer = await asyncio.open_connection(host, port, limit=4 * MAX_FRAME_BYTES)
+        self.decoder = InflatingDecoder() if self.compress else None
+        self._lines.clear()
+        self.wire_bytes = 0
+        capabilities = f"{PRESENCE},{ROOMS},{DEFLATE}" if self.compress else f"{PRESENCE},{ROOMS}"
+        self.writer.write(encode_line(f"{self.name}|0|0|{capabilities}|{self.room}"))
+        replayed = 0
+        try:
+            while True:
+                line = await self.readline()
+                if line is None:
+                    raise ConnectionError("closed during history replay")
+                if line == HISTORY_END.encode():
+                    break
+                if line.startswith(TAGGED_PREFIX):
+                    replayed += 1
+        except BaseException:
+            self.writer.close()
+            raise
+        return time.monotonic() - started, replayed
+
+    async def readline(self):
+        """Next line from the server without its delimiter; None once the connection is closed."""
+        if self.decoder is None:
+            line = await self.reader.readline()
+            self.wire_bytes += len(line)
+            return line.rstrip(b"\r\n") if line else None
+        while not self._lines:
+            data = await self.reader.read(RECV_SIZE)
+            if not data:
+                return None
+            self.wire_bytes += len(data)
+            self._lines.extend(self.decoder.feed(data))
+        return self._lines.popleft()
+
+    def send(self, text):
+        self.writer.write(encode_line(text))
+
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.readline()
+                if line is None:
+                    return
+                self.stats.received += 1
+                self._measure(line.decode('utf-8', errors='replace'))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def _measure(self, line):
+        _, text = split_tagged(line)
+        if PRIVATE_MARK in text:
+            # Skip the sender's own copy
+            if f"(Private) {self.name} ->" in text:
+                return
+            samples = self.stats.private_latency
+            mark = PRIVATE_MARK
+        elif self.probe and PUBLIC_MARK in text:
+            samples = self.stats.public_latency
+            mark = PUBLIC_MARK
+        else:
+            return
+        try:
+            sent_ns = int(text.rsplit(mark, 1)[1].split()[0])
+        except (IndexError, ValueError):
+            return
+        samples.append((time.monotonic_ns() - sent_ns) / 1e9)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+class RssSampler:
+    """Samples the resident set size of a process and its children from /proc (Linux)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []
+
+    @staticmethod
+    def _rss(pid):
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    @staticmethod
+    def _children(pid):
+        try:
+            with open(f"/proc/{pid}/task/{pid}/children") as children:
+                return [int(child) for child in children.read().split()]
+        except OSError:
+            return []
+
+    def sample(self):
+        total = 0
+        pending = [self.pid]
+        while pending:
+            pid = pending.pop()
+            total += self._rss(pid)
+            pending.extend(self._children(pid))
+        self.samples.append(total)
+        return total
+
+    async def run(self, interval=0.5):
+        while True:
+            self.sample()
+            await asyncio.sleep(interval)
+
+    def summary(self):
+        if not self.samples or not max(self.samples):
+            return None
+        return {"max": max(self.samples), "final": self.samples[-1]}
+
+
+def spawn_server(script, extra_args, workdir):
+    """Starts a server from this repository with a fresh messages.db in workdir."""
+    env = dict(os.environ, PYTHONPATH=REPO_DIR + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    return subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, script), *extra_args],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def port_in_use(host, port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        return probe.connect_ex((host, port)) == 0
+
+
+async def wait_for_port(host, port, timeout=SPAWN_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def seed(args, start, count):
+    """Sends history fillers start to start + count - 1 from a user of their own."""
+    seeder = SimUser(f"bench-seeder-{start}", DEFAULT_ROOM, Stats(), compress=args.deflate)
+    await seeder.connect(args.host, args.port)
+    seeder.writer.write(b"".join(encode_line(f"history filler {start + i}") for i in range(count)))
+    # The last message coming back means everything before it was broadcast
+    last = f"history filler {start + count - 1}"
+    while True:
+        line = await seeder.readline()
+        if line is None or line.decode('utf-8', errors='replace').rstrip().endswith(last):
+            break
+    await seeder.close()
+
+
+async def grow_history(args, target, already):
+    """Sends public messages until the history holds target messages; returns the new count."""
+    if target <= already:
+        return already
+    slots = asyncio.Semaphore(SEED_CONNECTIONS)
+
+    async def seed_batch(start):
+        async with slots:
+            await seed(args, start, min(SEED_BATCH, target - start))
+
+    await asyncio.gather(*(seed_batch(start) for start in range(already, target, SEED_BATCH)))
+    # Let the write-behind queue commit
+    await asyncio.sleep(0.5)
+    return target
+
+
+async def measure_joins(args):
+    results = []
+    history = 0
+    for size in args.history_sizes:
+        history = await grow_history(args, size, history)
+        timings = []
+        replayed = 0
+        wire_bytes = 0
+        for i in range(args.join_samples):
+            user = SimUser(f"bench-join-{i}", DEFAULT_ROOM, Stats(), compress=args.deflate)
+            seconds, replayed = await user.connect(args.host, args.port)
+            wire_bytes = user.wire_bytes
+            timings.append(seconds)
+            await user.close()
+        results.append({"history_size": size, "replayed": replayed, "replay_wire_bytes": wire_bytes,
+                        "join_ms": percentiles(timings)})
+    return results
+
+
+async def user_sender(user, users, args, stats, stop):
+    interval = 1.0 / args.rate if args.rate > 0 else None
+    # Spread the first sends so users do not fire in lockstep
+    await asyncio.sleep(random.random() * (interval or 0))
+    while interval and not stop.is_set():
+        try:
+            if random.random() < args.pm_ratio:
+                target = random.choice(users)
+                if target is not user:
+                    user.send(f"/pm {target.name} {PRIVATE_MARK} {time.monotonic_ns()}")
+                    stats.sent["private"] += 1
+            else:
+                user.send(f"{PUBLIC_MARK} {time.monotonic_ns()}")
+                stats.sent["public"] += 1
+        except ConnectionError:
+            stats.errors += 1
+        await asyncio.sleep(interval)
+
+
+async def flood(user, count, results):
+    """Pastes count public messages at once and counts them as they come back."""
+
+    async def paste():
+        lines = [encode_line(f"{FLOOD_MARK} {i}") for i in range(count)]
+        for i in range(0, count, SEED_BATCH):
+            user.writer.write(b"".join(lines[i:i + SEED_BATCH]))
+            # Blocks once the server stops reading from us
+            await user.writer.drain()
+
+    sender = asyncio.ensure_future(paste())
+    try:
+        while True:
+            line = await user.readline()
+            if line is None:
+                return
+            text = line.decode('utf-8', errors='replace')
+            if FLOOD_MARK in text:
+                results["delivered"] += 1
+            elif text.startswith("Slow down"):
+                results["throttle_notices"] += 1
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        sender.cancel()
+
+
+async def run_load(args, stats):
+    users = []
+    readers = {}
+    rooms = [DEFAULT_ROOM] + [f"bench-{i}" for i in range(1, args.rooms)]
+    for i in range(args.users):
+        user = SimUser(f"bench-{i}", rooms[i % len(rooms)], stats, probe=i < args.probes, compress=args.deflate)
+        try:
+            await asyncio.wait_for(user.connect(args.host, args.port), SPAWN_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            stats.errors += 1
+            continue
+        users.append(user)
+        # Connected users must keep reading, or presence broadcasts back up on the server
+        readers[user] = asyncio.ensure_future(user.read_loop())
+
+    stop = asyncio.Event()
+    tasks = {}
+    for user in users:
+        tasks[user] = (readers[user], asyncio.ensure_future(user_sender(user, users, args, stats, stop)))
+
+    async def churn():
+        while args.churn > 0 and not stop.is_set():
+            await asyncio.sleep(1.0 / args.churn)
+            # Probes stay connected so latency sampling is continuous
+            candidates = [user for user in users if not user.probe]
+            if not candidates:
+                continue
+            user = random.choice(candidates)
+            for task in tasks[user]:
+                task.cancel()
+            await user.close()
+            try:
+                seconds, replayed = await asyncio.wait_for(user.connect(args.host, args.port), SPAWN_TIMEOUT)
+                stats.joins.append((seconds, replayed))
+            except (OSError, asyncio.TimeoutError):
+                stats.errors += 1
+                continue
+            tasks[user] = (asyncio.ensure_future(user.read_loop()),
+                           asyncio.ensure_future(user_sender(user, users, args, stats, stop)))
+
+    flood_results = {"sent": args.flood, "delivered": 0, "throttle_notices": 0}
+    flooder = SimUser("bench-flooder", DEFAULT_ROOM, Stats(), compress=args.deflate)
+    flood_task = None
+    if args.flood:
+        await flooder.connect(args.host, args.port)
+        flood_task = asyncio.ensure_future(flood(flooder, args.flood, flood_results))
+
+    churn_task = asyncio.ensure_future(churn())
+    started = time.monotonic()
+    received_before = stats.received
+    await asyncio.sleep(args.duration)
+    stop.set()
+    elapsed = time.monotonic() - started
+    # Give in-flight messages a moment to arrive
+    await asyncio.sleep(1.0)
+    churn_task.cancel()
+    if flood_task is not None:
+        flood_task.cancel()
+        flood_results["delivered_per_second"] = round(flood_results["delivered"] / elapsed, 1)
+    for reader_task, sender_task in tasks.values():
+        reader_task.cancel()
+        sender_task.cancel()
+    for user in users + [flooder]:
+        await user.close()
+    return {
+        "connected_users": len(users),
+        "elapsed_seconds": round(elapsed, 3),
+        "sent_per_second": round(sum(stats.sent.values()) / elapsed, 1),
+        "received_per_second": round((stats.received - received_before) / elapsed, 1),
+        "sent": dict(stats.sent),
+        "flood": flood_results if args.flood else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(args):
+    server_process = None
+    workdir = None
+    pid = args.server_pid
+    if args.spawn:
+        if port_in_use(args.host, args.port):
+            raise SystemExit(f"{args.host}:{args.port} is already in use; stop that server or pick another --port")
+        spawn_args = shlex.split(args.spawn_args)
+        if os.path.basename(args.spawn) in PORT_ARGUMENT_SCRIPTS:
+            if "--port" not in spawn_args:
+                spawn_args += ["--port", str(args.port)]
+        elif args.port != DEFAULT_PORT:
+            raise SystemExit(f"{args.spawn} always listens on port {DEFAULT_PORT}; drop --port or spawn cluster.py")
+        workdir = tempfile.mkdtemp(prefix="chat-bench-")
+        server_process = spawn_server(args.spawn, spawn_args, workdir)
+        pid = server_process.pid
+    sampler = RssSampler(pid) if pid else None
+    sampler_task = asyncio.ensure_future(sampler.run()) if sampler else None
+    try:
+        await wait_for_port(args.host, args.port)
+        cpu_before = resource.getrusage(resource.RUSAGE_SELF)
+        joins = await measure_joins(args) if args.join_samples else []
+        stats = Stats()
+        throughput = await run_load(args, stats)
+        cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        if sampler_task:
+            sampler_task.cancel()
+            sampler.sample()
+        if server_process is not None:
+            server_process.terminate()
+            try:
+                server_process.wait(timeout=SPAWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                server_process.kill()
+                server_process.wait()
+
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "throughput": throughput,
+        "latency_ms": {
+            "public": percentiles(stats.public_latency),
+            "private": percentiles(stats.private_latency),
+        },
+        "join_vs_history": joins,
+        "churn_joins_ms": percentiles([seconds for seconds, _ in stats.joins]),
+        "server_rss_bytes": sampler.summary() if sampler else None,
+        "client_cpu_seconds": round((cpu_after.ru_utime - cpu_before.ru_utime)
+                                    + (cpu_after.ru_stime - cpu_before.ru_stime), 3),
+        "errors": stats.errors,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the chat server and record latency percentiles.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--spawn", metavar="SCRIPT",
+                        help="start this server script (server.py, aio_server.py, cluster.py) in a temp directory")
+    parser.add_argument("--spawn-args", default="", help="extra arguments for the spawned server")
+    parser.add_argument("--server-pid", type=int, help="pid of an already running server, for RSS sampling")
+    parser.add_argument("--users", type=int, default=50, help="simulated users during the load phase")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per user")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--pm-ratio", type=float, default=0.1, help="share of messages sent as /pm")
+    parser.add_argument("--churn", type=float, default=0.0, help="reconnects per second during the load phase")
+    parser.add_argument("--flood", type=int, default=0,
+                        help="messages one more user pastes at once during the load phase")
+    parser.add_argument("--rooms", type=int, default=1, help="rooms the users are spread over")
+    parser.add_argument("--probes", type=int, default=5, help="users that record public message latency")
+    parser.add_argument("--history-sizes", type=lambda value: [int(size) for size in value.split(",")],
+                        default=[0, 1000, 10000], help="comma-separated history sizes for the join phase")
+    parser.add_argument("--join-samples", type=int, default=5, help="timed joins per history size (0 skips)")
+    parser.add_argument("--deflate", action="store_true", help="simulated users ask for compression")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(benchmark(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    throughput = results["throughput"]
+    public = results["latency_ms"]["public"]
+    print(f"{throughput['connected_users']} users: {throughput['sent_per_second']} sent/s, "
+          f"{throughput['received_per_second']} delivered/s, public p50 {public.get('p50')} ms, "
+          f"p99 {public.get('p99')} ms -> {args.output}")
+    if throughput["flood"]:
+        print(f"flood: {throughput['flood']['delivered']} of {args.flood} delivered, "
+              f"{throughput['flood']['delivered_per_second']}/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,38 @@
-import socket
+import asyncio
+import queue
 import threading
+import time
 import tkinter as tk
+from collections import deque
 from tkinter import simpledialog, scrolledtext, filedialog
-import winsound  # used for sound notifications (Windows only)
-from datetime import datetime
+
+from aio_client import (
+    AsyncChatClient, Connected, Disconnected, History, HistoryPage, HistoryReset, Notice, PrivateMessage,
+    PublicMessage, RoomChanged, Roster, SystemMessage,
+)
+from protocol import DEFAULT_ROOM
+
+try:
+    import winsound  # used for sound notifications (Windows only)
+except ImportError:
+    winsound = None
 
 HOST = '127.0.0.1'
 PORT = 9090
 
+# The connection runs on its own event loop thread and never touches Tk: it queues
+# events that the Tk loop applies every RENDER_INTERVAL_MS, for at most RENDER_BUDGET seconds per frame
+RENDER_INTERVAL_MS = 16
+RENDER_BUDGET = 0.012
+
+# Lines kept in the chat. The oldest are trimmed while the view follows the newest
+# messages; while the user reads further up, only past twice this many.
+SCROLLBACK_LINES = 5000
+
+# Older messages fetched each time the view reaches the top, and per page of an export
+OLDER_PAGE_LINES = 100
+EXPORT_PAGE_LINES = 500
+
 
 class ChatClient:
     def __init__(self, master):
@@ -31,8 +56,10 @@ class ChatClient:
         self.toggle_button = tk.Button(top_frame, text="Disconnect", command=self.toggle_connection)
         self.toggle_button.pack(side=tk.LEFT, padx=10)
 
-        self.current_users = []
-        self.history_loaded = False
+        # Online users in join order, as last reported by the connection
+        self.current_users = ()
+        # Room shown in the chat
+        self.room = DEFAULT_ROOM
 
         # Chat text area
         self.text_area = scrolledtext.ScrolledText(master, state='disabled', wrap='word')
@@ -43,6 +70,20 @@ class ChatClient:
         self.text_area.tag_config("private_received", foreground="orange", font=("Helvetica", 10, "bold"))
         self.text_area.tag_config("my_message", foreground="green", font=("Helvetica", 10, "bold"))
 
+        # Display events from any thread, applied by drain_events on the Tk thread
+        self.events = queue.SimpleQueue()
+        self.master.after(RENDER_INTERVAL_MS, self.drain_events)
+
+        # Message id of every line in the chat (None for lines without one), oldest first
+        self.line_ids = deque()
+        # Whether the server may hold messages older than the oldest one shown
+        self.older_available = False
+        self.loading_older = False
+        self.text_area.config(yscrollcommand=self.on_scroll)
+
+        # File the room history is being streamed to by export_chat (written on the connection's thread)
+        self.export_file = None
+
         # Message entry area
         entry_frame = tk.Frame(master)
         entry_frame.pack(pady=5, fill=tk.X)
@@ -64,190 +105,340 @@ class ChatClient:
         self.running = True
         # Flag indicating that the connection is manually disconnected
         self.connection_blocked = False
+        # Whether the connection is up, as last reported by it, and whether it has been lost before
+        self.online = False
+        self.reconnecting = False
 
-        # Connect to the server
-        self.connect_to_server()
+        # Protocol handling, history merging and reconnects live in the headless client;
+        # it runs on its own event loop in a background thread
+        self.connection = AsyncChatClient(self.username, host=HOST, port=PORT)
+        self.loop = asyncio.new_event_loop()
+        self.network_thread = threading.Thread(target=self.run_connection, daemon=True)
+        self.network_thread.start()
 
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
 
-    def connect_to_server(self):
-        """Attempt to connect to the server if not manually blocked."""
-        if self.connection_blocked:
-            return
-
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        try:
-            self.sock.connect((HOST, PORT))
-        except Exception:
-            if not self.connection_blocked:
-                self.master.after(5000, self.connect_to_server)
-            return
-
-        try:
-            local_offset_seconds = int(datetime.now().astimezone().utcoffset().total_seconds())
-            self.sock.sendall(f"{self.username}|{local_offset_seconds}".encode('utf-8'))
-        except Exception:
-            self.display_message("Error sending username.", tag="system")
-            self.master.after(5000, self.connect_to_server)
-            return
-
-        self.display_message("Server connection restored!", tag="system")
-
-        # Clear the chat before reloading chat history
-        self.clear_chat()
+    def run_connection(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.pump_events())
+
+    async def pump_events(self):
+        """Turns the connection's events into display events for the Tk thread."""
+        async for event in self.connection.events():
+            self.show_event(event)
+
+    def show_event(self, event):
+        """Runs on the connection's thread; only queues display events, except export pages which it writes."""
+        if isinstance(event, PublicMessage):
+            own = event.sender == self.username
+            self.display_message(event.line, tag="my_message" if own else "client", message_id=event.id)
+            if not own and self.connection.history_loaded:
+                self.events.put(("notify",))
+        elif isinstance(event, PrivateMessage):
+            if event.sender == self.username:
+                self.display_message(event.line, tag="private_sent")
+            else:
+                self.display_message(event.line, tag="private_received")
+                if self.connection.history_loaded:
+                    self.events.put(("notify",))
+        elif isinstance(event, SystemMessage):
+            self.display_message(event.line, tag="system")
+        elif isinstance(event, Notice):
+            self.display_message(event.line)
+        elif isinstance(event, History):
+            # One event for the whole replay, rendered as a single insert
+            self.events.put(("history", [self.line_for(message) for message in event.messages]))
+        elif isinstance(event, HistoryPage):
+            if event.direction == "after":
+                self.write_export_page(event.messages, event.more)
+            else:
+                self.events.put(("older", [self.line_for(message) for message in event.messages], event.more))
+        elif isinstance(event, Roster):
+            self.events.put(("online", event.users))
+        elif isinstance(event, RoomChanged):
+            self.events.put(("room", event.room))
+            self.clear_chat()
+        elif isinstance(event, HistoryReset):
+            # The replay does not continue from what is shown
+            self.clear_chat()
+        elif isinstance(event, Connected):
+            self.online = True
+            if self.reconnecting:
+                self.display_message("Server connection restored!", tag="system")
+            # Without a known last message the whole window is replayed, so start from a clean chat
+            if not event.resumed:
+                self.clear_chat()
+        elif isinstance(event, Disconnected):
+            if self.export_file is not None:
+                self.finish_export("Export interrupted: the connection was lost.")
+            if self.online and self.running and not self.connection_blocked:
+                self.display_message("Server disconnected. Attempting to reconnect...", tag="system")
+            self.online = False
+            self.reconnecting = True
+
+    def line_for(self, message):
+        """(text, tag, message id) for a message shown as history."""
+        if isinstance(message, PublicMessage):
+            return message.line, "my_message" if message.sender == self.username else "client", message.id
+        if isinstance(message, PrivateMessage):
+            return message.line, "private_sent" if message.sender == self.username else "private_received", None
+        if isinstance(message, SystemMessage):
+            return message.line, "system", None
+        return message.line, "client", None
+
+    def call(self, func, *args, on_error=None):
+        """Runs a sending method of the connection on its event loop; on_error() runs when it is not connected."""
+        def run():
+            try:
+                func(*args)
+            except ConnectionError:
+                (on_error or self.request_failed)()
+        self.loop.call_soon_threadsafe(run)
 
-        self.receive_thread = threading.Thread(target=self.receive_loop, daemon=True)
-        self.receive_thread.start()
+    def request_failed(self):
+        self.display_message("Error sending request.", tag="system")
 
     def toggle_connection(self):
         """Toggle the connection state: disconnect when pressed, reconnect on next press."""
         if not self.connection_blocked:
             self.connection_blocked = True
-            try:
-                self.sock.close()
-            except Exception:
-                pass
+            self.loop.call_soon_threadsafe(self.connection.disconnect)
             self.display_message("Connection manually disconnected.", tag="system")
             self.toggle_button.config(text="Connect")
         else:
             self.connection_blocked = False
             self.display_message("Attempting to restore connection...", tag="system")
             self.toggle_button.config(text="Disconnect")
-            self.connect_to_server()
+            self.loop.call_soon_threadsafe(self.connection.connect)
 
     def export_chat(self):
-        chat_text = self.text_area.get("1.0", tk.END)
+        """
+        Saves the room's whole public history, not just what the chat shows. The server
+        sends it page by page and each page is appended to the file as it arrives.
+        """
+        if self.export_file is not None:
+            self.display_message("An export is already running.", tag="system")
+            return
         file_path = filedialog.asksaveasfilename(defaultextension=".txt", filetypes=[("Text files", "*.txt")])
-        if file_path:
-            try:
-                with open(file_path, "w", encoding="utf-8") as f:
-                    f.write(chat_text)
-            except Exception:
-                self.display_message("Error exporting chat.", tag="system")
+        if not file_path:
+            return
+        try:
+            self.export_file = open(file_path, "w", encoding="utf-8")
+        except OSError:
+            self.display_message("Error exporting chat.", tag="system")
+            return
+        self.display_message(f"Exporting the history of #{self.room}...", tag="system")
+        self.call(self.connection.request_page, "after", 0, EXPORT_PAGE_LINES,
+                  on_error=lambda: self.finish_export("Error exporting chat."))
+
+    def write_export_page(self, messages, more):
+        """Appends a history page to the export file and asks for the next one."""
+        export_file = self.export_file
+        if export_file is None:
+            # A page asked for by something else, or the export already ended
+            return
+        try:
+            export_file.writelines(message.line + "\n" for message in messages)
+            last_id = getattr(messages[-1], "id", None) if messages else None
+            if more and last_id is not None:
+                self.connection.request_page("after", last_id, EXPORT_PAGE_LINES)
+                return
+        except Exception:
+            self.finish_export("Error exporting chat.")
+            return
+        self.finish_export(f"Chat exported to {export_file.name}.")
+
+    def finish_export(self, message):
+        export_file, self.export_file = self.export_file, None
+        if export_file is not None:
+            export_file.close()
+        self.display_message(message, tag="system")
 
     def play_notification_sound(self):
+        if winsound is None:
+            self.master.bell()
+            return
         try:
-            winsound.PlaySound("SystemAsterisk", winsound.SND_ALIAS)
+            winsound.PlaySound("SystemAsterisk", winsound.SND_ALIAS | winsound.SND_ASYNC)
         except Exception:
             pass
 
-    def receive_loop(self):
-        """
-        Main loop for receiving data from the server.
-        Collects chat history into a buffer until receiving the "HISTORY_END" line,
-        then displays it all at once for instant loading.
-        """
-        buffer = ""
-        collecting_history = True
-        history_lines = []
+    def show_online_count(self, users):
+        self.current_users = users
+        self.online_label.config(text=f"Online: {len(users)}")
 
-        while self.running:
-            try:
-                data = self.sock.recv(1024)
-                if not data:
-                    self.display_message("Server disconnected.", tag="system")
-                    break
-
-                buffer += data.decode('utf-8')
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    line = line.strip()
-                    if not line:
-                        continue
-
-                    if collecting_history:
-                        if line == "HISTORY_END":
-                            for hist_line in history_lines:
-                                self.display_message(hist_line)
-                            history_lines.clear()
-                            collecting_history = False
-                            self.history_loaded = True
-                            continue
-                        else:
-                            history_lines.append(line)
-                            continue
-
-                    if line.startswith("ONLINE_USERS|"):
-                        self.handle_online_users_message(line)
-                    else:
-                        if "(Private)" in line:
-                            if f"(Private) {self.username} ->" in line:
-                                self.display_message(line, tag="private_sent")
-                            else:
-                                self.display_message(line, tag="private_received")
-                                if self.history_loaded:
-                                    self.play_notification_sound()
-                        else:
-                            if "System:" in line:
-                                self.display_message(line, tag="system")
-                            else:
-                                if f"] {self.username}:" in line:
-                                    self.display_message(line, tag="my_message")
-                                else:
-                                    self.display_message(line, tag="client")
-                                    if self.history_loaded and self.username not in line:
-                                        self.play_notification_sound()
-
-            except Exception:
-                self.display_message("Error receiving data from the server.", tag="system")
-                break
+    def display_message(self, message, tag="client", message_id=None):
+        """Queues a line for the chat; safe to call from any thread."""
+        self.events.put(("line", message, tag, message_id))
+
+    def set_room(self, room):
+        self.room = room
+        self.master.title(f"Chat Client - #{room}")
 
-        self.sock.close()
-        if self.running and not self.connection_blocked:
-            self.display_message("Attempting to reconnect...", tag="system")
-            self.master.after(5000, self.connect_to_server)
+    def clear_chat(self):
+        """Queues clearing the chat, in order with the lines around it."""
+        self.events.put(("clear",))
 
-    def handle_online_users_message(self, message):
+    def drain_events(self):
         """
-        Processes the online users message.
-        Expected format: ONLINE_USERS|<number>|<nick1>|<nick2>|...
+        Applies queued events on the Tk thread. Consecutive lines become one
+        multi-tag insert, the scrollback is trimmed and the view scrolls at most
+        once per frame. Stops after RENDER_BUDGET seconds so the window stays
+        responsive; the rest is picked up right after Tk has redrawn.
         """
-        parts = message.split("|")
-        if len(parts) < 2:
+        if self.events.empty():
+            self.master.after(RENDER_INTERVAL_MS, self.drain_events)
             return
-        try:
-            count = int(parts[1])
-        except ValueError:
-            count = 0
-        users = parts[2:]
-        self.online_label.config(text=f"Online: {count}")
-        self.current_users = users
-
-    def display_message(self, message, tag="client"):
+        deadline = time.monotonic() + RENDER_BUDGET
+        # Only keep scrolling along if the user was looking at the newest messages
+        following = self.text_area.yview()[1] >= 1.0
+        runs = []  # [tag, [text, ...], [message id per chat line]] for consecutive lines with the same tag
+        inserted = False
+        notify = False
+        while time.monotonic() < deadline:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            kind = event[0]
+            if kind == "line":
+                self._add_line(runs, *event[1:])
+                continue
+            if kind == "history":
+                for line in event[1]:
+                    self._add_line(runs, *line)
+                self.older_available = any(message_id is not None for _, _, message_id in event[1])
+                continue
+            if kind == "notify":
+                notify = True
+                continue
+            # Everything else must see the lines queued before it
+            inserted |= self._insert_runs(runs)
+            if kind == "clear":
+                self.text_area.config(state='normal')
+                self.text_area.delete("1.0", tk.END)
+                self.text_area.config(state='disabled')
+                self.line_ids.clear()
+                self.older_available = False
+                self.loading_older = False
+            elif kind == "older":
+                self.prepend_older(event[1], event[2])
+            elif kind == "room":
+                self.set_room(event[1])
+            elif kind == "online":
+                self.show_online_count(event[1])
+        inserted |= self._insert_runs(runs)
+        if inserted:
+            self.trim_scrollback(following)
+            if following:
+                self.text_area.see(tk.END)
+        # One sound for a burst of messages
+        if notify:
+            self.play_notification_sound()
+        self.master.after(1 if not self.events.empty() else RENDER_INTERVAL_MS, self.drain_events)
+
+    @staticmethod
+    def _add_line(runs, text, tag, message_id=None):
+        if not runs or runs[-1][0] != tag:
+            runs.append([tag, [], []])
+        runs[-1][1].append(text)
+        runs[-1][2].append(message_id)
+        # Lines with line breaks (the help text) take several lines of the chat
+        breaks = text.count("\n")
+        if breaks:
+            runs[-1][2].extend([None] * breaks)
+
+    def _insert_runs(self, runs, at_top=False):
+        """
+        Inserts the collected lines with one Text.insert call, below the chat or above it;
+        returns whether anything was inserted.
+        """
+        if not runs:
+            return False
+        args = []
+        for tag, lines, message_ids in runs:
+            args.append("\n".join(lines) + "\n")
+            args.append(tag)
+        message_ids = [message_id for _, _, run_ids in runs for message_id in run_ids]
+        if at_top:
+            self.line_ids.extendleft(reversed(message_ids))
+        else:
+            self.line_ids.extend(message_ids)
         self.text_area.config(state='normal')
-        self.text_area.insert(tk.END, message + "\n", tag)
+        self.text_area.insert("1.0" if at_top else tk.END, *args)
         self.text_area.config(state='disabled')
-        self.text_area.see(tk.END)
+        runs.clear()
+        return True
 
-    def clear_chat(self):
+    def trim_scrollback(self, following):
+        """Drops the oldest lines beyond SCROLLBACK_LINES; they can be fetched again by scrolling up."""
+        excess = len(self.line_ids) - SCROLLBACK_LINES
+        if excess <= 0 or (not following and excess < SCROLLBACK_LINES):
+            return
         self.text_area.config(state='normal')
-        self.text_area.delete("1.0", tk.END)
+        self.text_area.delete("1.0", f"{excess + 1}.0")
         self.text_area.config(state='disabled')
+        for _ in range(excess):
+            self.line_ids.popleft()
+        self.older_available = True
+
+    def on_scroll(self, first, last):
+        """yscrollcommand of the chat: moves the scrollbar and loads older messages at the top."""
+        self.text_area.vbar.set(first, last)
+        if float(first) <= 0.0 and self.older_available and not self.loading_older:
+            self.request_older()
+
+    def request_older(self):
+        oldest_id = next((message_id for message_id in self.line_ids if message_id is not None), None)
+        if oldest_id is None:
+            return
+        self.loading_older = True
+        self.call(self.connection.request_page, "before", oldest_id, OLDER_PAGE_LINES, on_error=self.older_failed)
+
+    def older_failed(self):
+        self.loading_older = False
+
+    def prepend_older(self, lines, more):
+        """Puts a page of older messages above the chat without moving what the user is looking at."""
+        self.loading_older = False
+        self.older_available = more
+        runs = []
+        for line in lines:
+            self._add_line(runs, *line)
+        inserted = sum(len(message_ids) for _, _, message_ids in runs)
+        if not self._insert_runs(runs, at_top=True):
+            return
+        self.text_area.yview(f"{inserted + 1}.0")
 
     def process_command(self, msg):
-        if msg.startswith("/who"):
+        command = msg.split(maxsplit=1)[0]
+        if command == "/who":
             self.display_message("Users: " + ", ".join(self.current_users), tag="system")
-        elif msg.startswith("/clear"):
+        elif command == "/clear":
             self.clear_chat()
-        elif msg.startswith("/help"):
+        elif command == "/help":
             help_text = (
                 "Available commands:\n"
                 "/who - list users\n"
                 "/clear - clear chat\n"
                 "/pm <username> <message> - private message\n"
+                "/search [-p <page>] <terms> - search public history\n"
+                "/pmhistory <username> [before_id] - private messages with a user\n"
+                "/join <room> - switch to a room\n"
+                "/leave - back to #general\n"
+                "/rooms - list rooms\n"
                 "/help - help"
             )
             self.display_message(help_text, tag="system")
-        elif msg.startswith("/pm"):
+        elif command == "/pm":
             parts = msg.split(" ", 2)
             if len(parts) < 3:
                 self.display_message("Error: Usage /pm <username> <message>", tag="system")
             else:
-                try:
-                    self.sock.sendall(msg.encode('utf-8'))
-                except Exception:
-                    self.display_message("Error sending private message.", tag="system")
+                self.call(self.connection.send_line, msg,
+                          on_error=lambda: self.display_message("Error sending private message.", tag="system"))
+        elif command in ("/search", "/pmhistory", "/join", "/leave", "/rooms"):
+            self.call(self.connection.send_line, msg)
         else:
             self.display_message("Unknown command. Use /help", tag="system")
 
@@ -258,10 +449,8 @@ class ChatClient:
         if msg.startswith("/"):
             self.process_command(msg)
         else:
-            try:
-                self.sock.sendall(msg.encode('utf-8'))
-            except Exception:
-                self.display_message("Error sending message. Server may be unavailable.", tag="system")
+            self.call(self.connection.send, msg, on_error=lambda: self.display_message(
+                "Error sending message. Server may be unavailable.", tag="system"))
         self.entry_field.delete(0, tk.END)
 
     def show_online_users(self, event=None):
@@ -274,10 +463,7 @@ class ChatClient:
 
     def on_closing(self):
         self.running = False
-        try:
-            self.sock.close()
-        except:
-            pass
+        self.loop.call_soon_threadsafe(self.connection.close)
         self.master.destroy()
 
 
@@ -0,0 +1,387 @@
+"""
+Multi-process server: N asyncio workers on one port, joined by a local message bus.
+
+Each worker is a forked aio_server process with its own clients. With
+SO_REUSEPORT every worker binds the port itself and the kernel spreads new
+connections over them; without it the parent binds once and the workers share
+the listening socket (pre-fork accept).
+
+The parent process is the broker. Workers connect to it over a Unix socket and
+exchange one JSON object per line:
+
+  worker -> broker   {"op": "pub", "user", "text", "room", "seq"}   public message
+                     {"op": "pm", "from", "to", "text", "seq"}      private message
+                     {"op": "sys", "text", "room"}             system message (room null: everyone)
+                     {"op": "join", "user", "room"}            local presence change
+                     {"op": "leave", "user"}
+                     {"op": "room", "user", "room"}            user moved to another room
+  broker -> worker   {"op": "pub", "id", "ts", "user", "text", "room", "origin", "seq"}
+                     {"op": "pm", "id", "ts", "from", "to", "text", "stored", "origin", "seq"}
+                     {"op": "sys", "text", "room"}
+                     {"op": "join"|"room", "user", "room", "worker"}
+                     {"op": "leave", "user", "worker"}
+                     {"op": "presence", "users": {user: worker}, "rooms": {user: room}}
+
+The broker is the only process that assigns message ids and writes to the
+database, so history stays ordered exactly as every worker broadcast it, and it
+keeps the cluster-wide username -> worker and username -> room maps used for
+/pm routing, rosters and /rooms. Each worker only fans a public message out to
+the members of its room. Events for a worker are queued and written by a task of
+their own; a worker that stops reading is cut off once BUS_HIGH_WATER bytes wait.
+
+A worker numbers the pub and pm events it sends (seq). The broker's answer carries
+the sending worker's id (origin) and that number, and the client who sent the
+message waits for it before its next line is handled, so a pipelined "/join"
+cannot overtake the echo of the message before it.
+
+With --metrics-port N the broker serves its metrics (database writer) on
+localhost:N and worker i serves its own (clients, fanout) on N + 1 + i.
+
+POSIX only (fork and Unix sockets). Run with: python cluster.py --workers 4
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+from datetime import datetime
+
+import aio_server
+import server
+from connections import DISCONNECT
+from protocol import MAX_FRAME_BYTES, encode_lines
+from persistence import PublicRecord, PrivateRecord
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# Bus lines carry whole chat messages, so allow a frame plus the JSON envelope
+BUS_LINE_LIMIT = 4 * MAX_FRAME_BYTES
+
+# Bytes queued for a worker that stopped reading before the broker cuts it off
+BUS_HIGH_WATER = 16 * 1024 * 1024
+
+
+def _encode(event):
+    return json.dumps(event, separators=(",", ":")).encode('utf-8') + b"\n"
+
+
+class Broker:
+    """Sequences, stores and fans out events for all workers."""
+
+    def __init__(self, writer=None):
+        self.message_writer = writer or server.message_writer
+        self.workers = {}  # worker id -> AsyncClient queueing the worker's events
+        self.presence = {}  # username -> worker id
+        self.rooms = {}  # username -> room
+
+    async def handle_worker(self, reader, writer):
+        worker_id = None
+        try:
+            hello = await reader.readline()
+            if not hello:
+                logger.warning("A worker closed its bus connection before saying hello.")
+                return
+            worker_id = json.loads(hello)["worker"]
+            link = aio_server.AsyncClient(reader, writer, BUS_HIGH_WATER, DISCONNECT)
+            self.workers[worker_id] = link
+            link.sendall(_encode({"op": "presence", "users": self.presence, "rooms": self.rooms}))
+            logger.info("Worker %s connected to the bus.", worker_id)
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self.dispatch(worker_id, json.loads(line))
+        except (ConnectionError, ValueError, KeyError, TypeError) as e:
+            # ValueError also covers malformed JSON and lines over BUS_LINE_LIMIT
+            logger.warning("Bus connection of worker %s failed: %s", worker_id, e)
+        except asyncio.CancelledError:
+            # Broker shutting down
+            pass
+        finally:
+            link = self.workers.get(worker_id)
+            if link is not None and link.writer is writer:
+                link.close()
+                self._drop_worker(worker_id)
+            else:
+                writer.close()
+
+    def _drop_worker(self, worker_id):
+        del self.workers[worker_id]
+        # Users of a dead worker are gone for everyone else
+        for username in [user for user, owner in self.presence.items() if owner == worker_id]:
+            del self.presence[username]
+            self.rooms.pop(username, None)
+            self.fanout({"op": "leave", "user": username, "worker": worker_id})
+        logger.info("Worker %s left the bus.", worker_id)
+
+    async def dispatch(self, worker_id, event):
+        op = event["op"]
+        if op == "pub":
+            # Fanned out as soon as it is numbered, so workers get ids in increasing order
+            record = self.message_writer.new_public(event["user"], event["text"], event["room"])
+            self.fanout({"op": "pub", "id": record.id, "ts": record.timestamp.isoformat(),
+                         "user": record.username, "text": record.message, "room": record.room,
+                         "origin": worker_id, "seq": event.get("seq")})
+            await self.message_writer.submit_async(record)
+        elif op == "pm":
+            target_worker = self.presence.get(event["to"])
+            # Receivers who are offline get the message when they next connect
+            record = self.message_writer.new_private(event["from"], event["to"], event["text"],
+                                                     delivered=target_worker is not None)
+            await self.message_writer.submit_async(record)
+            reply = {"op": "pm", "id": record.id, "ts": record.timestamp.isoformat(),
+                     "from": record.sender, "to": record.receiver, "text": record.message,
+                     "stored": not record.delivered, "origin": worker_id, "seq": event.get("seq")}
+            if target_worker is not None:
+                self.send(target_worker, reply)
+            if target_worker != worker_id:
+                self.send(worker_id, reply)
+        elif op == "sys":
+            self.fanout(event)
+        elif op in ("join", "room"):
+            self.presence[event["user"]] = worker_id
+            self.rooms[event["user"]] = event["room"]
+            self.fanout({"op": op, "user": event["user"], "room": event["room"], "worker": worker_id},
+                        exclude=worker_id)
+        elif op == "leave":
+            # A reconnect on another worker may already own the name
+            if self.presence.get(event["user"]) == worker_id:
+                del self.presence[event["user"]]
+                self.rooms.pop(event["user"], None)
+                self.fanout({"op": "leave", "user": event["user"], "worker": worker_id}, exclude=worker_id)
+
+    def send(self, worker_id, event):
+        link = self.workers.get(worker_id)
+        if link is not None:
+            self._queue(link, _encode(event))
+
+    def fanout(self, event, exclude=None):
+        data = _encode(event)
+        for worker_id, link in list(self.workers.items()):
+            if worker_id != exclude:
+                self._queue(link, data)
+
+    @staticmethod
+    def _queue(link, data):
+        try:
+            link.sendall(data)
+        except ConnectionError:
+            # Cut off for not reading; its handler cleans up once the reader sees the abort
+            pass
+
+
+class WorkerBus:
+    """A worker's connection to the broker; installed as server.bus."""
+
+    def __init__(self, worker_id, reader, writer):
+        self.worker_id = worker_id
+        self.reader = reader
+        self.writer = writer
+        # seq -> Future of a pub or pm event the broker has not answered yet
+        self._waiting = {}
+        self._seq = 0
+
+    @classmethod
+    async def connect(cls, worker_id, path):
+        reader, writer = await asyncio.open_unix_connection(path, limit=BUS_LINE_LIMIT)
+        writer.write(_encode({"worker": worker_id}))
+        return cls(worker_id, reader, writer)
+
+    def _send(self, event):
+        self.writer.write(_encode(event))
+
+    def _request(self, event):
+        """Sends a numbered event; returns a Future done once the broker's answer has been applied."""
+        self._seq += 1
+        future = concurrent.futures.Future()
+        self._waiting[self._seq] = future
+        self._send(dict(event, seq=self._seq))
+        return future
+
+    def publish(self, username, message_text, room):
+        return self._request({"op": "pub", "user": username, "text": message_text, "room": room})
+
+    def private(self, sender, receiver, message_text):
+        return self._request({"op": "pm", "from": sender, "to": receiver, "text": message_text})
+
+    def system(self, text, room=None):
+        self._send({"op": "sys", "text": text, "room": room})
+
+    def joined(self, username, room):
+        self._send({"op": "join", "user": username, "room": room})
+
+    def moved(self, username, room):
+        self._send({"op": "room", "user": username, "room": room})
+
+    def left(self, username):
+        self._send({"op": "leave", "user": username})
+
+    async def run(self):
+        """Applies the broker's events to this worker's clients until the bus closes."""
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    raise ConnectionError("message bus closed")
+                self.apply(json.loads(line))
+        finally:
+            for future in self._waiting.values():
+                future.set_exception(ConnectionError("message bus closed"))
+            self._waiting.clear()
+
+    def apply(self, event):
+        op = event["op"]
+        if op == "pub":
+            server.broadcast_public(PublicRecord(
+                event["id"], datetime.fromisoformat(event["ts"]), event["user"], event["text"], event["room"]))
+        elif op == "pm":
+            record = PrivateRecord(event["id"], datetime.fromisoformat(event["ts"]),
+                                   event["from"], event["to"], event["text"], not event["stored"])
+            for username in (record.receiver, record.sender):
+                client = server.find_client_socket(username)
+                if client is None:
+                    continue
+                lines = [server.private_line(record, username=username)]
+                if username == record.sender and event["stored"]:
+                    lines.append(server.offline_notice(record.receiver))
+                try:
+                    server.send_live(client, encode_lines(lines), droppable=False)
+                except Exception as e:
+                    logger.error("Error sending private message to '%s': %s", username, e)
+            logger.debug("Private message %d from '%s' to '%s'", record.id, record.sender, record.receiver)
+        elif op == "sys":
+            server.broadcast_system(event["text"], event["room"])
+        elif op == "join":
+            server.remote_users[event["user"]] = event["worker"]
+            server.remote_rooms[event["user"]] = event["room"]
+            server.roster.changed()
+        elif op == "room":
+            server.remote_rooms[event["user"]] = event["room"]
+        elif op == "leave":
+            if server.remote_users.get(event["user"]) == event["worker"]:
+                del server.remote_users[event["user"]]
+                server.remote_rooms.pop(event["user"], None)
+                server.roster.changed()
+        elif op == "presence":
+            remote = [user for user, owner in event["users"].items() if owner != self.worker_id]
+            server.remote_users.clear()
+            server.remote_users.update((user, event["users"][user]) for user in remote)
+            server.remote_rooms.clear()
+            server.remote_rooms.update((user, event["rooms"][user]) for user in remote if user in event["rooms"])
+            server.roster.changed()
+        if event.get("origin") == self.worker_id:
+            future = self._waiting.pop(event["seq"], None)
+            if future is not None:
+                future.set_result(None)
+
+
+async def _worker_serve(worker_id, bus_path, listen_sock, host, port):
+    bus = await WorkerBus.connect(worker_id, bus_path)
+    server.bus = bus
+    reuse_port = True if listen_sock is None else None
+    accept = asyncio.ensure_future(aio_server.serve(host, port, sock=listen_sock, reuse_port=reuse_port))
+    bus_task = asyncio.ensure_future(bus.run())
+    done, pending = await asyncio.wait({accept, bus_task}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    for task in done:
+        task.result()
+
+
+def worker_main(worker_id, bus_path, listen_sock, bus_listener, host=server.HOST, port=server.PORT,
+                metrics_port=None):
+    # Inherited from the parent, which keeps handling them
+    bus_listener.close()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Pooled database connections must not be shared across fork
+    server.storage.after_fork()
+    if metrics_port is not None:
+        server.start_metrics(metrics_port + 1 + worker_id)
+    server.load_recent_messages()
+    try:
+        asyncio.run(_worker_serve(worker_id, bus_path, listen_sock, host, port))
+    except KeyboardInterrupt:
+        pass
+    except ConnectionError as e:
+        logger.error("Worker %s stopped: %s", worker_id, e)
+    finally:
+        aio_server.db_executor.shutdown(wait=True)
+        # Forked children skip atexit handlers
+        server.stop_log_listener()
+
+
+def _listen_socket(host, port):
+    """Listening socket the workers share when the platform has no SO_REUSEPORT."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(server.ACCEPT_BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+
+async def _run_broker(broker, bus_listener):
+    bus_server = await asyncio.start_unix_server(broker.handle_worker, sock=bus_listener, limit=BUS_LINE_LIMIT)
+    async with bus_server:
+        await bus_server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the chat server as several worker processes.")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of worker processes")
+    parser.add_argument("--host", default=server.HOST)
+    parser.add_argument("--port", type=int, default=server.PORT)
+    parser.add_argument("--metrics-port", type=int, default=server.METRICS_PORT,
+                        help="serve metrics on localhost: the broker on this port, worker i on port + 1 + i")
+    args = parser.parse_args()
+
+    bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+    bus_path = os.path.join(bus_dir, "bus.sock")
+    bus_listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    bus_listener.bind(bus_path)
+    bus_listener.listen(args.workers)
+
+    listen_sock = None if hasattr(socket, "SO_REUSEPORT") else _listen_socket(args.host, args.port)
+
+    # Fork before the parent starts any threads or event loop
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=worker_main, name=f"worker-{i}",
+                               args=(i, bus_path, listen_sock, bus_listener, args.host, args.port,
+                                     args.metrics_port), daemon=True)
+               for i in range(args.workers)]
+    for process in workers:
+        process.start()
+    if listen_sock is not None:
+        listen_sock.close()
+    logger.info("Started %d workers on %s:%s (%s).", args.workers, args.host, args.port,
+                "SO_REUSEPORT" if listen_sock is None else "shared listening socket")
+
+    server.stop_on_sigterm()
+    server.storage.after_fork()
+    server.message_writer.start()
+    server.start_metrics(args.metrics_port)
+    try:
+        asyncio.run(_run_broker(Broker(), bus_listener))
+    except KeyboardInterrupt:
+        logger.info("Cluster stopped.")
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join()
+        # Commit whatever the broker still has queued
+        server.message_writer.stop()
+        server.storage.close()
+        os.unlink(bus_path)
+        os.rmdir(bus_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Outbound queues for client connections.
+
+Every connection owns a bounded queue of encoded frames drained by its own
+writer, so sending to a client only appends to that queue and never waits for
+the network. Fanout traffic is marked droppable; replies and history replay are
+not. When a queue grows past OUTBOUND_HIGH_WATER bytes, SLOW_CONSUMER_POLICY
+decides what happens:
+  "drop_oldest" - the oldest droppable frames are discarded,
+  "disconnect"  - the client is evicted.
+
+The queue holds plain frames. A connection that negotiated compression
+(protocol.DEFLATE) runs each batch its writer takes through its DeflateEncoder
+just before the write, outside any lock.
+"""
+import logging
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from metrics import Histogram
+from protocol import DeflateEncoder
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_HIGH_WATER = 1024 * 1024
+
+# A client that accepts no data for this many seconds is considered gone
+SEND_TIMEOUT = 30
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+SLOW_CONSUMER_POLICY = DROP_OLDEST
+
+# Totals over all connections; deflate_in/deflate_out are bytes before and after compression
+outbound_counters = {"dropped": 0, "evicted": 0, "deflate_in": 0, "deflate_out": 0}
+
+SEND_SECONDS = Histogram("chat_socket_send_seconds", "Time to write one batch of queued frames to a client socket.")
+_counters_lock = threading.Lock()
+
+
+def count(name, amount=1):
+    with _counters_lock:
+        outbound_counters[name] += amount
+
+
+class SlowConsumer(ConnectionError):
+    """Raised when a client's outbound queue passes the high-water mark under the disconnect policy."""
+
+
+class OutboundQueue:
+    """Frames waiting to be written to one client, with their total size."""
+
+    def __init__(self, high_water=OUTBOUND_HIGH_WATER, policy=SLOW_CONSUMER_POLICY):
+        self.high_water = high_water
+        self.policy = policy
+        self._items = deque()  # (data, droppable)
+        self.bytes = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def push(self, data, droppable=False):
+        self._items.append((data, droppable))
+        self.bytes += len(data)
+        if self.bytes > self.high_water:
+            if self.policy == DISCONNECT:
+                raise SlowConsumer(f"outbound queue over {self.high_water} bytes")
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        kept = deque()
+        dropped = 0
+        while self.bytes > self.high_water and self._items:
+            data, droppable = self._items.popleft()
+            if droppable:
+                self.bytes -= len(data)
+                dropped += 1
+            else:
+                kept.append((data, droppable))
+        kept.extend(self._items)
+        self._items = kept
+        if dropped:
+            self.dropped += dropped
+            count("dropped", dropped)
+
+    def take(self):
+        """Removes and returns everything queued as one buffer."""
+        data = b"".join(item[0] for item in self._items)
+        self._items.clear()
+        self.bytes = 0
+        return data
+
+
+def compress(encoder, data):
+    """Data as the connection writes it: compressed when the connection has an encoder."""
+    if encoder is None:
+        return data
+    compressed = encoder.encode(data)
+    with _counters_lock:
+        outbound_counters["deflate_in"] += len(data)
+        outbound_counters["deflate_out"] += len(compressed)
+    return compressed
+
+
+class ClientConnection:
+    """
+    Client socket for the threaded engine. sendall() only queues the data;
+    a dedicated writer thread performs the blocking socket writes.
+    """
+
+    def __init__(self, sock, high_water=OUTBOUND_HIGH_WATER, policy=SLOW_CONSUMER_POLICY):
+        self.sock = sock
+        # Bounds the writer's blocking sends; recv() below retries on it
+        self.sock.settimeout(SEND_TIMEOUT)
+        self.outbound = OutboundQueue(high_water, policy)
+        # Set by start_compression(); only the writer thread uses it
+        self.encoder = None
+        self._cond = threading.Condition()
+        self._closing = False
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def sendall(self, data, droppable=False):
+        with self._cond:
+            if self._closing or self._closed:
+                raise ConnectionResetError("connection is closed")
+            try:
+                self.outbound.push(data, droppable)
+            except SlowConsumer:
+                self._evict()
+                raise
+            self._cond.notify_all()
+
+    def start_compression(self):
+        """Compresses everything sent from now on; must come before anything is sent."""
+        self.encoder = DeflateEncoder()
+
+    def recv(self, size):
+        while True:
+            try:
+                return self.sock.recv(size)
+            except socket.timeout:
+                if self._closed:
+                    return b""
+
+    def wait_readable(self, timeout):
+        """Whether data (or EOF) arrives within timeout seconds."""
+        # A selector rather than select.select(), which rejects fds of 1024 and above
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.sock, selectors.EVENT_READ)
+            return bool(selector.select(timeout))
+
+    def drain(self):
+        """Waits until everything queued so far has been taken by the writer."""
+        with self._cond:
+            while len(self.outbound) and not self._closed:
+                self._cond.wait()
+
+    def depth(self):
+        return self.outbound.bytes
+
+    def close(self):
+        """Closes the connection once the queued data has been written."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            writer_done = self._closed
+        if writer_done:
+            self.sock.close()
+
+    def _evict(self):
+        count("evicted")
+        logger.warning("Evicting slow client: %d bytes queued, %d frames dropped so far.",
+                       self.outbound.bytes, self.outbound.dropped)
+        self._closed = True
+        self._shutdown()
+        self._cond.notify_all()
+
+    def _shutdown(self):
+        # Wakes up the reader and the writer blocked on this socket
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self._cond:
+                    while not len(self.outbound) and not self._closing and not self._closed:
+                        self._cond.wait()
+                    if self._closed or not len(self.outbound):
+                        break
+                    data = self.outbound.take()
+                    self._cond.notify_all()
+                data = compress(self.encoder, data)
+                started = time.perf_counter()
+                self.sock.sendall(data)
+                SEND_SECONDS.observe(time.perf_counter() - started)
+        except OSError as e:
+            logger.debug("Writer stopped: %s", e)
+            self._shutdown()
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+                # The reader may still be using the socket; close() finishes the job then
+                reader_done = self._closing
+            if reader_done:
+                self.sock.close()
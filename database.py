@@ -1,10 +1,46 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool
+
+DATABASE_URL = "sqlite:///messages.db"
+
+# Applied to every new connection. WAL lets readers run alongside the writer;
+# synchronous=NORMAL is safe with WAL and only risks the last commits on power loss.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -32000,           # KiB (negative) -> 32 MB page cache per connection
+    "mmap_size": 256 * 1024 * 1024,
+    "busy_timeout": 5000,           # ms to wait for the write lock instead of failing
+    "temp_store": "MEMORY",
+}
+
+# Connections kept open: the message writer, the async engine's DB threads and
+# history replays of the threaded engine; bursts go to the overflow
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
 
 engine = create_engine(
-    "sqlite:///messages.db",
+    DATABASE_URL,
     echo=False,
-    connect_args={"check_same_thread": False}
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
 )
+
+
+@event.listens_for(engine, "connect")
+def _apply_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
 Session = sessionmaker(bind=engine)
 Base = declarative_base()
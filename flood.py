@@ -0,0 +1,114 @@
+"""
+Flood control: token buckets that delay messages over a rate instead of rejecting them.
+
+FloodControl keeps one bucket per user and one for the process; the server asks
+it how long to hold each public or private message back before handling it.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    rate tokens per second, up to burst of them; one per message. Kept as the time at
+    which the bucket is full again, so an idle bucket costs nothing to refill.
+    """
+
+    def __init__(self, rate, burst):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.full_at = 0.0
+        # Messages held back and seconds they waited, for the logs
+        self.throttled = 0
+        self.delay = 0.0
+        self.throttling = False
+
+    def reserve(self, now):
+        """Takes a token; returns the seconds to wait until it is there."""
+        full_at = max(self.full_at, now)
+        self.full_at = full_at + self.interval
+        return max(0.0, full_at - self.tolerance - now)
+
+    def idle(self, now):
+        return self.full_at <= now
+
+
+class FloodControl:
+    """
+    Token buckets on public and private messages, one per user and one for the process,
+    set from the server settings when it starts: in server.main() and aio_server.serve().
+    A message over a limit is delayed, not rejected: the sender's reader waits before
+    handling it, so the client stops being read and its data backs up in its socket.
+    """
+
+    def __init__(self):
+        self.user_limit = None
+        self.global_rate = None
+        self.global_bucket = None
+        self.counts = {"throttled": 0, "delay": 0.0}
+        self._buckets = {}
+        # Users who left while throttled; their buckets are kept until they drain
+        self._parked = set()
+        self._lock = threading.Lock()
+
+    def configure(self, user_rate, user_burst, global_rate, global_burst):
+        self.user_limit = (user_rate, user_burst) if user_rate else None
+        self.global_rate = global_rate
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate else None
+
+    def user_delay(self, username):
+        """Seconds the user's next message has to wait, and whether throttling the user starts with it."""
+        if self.user_limit is None:
+            return 0.0, False
+        now = time.monotonic()
+        with self._lock:
+            self._parked.discard(username)
+            bucket = self._buckets.get(username)
+            if bucket is None:
+                bucket = self._buckets[username] = TokenBucket(*self.user_limit)
+            wait = bucket.reserve(now)
+            started = self._account(bucket, wait)
+        if started:
+            logger.warning("Throttling '%s': over %s messages per second.", username, self.user_limit[0])
+        return wait, started
+
+    def global_delay(self):
+        """Seconds the next message of any user has to wait for the process-wide limit."""
+        if self.global_bucket is None:
+            return 0.0
+        with self._lock:
+            wait = self.global_bucket.reserve(time.monotonic())
+            started = self._account(self.global_bucket, wait)
+        if started:
+            logger.warning("Throttling all users: over %s messages per second.", self.global_rate)
+        return wait
+
+    def _account(self, bucket, wait):
+        started = bool(wait) and not bucket.throttling
+        bucket.throttling = bool(wait)
+        if wait:
+            bucket.throttled += 1
+            bucket.delay += wait
+            self.counts["throttled"] += 1
+            self.counts["delay"] += wait
+        return started
+
+    def forget(self, username):
+        """Called when the user leaves; logs what was held back."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(username)
+            if bucket is not None and bucket.idle(now):
+                del self._buckets[username]
+            elif bucket is not None:
+                # Reconnecting must not refill the bucket
+                self._parked.add(username)
+            for name in [name for name in self._parked if self._buckets[name].idle(now)]:
+                self._parked.discard(name)
+                del self._buckets[name]
+        if bucket is not None and bucket.throttled:
+            logger.info("'%s' had %d messages throttled, held back %.1f seconds in total.",
+                        username, bucket.throttled, bucket.delay)
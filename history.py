@@ -0,0 +1,313 @@
+"""
+Chat history: queries and the in-memory buffer of recent public messages.
+
+History is read per room with keyset pagination on the (room, timestamp, id)
+index instead of loading the whole table: a joining client gets the room's rows
+after the last message it has seen, or the newest HISTORY_WINDOW rows on a cold
+join, fetched and sent HISTORY_CHUNK rows at a time. Older pages are read the
+same way, backwards from the oldest message the client holds.
+
+Private conversations are paged backwards by id on the (sender, receiver, id)
+index, one range scan per direction, so a page costs the same however large
+private_messages grows.
+"""
+import heapq
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+
+from sqlalchemy import and_, or_, select, false
+
+from models import ChatMessage, PrivateMessage
+from protocol import DEFAULT_ROOM
+
+# Number of most recent messages replayed to a client that joins without history
+HISTORY_WINDOW = 200
+
+# Rows fetched per query and sent per write during replay
+HISTORY_CHUNK = 500
+
+# Recent messages kept in memory for replay; should not be smaller than HISTORY_WINDOW
+RECENT_MESSAGES_SIZE = 1000
+RECENT_MESSAGES_MAX_BYTES = 4 * 1024 * 1024
+
+# Rooms with a buffer of their own; the least recently used one is dropped beyond this
+RECENT_ROOMS = 64
+
+# Public messages per /history page, by default and at most
+HISTORY_PAGE_SIZE = 100
+HISTORY_PAGE_MAX = HISTORY_CHUNK
+
+# Private messages per /pmhistory page
+PM_HISTORY_PAGE = 50
+
+HISTORY_COLUMNS = (ChatMessage.id, ChatMessage.timestamp, ChatMessage.username, ChatMessage.message)
+PRIVATE_COLUMNS = (PrivateMessage.id, PrivateMessage.timestamp, PrivateMessage.sender,
+                   PrivateMessage.receiver, PrivateMessage.message)
+
+
+def after_message(message_id):
+    """Filter for rows that sort after the given message in (timestamp, id) order."""
+    cursor_ts = select(ChatMessage.timestamp).where(ChatMessage.id == message_id).scalar_subquery()
+    # The redundant >= bound gives SQLite a range to seek to in the index
+    return and_(
+        ChatMessage.timestamp >= cursor_ts,
+        or_(
+            ChatMessage.timestamp > cursor_ts,
+            and_(ChatMessage.timestamp == cursor_ts, ChatMessage.id > message_id),
+        ),
+    )
+
+
+def before_message(message_id):
+    """Filter for rows that sort before the given message in (timestamp, id) order."""
+    cursor_ts = select(ChatMessage.timestamp).where(ChatMessage.id == message_id).scalar_subquery()
+    return and_(
+        ChatMessage.timestamp <= cursor_ts,
+        or_(
+            ChatMessage.timestamp < cursor_ts,
+            and_(ChatMessage.timestamp == cursor_ts, ChatMessage.id < message_id),
+        ),
+    )
+
+
+def replay_start(session_db, last_id=None, window=HISTORY_WINDOW, room=DEFAULT_ROOM):
+    """
+    Works out where history replay of a room for a joining client begins.
+    Returns (after_id, reset): rows after after_id are replayed (None means from the oldest row).
+    reset is True when the client's last seen message is unknown or older than the window,
+    so whatever the client still shows is not contiguous with the replay.
+    """
+    window_bound = (
+        session_db.query(ChatMessage.id)
+        .filter(ChatMessage.room == room)
+        .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+        .offset(window)
+        .limit(1)
+        .scalar()
+    )
+    if last_id:
+        query = session_db.query(ChatMessage.id).filter(ChatMessage.id == last_id, ChatMessage.room == room)
+        if window_bound is not None and last_id != window_bound:
+            query = query.filter(after_message(window_bound))
+        if query.first() is not None:
+            return last_id, False
+    return window_bound, True
+
+
+def fetch_page(session_db, after_id=None, limit=HISTORY_CHUNK, room=DEFAULT_ROOM, archived_through=0):
+    """
+    Returns up to limit rows of the room following after_id, oldest first.
+    Rows with ids up to archived_through are left out: they are read from the archive.
+    """
+    query = session_db.query(*HISTORY_COLUMNS).filter(ChatMessage.room == room)
+    if after_id is not None:
+        query = query.filter(after_message(after_id))
+    if archived_through:
+        query = query.filter(ChatMessage.id > archived_through)
+    return query.order_by(ChatMessage.timestamp.asc(), ChatMessage.id.asc()).limit(limit).all()
+
+
+def fetch_page_before(session_db, before_id, limit=HISTORY_PAGE_SIZE, room=DEFAULT_ROOM):
+    """Returns up to limit rows of the room preceding before_id, oldest first."""
+    rows = (
+        session_db.query(*HISTORY_COLUMNS)
+        .filter(ChatMessage.room == room, before_message(before_id))
+        .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+        .limit(limit)
+        .all()
+    )
+    rows.reverse()
+    return rows
+
+
+def fetch_recent(session_db, room=DEFAULT_ROOM, limit=RECENT_MESSAGES_SIZE):
+    """Returns the room's newest limit rows, oldest first."""
+    rows = (
+        session_db.query(*HISTORY_COLUMNS)
+        .filter(ChatMessage.room == room)
+        .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+        .limit(limit)
+        .all()
+    )
+    rows.reverse()
+    return rows
+
+
+def _private_direction(session_db, sender, receiver, before_id):
+    query = session_db.query(*PRIVATE_COLUMNS).filter(
+        PrivateMessage.sender == sender, PrivateMessage.receiver == receiver)
+    if before_id is not None:
+        query = query.filter(PrivateMessage.id < before_id)
+    return query.order_by(PrivateMessage.id.desc())
+
+
+def iter_conversation(session_db, user, other, before_id=None, limit=PM_HISTORY_PAGE):
+    """
+    Yields up to limit private messages between user and other with ids below before_id,
+    newest first. Both directions are read as index range scans and merged as rows arrive.
+    """
+    sent = _private_direction(session_db, user, other, before_id).limit(limit)
+    received = _private_direction(session_db, other, user, before_id).limit(limit)
+    merged = heapq.merge(sent.yield_per(limit), received.yield_per(limit),
+                         key=lambda row: row.id, reverse=True)
+    return islice(merged, limit)
+
+
+def iter_undelivered(session_db, receiver):
+    """Yields the private messages stored for receiver while they were offline, oldest first."""
+    return (
+        session_db.query(*PRIVATE_COLUMNS)
+        .filter(PrivateMessage.receiver == receiver, PrivateMessage.delivered == false())
+        .order_by(PrivateMessage.id.asc())
+        .yield_per(HISTORY_CHUNK)
+    )
+
+
+def mark_delivered(session_db, receiver, up_to_id):
+    """Flags every stored message for receiver up to up_to_id as delivered, in one statement."""
+    session_db.query(PrivateMessage).filter(
+        PrivateMessage.receiver == receiver,
+        PrivateMessage.delivered == false(),
+        PrivateMessage.id <= up_to_id,
+    ).update({PrivateMessage.delivered: True}, synchronize_session=False)
+    session_db.commit()
+
+
+class RecentMessages:
+    """
+    Ring buffer of the most recently persisted public messages, already rendered in UTC and
+    encoded (plain and MSG-tagged), so that joins and reconnects inside the window are served
+    without touching the database. The rows are kept too, for readers in other timezones.
+    Bounded by both entry count and total size. Safe to use from several threads.
+    """
+
+    def __init__(self, size=RECENT_MESSAGES_SIZE, max_bytes=RECENT_MESSAGES_MAX_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        self._entries = deque()  # (message_id, data, tagged_data, row), oldest first
+        self._bytes = 0
+        # True while the buffer holds every message in the database
+        self._complete = False
+        self._lock = threading.Lock()
+
+    def fill(self, storage, render, room=DEFAULT_ROOM):
+        """Loads the room's newest rows from storage; render(row) returns (data, tagged_data)."""
+        rows = storage.recent(room, self.size)
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._complete = True
+            for row in rows:
+                self._append(row, *render(row))
+            if len(rows) == self.size:
+                self._complete = False
+
+    def append(self, row, data, tagged_data):
+        with self._lock:
+            self._append(row, data, tagged_data)
+
+    @staticmethod
+    def _size(entry):
+        _, data, tagged_data, row = entry
+        return len(data) + len(tagged_data) + len(row.username) + len(row.message)
+
+    def _append(self, row, data, tagged_data):
+        message_id = row.id
+        entry = (message_id, data, tagged_data, row)
+        entries = self._entries
+        if entries and message_id < entries[-1][0]:
+            # Committed concurrently and appended out of order; keep the buffer sorted by id
+            position = len(entries)
+            while position and entries[position - 1][0] > message_id:
+                position -= 1
+            entries.insert(position, entry)
+        else:
+            entries.append(entry)
+        self._bytes += self._size(entry)
+        while entries and (len(entries) > self.size or self._bytes > self.max_bytes):
+            self._bytes -= self._size(entries.popleft())
+            self._complete = False
+
+    def replay(self, last_id=None, window=HISTORY_WINDOW, chunk=HISTORY_CHUNK, render=None):
+        """
+        Same contract as replay_start() + paging with Storage.fetch_page(), served from memory.
+        Returns (chunks, reset, count) with chunks as encoded buffers of at most chunk messages,
+        or None when the requested range is not fully in the buffer. Chunks are the cached
+        UTC lines, or render(rows, tagged) for a reader who needs them rendered differently.
+        """
+        tagged = last_id is not None
+        with self._lock:
+            entries = self._entries
+            newest_id = entries[-1][0] if entries else 0
+            missing = []
+            reached_last = False
+            if last_id and last_id <= newest_id:
+                for entry in reversed(entries):
+                    if entry[0] <= last_id:
+                        reached_last = True
+                        break
+                    missing.append(entry)
+                    if len(missing) > window:
+                        break
+            if reached_last:
+                reset = False
+            elif len(entries) >= window or self._complete:
+                reset = True
+                missing = list(islice(reversed(entries), window))
+            else:
+                return None
+        missing.reverse()
+        if render is not None:
+            chunks = [render([entry[3] for entry in missing[i:i + chunk]], tagged)
+                      for i in range(0, len(missing), chunk)]
+            return chunks, reset, len(missing)
+        index = 2 if tagged else 1
+        chunks = [
+            b"".join(entry[index] for entry in missing[i:i + chunk])
+            for i in range(0, len(missing), chunk)
+        ]
+        return chunks, reset, len(missing)
+
+    def stats(self):
+        with self._lock:
+            return len(self._entries), self._bytes
+
+
+class RoomHistory:
+    """
+    RecentMessages per room. A room's buffer is created empty on first use and
+    only serves replays once it holds enough messages, so rooms never need to be
+    loaded from the database up front. At most max_rooms buffers are kept.
+    """
+
+    def __init__(self, max_rooms=RECENT_ROOMS, size=RECENT_MESSAGES_SIZE, max_bytes=RECENT_MESSAGES_MAX_BYTES):
+        self.max_rooms = max_rooms
+        self.size = size
+        self.max_bytes = max_bytes
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+
+    def room(self, name=DEFAULT_ROOM):
+        with self._lock:
+            buffer = self._rooms.get(name)
+            if buffer is None:
+                buffer = self._rooms[name] = RecentMessages(self.size, self.max_bytes)
+                while len(self._rooms) > self.max_rooms:
+                    self._rooms.popitem(last=False)
+            else:
+                self._rooms.move_to_end(name)
+            return buffer
+
+    def append(self, room, row, data, tagged_data):
+        self.room(room).append(row, data, tagged_data)
+
+    def replay(self, room, last_id=None, window=HISTORY_WINDOW, chunk=HISTORY_CHUNK, render=None):
+        return self.room(room).replay(last_id, window, chunk, render)
+
+    def stats(self):
+        """Total (messages, bytes) over all buffered rooms."""
+        with self._lock:
+            buffers = list(self._rooms.values())
+        totals = [buffer.stats() for buffer in buffers]
+        return sum(count for count, _ in totals), sum(size for _, size in totals)
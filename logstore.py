@@ -0,0 +1,590 @@
+"""
+Append-only log storage: the "log" backend of storage.py.
+
+Messages are appended to numbered segment files in LOG_DIRECTORY, one record each:
+
+    length u32 | crc32 u32 | kind u8 | id u64 | timestamp i64 | len a u16 | len b u16 | len c u32 | a | b | c
+
+length and the CRC cover everything after them, the timestamp is in microseconds
+since the epoch (UTC) and a, b, c are UTF-8 text:
+    PUBLIC     room, username, message
+    PRIVATE    sender, receiver, message (STORED when the receiver was offline)
+    DELIVERED  receiver; the id is the newest stored message now delivered
+
+A batch of the message writer is one write(). Once a segment passes SEGMENT_BYTES
+it is sealed: its data is synced, its index is written under a temporary name,
+synced and renamed into place, and only then is the next segment created. A
+segment counts as sealed once a newer one exists, so a crash anywhere in the
+rollover leaves either a sealed segment with a complete index or the segment
+still being appended to. On open the active segment is scanned and a record
+torn by a crash is cut off; a sealed segment whose index is missing or stale is
+indexed again from its data.
+
+An index holds one fixed-size entry per record (id, timestamp, offset, key, kind),
+sorted by id within the public, private and delivery groups, and is
+memory-mapped like the sealed data it points into: a range read is a binary
+search in the index and reads straight from the mapped segment. key is the
+crc32 of the room or of the conversation, checked before a record is decoded.
+The active segment's entries are kept in memory.
+
+Ids grow along the log except for a record that reached the writer after a
+later one; reads merge the segments whose id ranges overlap. Rows are ordered
+by id, where the SQL backend orders by timestamp and id.
+
+Durability matches the SQLite settings: a batch reaches the OS before the next
+one is written, but is only synced at rollover and on close unless LOG_FSYNC
+is set. /search scans the newest LOG_SEARCH_SCAN public messages for the
+terms, newest first, instead of ranking with a full-text index.
+
+Cluster workers (after_fork) share the directory with the broker: appends are
+serialised by an exclusive lock on LOCK_FILE, and every read first picks up
+what other processes appended.
+"""
+import heapq
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: appends are only serialised within the process, which is all a single server needs
+    fcntl = None
+
+from history import HISTORY_CHUNK, HISTORY_PAGE_SIZE, HISTORY_WINDOW, PM_HISTORY_PAGE
+from persistence import PublicRecord, PrivateRecord
+from protocol import DEFAULT_ROOM
+from search import SEARCH_PAGE_SIZE, search_terms
+from storage import Storage
+
+LOG_DIRECTORY = "messages.log"
+LOCK_FILE = "LOCK"
+
+# Size past which the active segment is sealed and a new one started
+SEGMENT_BYTES = 32 * 1024 * 1024
+
+# Sync every batch to disk instead of only at rollover and on close
+LOG_FSYNC = False
+
+# Newest public messages /search looks through
+LOG_SEARCH_SCAN = 50000
+
+# Record kinds
+PUBLIC = 1
+PRIVATE = 2
+STORED = 3
+DELIVERED = 4
+
+# Index groups, each sorted by id: public messages, private messages, deliveries
+PUBLIC_GROUP = 0
+PRIVATE_GROUP = 1
+DELIVERY_GROUP = 2
+GROUP_OF_KIND = {PUBLIC: PUBLIC_GROUP, PRIVATE: PRIVATE_GROUP, STORED: PRIVATE_GROUP, DELIVERED: DELIVERY_GROUP}
+
+RECORD_HEADER = struct.Struct("<II")  # length and crc32 of the body
+RECORD_BODY = struct.Struct("<BQqHHI")  # kind, id, timestamp, text lengths
+INDEX_HEADER = struct.Struct("<4sQIII")  # magic, data bytes indexed, entries per group
+INDEX_ENTRY = struct.Struct("<QqIIB")  # id, timestamp, offset, key, kind
+INDEX_MAGIC = b"CLI1"
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+O_BINARY = getattr(os, "O_BINARY", 0)
+
+
+def name_key(name):
+    """Key of a room, or of the receiver of a delivery."""
+    return zlib.crc32(name)
+
+
+def conversation_key(sender, receiver):
+    """The same key for both directions of a conversation."""
+    return zlib.crc32(b"\0".join(sorted((sender, receiver))))
+
+
+def encode_record(kind, message_id, timestamp, a, b=b"", c=b""):
+    body = RECORD_BODY.pack(kind, message_id, (timestamp - EPOCH) // MICROSECOND, len(a), len(b), len(c)) + a + b + c
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def entry_key(kind, a, b):
+    if kind in (PUBLIC, DELIVERED):
+        return name_key(a)
+    return conversation_key(a, b)
+
+
+def _write_all(fd, data):
+    with memoryview(data) as view:
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+
+
+def _sync_directory(path):
+    """Makes a created or renamed file in path durable; not possible (nor needed) on Windows."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class IndexView:
+    """One group of a mapped index file as a read-only sequence of entry tuples."""
+
+    def __init__(self, buffer, start, count):
+        self.buffer = buffer
+        self.start = start
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.count
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        return INDEX_ENTRY.unpack_from(self.buffer, self.start + position * INDEX_ENTRY.size)
+
+
+class Segment:
+    """A data file with its entries; sealed segments have them in a mapped index file."""
+
+    def __init__(self, directory, number):
+        self.number = number
+        self.path = os.path.join(directory, f"{number:010d}.log")
+        self.index_path = os.path.join(directory, f"{number:010d}.idx")
+        # Bytes of complete records
+        self.size = 0
+        self.groups = ([], [], [])
+        self._data = None
+        self._view = None
+        self._index = None
+
+    def add(self, entry):
+        entries = self.groups[GROUP_OF_KIND[entry[4]]]
+        if entries and entry[0] < entries[-1][0]:
+            insort(entries, entry)
+        else:
+            entries.append(entry)
+
+    def scan(self):
+        """Indexes the complete records past self.size. Returns (new entries, whether bytes were left over)."""
+        with open(self.path, "rb") as f:
+            f.seek(self.size)
+            data = f.read()
+        added = []
+        position = 0
+        with memoryview(data) as view:
+            while position + RECORD_HEADER.size <= len(data):
+                length, crc = RECORD_HEADER.unpack_from(view, position)
+                start = position + RECORD_HEADER.size
+                end = start + length
+                if length < RECORD_BODY.size or end > len(data) or zlib.crc32(view[start:end]) != crc:
+                    break
+                kind, message_id, timestamp, length_a, length_b, _ = RECORD_BODY.unpack_from(view, start)
+                text = start + RECORD_BODY.size
+                a = bytes(view[text:text + length_a])
+                b = bytes(view[text + length_a:text + length_a + length_b])
+                entry = (message_id, timestamp, self.size + position, entry_key(kind, a, b), kind)
+                self.add(entry)
+                added.append(entry)
+                position = end
+        self.size += position
+        return added, position < len(data)
+
+    def read(self, offset):
+        """Decodes the record at offset: (kind, id, timestamp, a, b, c)."""
+        if self._view is None or len(self._view) < self.size:
+            self._map_data()
+        view = self._view
+        kind, message_id, timestamp, length_a, length_b, length_c = RECORD_BODY.unpack_from(
+            view, offset + RECORD_HEADER.size)
+        start = offset + RECORD_HEADER.size + RECORD_BODY.size
+        a = str(view[start:start + length_a], "utf-8")
+        start += length_a
+        b = str(view[start:start + length_b], "utf-8")
+        start += length_b
+        c = str(view[start:start + length_c], "utf-8")
+        return kind, message_id, EPOCH + timestamp * MICROSECOND, a, b, c
+
+    def _map_data(self):
+        self._unmap_data()
+        with open(self.path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._data)
+
+    def _unmap_data(self):
+        if self._view is not None:
+            self._view.release()
+            self._data.close()
+            self._view = self._data = None
+
+    def write_index(self):
+        header = INDEX_HEADER.pack(INDEX_MAGIC, self.size, *(len(entries) for entries in self.groups))
+        temporary = self.index_path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(header)
+            for entries in self.groups:
+                f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.index_path)
+
+    def load_index(self):
+        """Maps the index file; False when it is missing or does not cover the whole data file."""
+        try:
+            with open(self.index_path, "rb") as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        try:
+            magic, size, *counts = INDEX_HEADER.unpack_from(index)
+        except struct.error:
+            index.close()
+            return False
+        if (magic != INDEX_MAGIC or size != os.path.getsize(self.path)
+                or len(index) != INDEX_HEADER.size + sum(counts) * INDEX_ENTRY.size):
+            index.close()
+            return False
+        self._index = index
+        self.size = size
+        start = INDEX_HEADER.size
+        groups = []
+        for count in counts:
+            groups.append(IndexView(index, start, count))
+            start += count * INDEX_ENTRY.size
+        self.groups = tuple(groups)
+        return True
+
+    def close(self):
+        self._unmap_data()
+        if self._index is not None:
+            self.groups = ([], [], [])
+            self._index.close()
+            self._index = None
+
+
+class LogStorage(Storage):
+    """Segmented append-only log in LOG_DIRECTORY; see the module docstring."""
+
+    def __init__(self, directory=LOG_DIRECTORY):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._segments = []
+        # Append descriptor and the number of the segment it is open on
+        self._fd = None
+        self._fd_number = None
+        # Set in forked processes, which share the log with each other
+        self._shared = False
+        # receiver -> [(entry, segment)] of stored private messages not yet delivered
+        self._pending = {}
+        # receiver -> id of the newest stored message delivered
+        self._delivered = {}
+        with self._lock, self._append_lock(force=True):
+            self._open()
+
+    def _open(self):
+        numbers = sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                         if name.endswith(".log") and name[:-4].isdigit())
+        for number in numbers[:-1]:
+            segment = Segment(self.directory, number)
+            if not segment.load_index():
+                segment.scan()
+                segment.write_index()
+                segment.load_index()
+            self._segments.append(segment)
+        active = Segment(self.directory, numbers[-1] if numbers else 1)
+        if not numbers:
+            open(active.path, "ab").close()
+            _sync_directory(self.directory)
+        _, torn = active.scan()
+        if torn:
+            # The tail of a write cut short by a crash
+            os.truncate(active.path, active.size)
+        self._segments.append(active)
+        for segment in self._segments:
+            for entry in segment.groups[PRIVATE_GROUP]:
+                if entry[4] == STORED:
+                    self._track(segment, entry)
+            for entry in segment.groups[DELIVERY_GROUP]:
+                self._track(segment, entry)
+
+    @contextmanager
+    def _append_lock(self, force=False):
+        """Excludes appends of other processes; only needed once the log is shared."""
+        if fcntl is None or not (self._shared or force):
+            yield
+            return
+        fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _track(self, segment, entry):
+        """Follows stored private messages and their delivery."""
+        kind = entry[4]
+        if kind == STORED:
+            receiver = segment.read(entry[2])[4]
+            if entry[0] > self._delivered.get(receiver, 0):
+                self._pending.setdefault(receiver, []).append((entry, segment))
+        elif kind == DELIVERED:
+            receiver = segment.read(entry[2])[3]
+            if entry[0] > self._delivered.get(receiver, 0):
+                self._delivered[receiver] = entry[0]
+                waiting = [item for item in self._pending.get(receiver, ()) if item[0][0] > entry[0]]
+                if waiting:
+                    self._pending[receiver] = waiting
+                else:
+                    self._pending.pop(receiver, None)
+
+    def _refresh(self):
+        """Picks up records and segments that other processes appended."""
+        if not self._shared:
+            return
+        while True:
+            segment = self._segments[-1]
+            if os.path.getsize(segment.path) > segment.size:
+                for entry in segment.scan()[0]:
+                    if entry[4] in (STORED, DELIVERED):
+                        self._track(segment, entry)
+            following = Segment(self.directory, segment.number + 1)
+            if not os.path.exists(following.path):
+                return
+            # Sealed by another process, which appended everything before creating the next segment
+            for entry in segment.scan()[0]:
+                if entry[4] in (STORED, DELIVERED):
+                    self._track(segment, entry)
+            segment.load_index()
+            self._segments.append(following)
+
+    def _append(self, data, entries):
+        """Appends encoded records; entries carry offsets relative to the start of data."""
+        with self._lock, self._append_lock():
+            self._refresh()
+            active = self._segments[-1]
+            if active.size and active.size + len(data) > SEGMENT_BYTES:
+                active = self._roll()
+            if self._fd_number != active.number:
+                self._close_fd()
+                self._fd = os.open(active.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | O_BINARY, 0o644)
+                self._fd_number = active.number
+            if os.fstat(self._fd).st_size != active.size:
+                # Left behind by a failed or crashed write
+                os.ftruncate(self._fd, active.size)
+            try:
+                _write_all(self._fd, data)
+                if LOG_FSYNC:
+                    os.fsync(self._fd)
+            except OSError:
+                os.ftruncate(self._fd, active.size)
+                raise
+            base = active.size
+            active.size += len(data)
+            for message_id, timestamp, offset, key, kind in entries:
+                entry = (message_id, timestamp, base + offset, key, kind)
+                active.add(entry)
+                if kind in (STORED, DELIVERED):
+                    self._track(active, entry)
+
+    def _roll(self):
+        """Seals the active segment and starts the next one; see the module docstring for the order."""
+        active = self._segments[-1]
+        if self._fd is not None:
+            os.fsync(self._fd)
+        active.write_index()
+        active.load_index()
+        following = Segment(self.directory, active.number + 1)
+        open(following.path, "ab").close()
+        _sync_directory(self.directory)
+        self._segments.append(following)
+        return following
+
+    def _close_fd(self):
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = self._fd_number = None
+
+    def _entries(self, group, after_id=None, before_id=None, reverse=False, key=None):
+        """(segment, entry) of a group with after_id < id < before_id and the given key, in id order."""
+        runs = []  # consecutive segments whose id ranges overlap
+        highest = None
+        for segment in self._segments:
+            entries = segment.groups[group]
+            if not entries:
+                continue
+            low, high = entries[0][0], entries[-1][0]
+            if (after_id is not None and high <= after_id) or (before_id is not None and low >= before_id):
+                continue
+            if runs and low < highest:
+                runs[-1].append(segment)
+            else:
+                runs.append([segment])
+            highest = high if highest is None else max(highest, high)
+        if reverse:
+            runs.reverse()
+        for run in runs:
+            scans = [self._segment_entries(segment, group, after_id, before_id, reverse, key) for segment in run]
+            if len(scans) == 1:
+                yield from scans[0]
+            else:
+                yield from heapq.merge(*scans, key=lambda item: item[1][0], reverse=reverse)
+
+    @staticmethod
+    def _segment_entries(segment, group, after_id, before_id, reverse, key):
+        entries = segment.groups[group]
+        low = bisect_left(entries, (after_id + 1,)) if after_id is not None else 0
+        high = bisect_left(entries, (before_id,)) if before_id is not None else len(entries)
+        positions = range(high - 1, low - 1, -1) if reverse else range(low, high)
+        for position in positions:
+            entry = entries[position]
+            if key is None or entry[3] == key:
+                yield segment, entry
+
+    def _record(self, segment, entry):
+        kind, message_id, timestamp, a, b, c = segment.read(entry[2])
+        if kind == PUBLIC:
+            return PublicRecord(message_id, timestamp, b, c, a)
+        delivered = kind == PRIVATE or message_id <= self._delivered.get(b, 0)
+        return PrivateRecord(message_id, timestamp, a, b, c, delivered)
+
+    def _public(self, room, after_id=None, before_id=None, reverse=False):
+        for segment, entry in self._entries(PUBLIC_GROUP, after_id, before_id, reverse, name_key(room.encode())):
+            record = self._record(segment, entry)
+            if record.room == room:
+                yield record
+
+    def max_ids(self):
+        with self._lock:
+            self._refresh()
+            return tuple(max((segment.groups[group][-1][0] for segment in self._segments if segment.groups[group]),
+                             default=0)
+                         for group in (PUBLIC_GROUP, PRIVATE_GROUP))
+
+    def write(self, public_records, private_records):
+        chunks = []
+        entries = []
+        size = 0
+        for record in sorted(public_records, key=lambda record: record.id):
+            room, username, message = record.room.encode(), record.username.encode(), record.message.encode()
+            data = encode_record(PUBLIC, record.id, record.timestamp, room, username, message)
+            entries.append((record.id, (record.timestamp - EPOCH) // MICROSECOND, size, name_key(room), PUBLIC))
+            chunks.append(data)
+            size += len(data)
+        for record in sorted(private_records, key=lambda record: record.id):
+            kind = PRIVATE if record.delivered else STORED
+            sender, receiver, message = record.sender.encode(), record.receiver.encode(), record.message.encode()
+            data = encode_record(kind, record.id, record.timestamp, sender, receiver, message)
+            entries.append((record.id, (record.timestamp - EPOCH) // MICROSECOND, size,
+                            conversation_key(sender, receiver), kind))
+            chunks.append(data)
+            size += len(data)
+        if chunks:
+            self._append(b"".join(chunks), entries)
+
+    def replay_start(self, last_id=None, window=HISTORY_WINDOW, room=DEFAULT_ROOM):
+        with self._lock:
+            self._refresh()
+            newest = list(islice(self._public(room, reverse=True), window + 1))
+            window_bound = newest[window].id if len(newest) > window else None
+            if last_id and (window_bound is None or last_id >= window_bound):
+                for record in self._public(room, after_id=last_id - 1):
+                    if record.id == last_id:
+                        return last_id, False
+                    break
+            return window_bound, True
+
+    def fetch_page(self, after_id=None, limit=HISTORY_CHUNK, room=DEFAULT_ROOM, archived=False):
+        with self._lock:
+            self._refresh()
+            return list(islice(self._public(room, after_id=after_id), limit))
+
+    def fetch_page_before(self, before_id, limit=HISTORY_PAGE_SIZE, room=DEFAULT_ROOM):
+        with self._lock:
+            self._refresh()
+            rows = list(islice(self._public(room, before_id=before_id, reverse=True), limit))
+        rows.reverse()
+        return rows
+
+    def recent(self, room, limit):
+        with self._lock:
+            self._refresh()
+            rows = list(islice(self._public(room, reverse=True), limit))
+        rows.reverse()
+        return rows
+
+    def conversation(self, user, other, before_id=None, limit=PM_HISTORY_PAGE):
+        pair = {(user, other), (other, user)}
+        rows = []
+        with self._lock:
+            self._refresh()
+            key = conversation_key(user.encode(), other.encode())
+            for segment, entry in self._entries(PRIVATE_GROUP, before_id=before_id, reverse=True, key=key):
+                record = self._record(segment, entry)
+                if (record.sender, record.receiver) in pair:
+                    rows.append(record)
+                    if len(rows) == limit:
+                        break
+        return rows
+
+    def undelivered(self, receiver):
+        with self._lock:
+            self._refresh()
+            waiting = sorted(self._pending.get(receiver, ()), key=lambda item: item[0][0])
+            return [self._record(segment, entry) for entry, segment in waiting]
+
+    def mark_delivered(self, receiver, up_to_id):
+        receiver = receiver.encode()
+        data = encode_record(DELIVERED, up_to_id, datetime.utcnow(), receiver)
+        self._append(data, [(up_to_id, 0, 0, name_key(receiver), DELIVERED)])
+
+    def search(self, terms, page=1, page_size=SEARCH_PAGE_SIZE, room=DEFAULT_ROOM):
+        # Every word of a term must appear as a word of the username or message, the last one as a prefix for "abc*"
+        wanted = []
+        for word, prefix in search_terms(terms):
+            words = re.findall(r"\w+", word.lower())
+            wanted.extend((part, prefix and i == len(words) - 1) for i, part in enumerate(words))
+        if not wanted:
+            return [], False
+        skip = (page - 1) * page_size
+        rows = []
+        with self._lock:
+            self._refresh()
+            for record in islice(self._public(room, reverse=True), LOG_SEARCH_SCAN):
+                words = set(re.findall(r"\w+", f"{record.username} {record.message}".lower()))
+                if all(any(w.startswith(part) for w in words) if prefix else part in words
+                       for part, prefix in wanted):
+                    if skip:
+                        skip -= 1
+                        continue
+                    rows.append(record)
+                    if len(rows) > page_size:
+                        break
+        return rows[:page_size], len(rows) > page_size
+
+    def after_fork(self):
+        self._shared = True
+
+    def close(self):
+        with self._lock:
+            self._close_fd()
+            for segment in self._segments:
+                segment.close()
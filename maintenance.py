@@ -0,0 +1,161 @@
+"""
+Maintenance of the message database (SQL backend), run next to the server:
+
+    python maintenance.py archive --days 90
+    python maintenance.py export --since 2026-01-01 --until 2026-02-01 --format csv --output january.csv
+
+archive moves public and private messages older than the retention window into
+the archive (archive.py), ARCHIVE_BATCH rows per step in id order. Each step
+reads its rows, appends them to the archive and deletes them in a short
+transaction of its own, so the server's writer waits for one small delete at
+most. An interrupted run is picked up by the next one. Private messages stored
+for a user who did not come back within the window are archived undelivered.
+
+export streams the messages of a time range, archived ones first, as JSONL
+(the archive's row format) or CSV. Database rows are read with yield_per on a
+streaming cursor, so memory does not grow with the range.
+"""
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from archive import Archive, PUBLIC_TABLE, PRIVATE_TABLE, RECORDS, encode_row
+from database import Session, engine
+from migrations import migrate
+from models import ChatMessage, PrivateMessage
+
+logger = logging.getLogger(__name__)
+
+RETENTION_DAYS = 90
+
+# Rows moved per step, and the pause between steps that lets the server's writer in
+ARCHIVE_BATCH = 5000
+ARCHIVE_PAUSE = 0.05
+
+# Rows fetched per round trip while exporting
+EXPORT_BATCH = 1000
+
+MODELS = {PUBLIC_TABLE: ChatMessage, PRIVATE_TABLE: PrivateMessage}
+
+
+def _columns(table):
+    model = MODELS[table]
+    return [getattr(model, field) for field in RECORDS[table]._fields]
+
+
+def archive_table(archive, table, cutoff, batch=ARCHIVE_BATCH, pause=ARCHIVE_PAUSE):
+    """Moves the table's rows with timestamps before cutoff into the archive; returns how many."""
+    model = MODELS[table]
+    record = RECORDS[table]
+    archive.refresh()
+    moved = 0
+    # Rows archived by an interrupted run but still in the table
+    through = archive.archived_through(table)
+    with engine.begin() as connection:
+        connection.execute(delete(model).where(model.id <= through))
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(
+                select(*_columns(table)).where(model.id > through).order_by(model.id).limit(batch)).all()
+        # Only the oldest rows in id order, so the archive stays exactly the rows up to archived_through
+        rows = [record(*row) for row in rows]
+        old = next((i for i, row in enumerate(rows) if row.timestamp >= cutoff), len(rows))
+        if not old:
+            return moved
+        rows = rows[:old]
+        archive.append(table, rows)
+        through = rows[-1].id
+        with engine.begin() as connection:
+            connection.execute(delete(model).where(model.id <= through))
+        moved += len(rows)
+        logger.info("Archived %d %s rows up to id %d.", moved, table, through)
+        if old < batch:
+            return moved
+        time.sleep(pause)
+
+
+def export_rows(table, since=None, until=None, archive=None):
+    """Yields the table's rows with since <= timestamp < until: the archived ones, then the stored ones."""
+    archive = archive or Archive()
+    archive.refresh()
+    # Rows an interrupted archive run left in the table are exported from the archive only
+    through = archive.archived_through(table)
+    yield from archive.rows(table, since, until)
+    model = MODELS[table]
+    record = RECORDS[table]
+    session_db = Session()
+    try:
+        query = session_db.query(*_columns(table)).filter(model.id > through)
+        if since is not None:
+            query = query.filter(model.timestamp >= since)
+        if until is not None:
+            query = query.filter(model.timestamp < until)
+        for row in query.order_by(model.id).yield_per(EXPORT_BATCH):
+            yield record(*row)
+    finally:
+        session_db.close()
+
+
+def write_export(rows, out, fmt, fields):
+    count = 0
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(encode_row(row))
+            count += 1
+    else:
+        for row in rows:
+            out.write(json.dumps(encode_row(row), ensure_ascii=False, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+
+def _timestamp(text):
+    return datetime.fromisoformat(text)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s",
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description="Archive and export chat messages.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    archive_parser = commands.add_parser("archive", help="move messages past the retention window to the archive")
+    archive_parser.add_argument("--days", type=float, default=RETENTION_DAYS, help="retention window in days")
+    archive_parser.add_argument("--batch", type=int, default=ARCHIVE_BATCH, help="rows moved per step")
+    export_parser = commands.add_parser("export", help="stream messages of a time range, archived ones included")
+    export_parser.add_argument("--table", choices=("public", "private"), default="public")
+    export_parser.add_argument("--since", type=_timestamp, help="UTC, ISO format; from the oldest message by default")
+    export_parser.add_argument("--until", type=_timestamp, help="UTC, ISO format, exclusive; up to now by default")
+    export_parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    export_parser.add_argument("--output", help="file to write; standard output by default")
+    args = parser.parse_args()
+
+    migrate()
+    archive = Archive()
+    if args.command == "archive":
+        cutoff = datetime.utcnow() - timedelta(days=args.days)
+        for table in (PUBLIC_TABLE, PRIVATE_TABLE):
+            moved = archive_table(archive, table, cutoff, args.batch)
+            logger.info("%s: %d rows older than %s archived.", table, moved, cutoff.isoformat(" ", "seconds"))
+        return
+
+    table = PUBLIC_TABLE if args.table == "public" else PRIVATE_TABLE
+    rows = export_rows(table, args.since, args.until, archive)
+    fields = RECORDS[table]._fields
+    if args.output:
+        with open(args.output, "w", encoding="utf-8", newline="") as out:
+            count = write_export(rows, out, args.format, fields)
+    else:
+        count = write_export(rows, sys.stdout, args.format, fields)
+    logger.info("Exported %d %s rows.", count, table)
+
+
+if __name__ == "__main__":
+    main()
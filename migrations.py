@@ -0,0 +1,97 @@
+"""
+In-place schema upgrades for existing databases.
+
+The schema version is kept in SQLite's PRAGMA user_version. Missing tables are
+created from the models, then every step in MIGRATIONS past the stored version
+is applied in order, each in its own transaction together with the version bump.
+A new database runs all steps right after create_all, so steps must tolerate
+objects the models already created.
+
+To change the schema, update the models and append a step here; steps must
+never be edited or reordered once released.
+"""
+import logging
+
+from sqlalchemy import inspect
+
+import models
+from database import engine, Base
+from protocol import DEFAULT_ROOM
+from search import create_search_index
+
+logger = logging.getLogger(__name__)
+
+
+def _create_index(connection, model, name):
+    for index in model.__table__.indexes:
+        if index.name == name:
+            index.create(bind=connection, checkfirst=True)
+
+
+def _create_indexes(connection):
+    """Indexes used by history replay and private message lookups."""
+    # Only the indexes of version 1: later ones need columns added by later steps
+    _create_index(connection, models.ChatMessage, 'ix_chat_messages_timestamp_id')
+    _create_index(connection, models.PrivateMessage, 'ix_private_messages_sender_timestamp')
+    _create_index(connection, models.PrivateMessage, 'ix_private_messages_receiver_timestamp')
+
+
+def _create_conversation_index(connection):
+    """Index for private message history."""
+    _create_index(connection, models.PrivateMessage, 'ix_private_messages_conversation')
+
+
+def _add_delivered_flag(connection):
+    """Delivered flag for store-and-forward private messages."""
+    columns = {column["name"] for column in inspect(connection).get_columns("private_messages")}
+    if "delivered" not in columns:
+        # Messages stored before this version were all sent to an online user
+        connection.exec_driver_sql("ALTER TABLE private_messages ADD COLUMN delivered BOOLEAN NOT NULL DEFAULT 1")
+    _create_index(connection, models.PrivateMessage, 'ix_private_messages_undelivered')
+
+
+def _add_room_column(connection):
+    """Room column and room-scoped history index on public messages."""
+    columns = {column["name"] for column in inspect(connection).get_columns("chat_messages")}
+    if "room" not in columns:
+        # Everything said before rooms existed belongs to the default room
+        connection.exec_driver_sql(
+            f"ALTER TABLE chat_messages ADD COLUMN room VARCHAR(50) NOT NULL DEFAULT '{DEFAULT_ROOM}'")
+    _create_index(connection, models.ChatMessage, 'ix_chat_messages_room_timestamp_id')
+
+
+# Step N upgrades a database from version N-1 to N
+MIGRATIONS = [
+    _create_indexes,
+    create_search_index,
+    _create_conversation_index,
+    _add_delivered_flag,
+    _add_room_column,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(connection):
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def _set_schema_version(connection, version):
+    connection.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def migrate(bind=engine):
+    """Creates missing tables and brings an existing database up to SCHEMA_VERSION."""
+    with bind.begin() as connection:
+        Base.metadata.create_all(connection)
+        version = schema_version(connection)
+    if version > SCHEMA_VERSION:
+        logger.warning("Database schema version %d is newer than this server (%d).", version, SCHEMA_VERSION)
+        return
+
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        step = MIGRATIONS[number - 1]
+        logger.info("Migrating database to version %d: %s", number, step.__doc__ or step.__name__)
+        with bind.begin() as connection:
+            step(connection)
+            _set_schema_version(connection, number)
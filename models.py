@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, DateTime, func
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Index, func, true, false
 from database import Base
+from protocol import DEFAULT_ROOM
 
 
 class ChatMessage(Base):
@@ -9,6 +10,13 @@ class ChatMessage(Base):
     username = Column(String(50))
     message = Column(String(500))
     timestamp = Column(DateTime, default=func.now())
+    room = Column(String(50), nullable=False, default=DEFAULT_ROOM, server_default=DEFAULT_ROOM)
+
+    # Keyset pagination for history replay
+    __table_args__ = (
+        Index('ix_chat_messages_timestamp_id', 'timestamp', 'id'),
+        Index('ix_chat_messages_room_timestamp_id', 'room', 'timestamp', 'id'),
+    )
 
     def __repr__(self):
         return f"<ChatMessage(username='{self.username}', message='{self.message}', timestamp='{self.timestamp}')>"
@@ -22,6 +30,18 @@ class PrivateMessage(Base):
     receiver = Column(String(50))
     message = Column(String(500))
     timestamp = Column(DateTime, default=func.now())
+    # False while the receiver has not been online since the message was sent
+    delivered = Column(Boolean, nullable=False, default=True, server_default=true())
+
+    # Conversation lookups by either side, newest first
+    __table_args__ = (
+        Index('ix_private_messages_sender_timestamp', 'sender', 'timestamp'),
+        Index('ix_private_messages_receiver_timestamp', 'receiver', 'timestamp'),
+        # Keyset pagination of one conversation
+        Index('ix_private_messages_conversation', 'sender', 'receiver', 'id'),
+        # Only the messages still waiting for delivery
+        Index('ix_private_messages_undelivered', 'receiver', 'id', sqlite_where=delivered == false()),
+    )
 
     def __repr__(self):
         return f"<PrivateMessage(sender='{self.sender}', receiver='{self.receiver}', message='{self.message}', timestamp='{self.timestamp}')>"
@@ -0,0 +1,201 @@
+"""
+Write-behind persistence for chat messages.
+
+Messages are given their id and timestamp in memory, handed to the broadcast
+right away and queued for a single writer thread that hands them to the
+storage backend (storage.py) in batches, one write per batch. A batch is written once it holds WRITE_BATCH_SIZE
+messages or WRITE_FLUSH_INTERVAL seconds after its first message, whichever
+comes first.
+
+Readers that must see every message sent so far (history, stored private
+messages) call flush() first, which waits for the records queued before it.
+
+Durability: a message is acknowledged (broadcast) before it is committed.
+A clean shutdown flushes the queue, but a crash loses whatever is still queued,
+at most WRITE_FLUSH_INTERVAL seconds of traffic at normal load. When the queue
+is full, senders block until the writer catches up.
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from metrics import Histogram
+from protocol import DEFAULT_ROOM
+
+logger = logging.getLogger(__name__)
+
+# Messages waiting for the writer before senders are made to wait
+WRITE_QUEUE_SIZE = 10000
+WRITE_BATCH_SIZE = 500
+WRITE_FLUSH_INTERVAL = 0.05
+
+# Attempts for a failing batch before it is written row by row
+WRITE_RETRIES = 3
+
+COMMIT_SECONDS = Histogram("chat_db_commit_seconds", "Time to store one batch of messages.")
+BATCH_MESSAGES = Histogram("chat_db_batch_messages", "Messages written per batch.",
+                           buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+PublicRecord = namedtuple("PublicRecord", "id timestamp username message room", defaults=(DEFAULT_ROOM,))
+PrivateRecord = namedtuple("PrivateRecord", "id timestamp sender receiver message delivered", defaults=(True,))
+
+_STOP = object()
+
+
+class IdAllocator:
+    """Hands out increasing primary keys, continuing from the largest id already stored."""
+
+    def __init__(self):
+        self._next = None
+        self._lock = threading.Lock()
+
+    def load(self, max_id):
+        with self._lock:
+            self._next = max_id + 1
+
+    def allocate(self):
+        with self._lock:
+            message_id = self._next
+            self._next += 1
+            return message_id
+
+
+class MessageWriter:
+    """Bounded queue of records drained by one writer thread in group commits."""
+
+    def __init__(self, storage, queue_size=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE,
+                 flush_interval=WRITE_FLUSH_INTERVAL):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.public_ids = IdAllocator()
+        self.private_ids = IdAllocator()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        # Records queued and records handled (written or dropped), for flush()
+        self._submitted = 0
+        self._handled = 0
+        self._progress = threading.Condition()
+
+        # Counters
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        public_max, private_max = self.storage.max_ids()
+        self.public_ids.load(public_max)
+        self.private_ids.load(private_max)
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def new_public(self, username, message_text, room=DEFAULT_ROOM):
+        """Returns a record for a public message with its id and timestamp assigned."""
+        return PublicRecord(self.public_ids.allocate(), datetime.utcnow(), username, message_text, room)
+
+    def new_private(self, sender, receiver, message_text, delivered=True):
+        """delivered=False stores the message for a receiver who is offline."""
+        return PrivateRecord(self.private_ids.allocate(), datetime.utcnow(), sender, receiver, message_text, delivered)
+
+    def submit(self, record, block=True):
+        """
+        Queues a record for writing.
+        With block=False returns False instead of waiting when the queue is full.
+        """
+        try:
+            self._queue.put(record, block)
+        except queue.Full:
+            return False
+        with self._progress:
+            self._submitted += 1
+        return True
+
+    async def submit_async(self, record):
+        """
+        submit() for code on an event loop: when the queue is full the wait happens
+        in a worker thread, so only the caller is held back and the loop keeps running.
+        """
+        if not self.submit(record, block=False):
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.submit, record)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """Blocks until every record queued so far is committed; records queued meanwhile are not waited for."""
+        with self._progress:
+            target = self._submitted
+            while self._handled < target and self._thread is not None:
+                self._progress.wait()
+
+    def stop(self):
+        """Writes out everything still queued and stops the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        with self._progress:
+            self._thread = None
+            self._progress.notify_all()
+        logger.info("Message writer stopped: %d written, %d failed in %d batches.",
+                    self.written, self.failed, self.batches)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self._write(batch)
+            finally:
+                with self._progress:
+                    self._handled += len(batch)
+                    self._progress.notify_all()
+            if stopping:
+                return
+
+    def _write(self, batch):
+        public_records = [record for record in batch if type(record) is PublicRecord]
+        private_records = [record for record in batch if type(record) is PrivateRecord]
+        for attempt in range(1, WRITE_RETRIES + 1):
+            try:
+                started = time.perf_counter()
+                self.storage.write(public_records, private_records)
+                COMMIT_SECONDS.observe(time.perf_counter() - started)
+                BATCH_MESSAGES.observe(len(batch))
+                self.written += len(batch)
+                self.batches += 1
+                return
+            except Exception as e:
+                logger.warning("Writing batch of %d messages failed (attempt %d): %s", len(batch), attempt, e)
+                time.sleep(0.1 * attempt)
+
+        # Isolate the records that cannot be written so the rest of the batch is kept
+        for record in batch:
+            public = type(record) is PublicRecord
+            try:
+                self.storage.write([record] if public else [], [] if public else [record])
+                self.written += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error("Dropping %s message %s: %s", "public" if public else "private", record.id, e)
@@ -0,0 +1,223 @@
+"""
+Wire protocol shared by the server engines and the client.
+
+Every message is one UTF-8 line terminated by "\\n". Frames are decoded
+incrementally from a bytearray, so a peer can pipeline many messages in one
+send and a message split over several recv() calls is reassembled intact.
+
+Clients written before framing was introduced send the handshake and each
+message without a terminator. The server detects them by the missing "\\n" in
+the first chunk and keeps treating every recv() chunk as one message.
+"""
+import zlib
+
+FRAME_DELIMITER = b"\n"
+
+# Upper bound for a single frame; protects the decoder from unbounded growth
+MAX_FRAME_BYTES = 64 * 1024
+
+# Read size used by both ends; large enough to take many pipelined frames at once
+RECV_SIZE = 64 * 1024
+
+HISTORY_END = "HISTORY_END"
+ONLINE_USERS = "ONLINE_USERS"
+
+# Clients that send the id of the last message they saw in the handshake
+# (<username>|<offset>|<last id>, 0 on a cold join) receive public messages as
+# MSG|<id>|<line>, and HISTORY_RESET before a replay that does not continue from that id.
+MSG = "MSG"
+HISTORY_RESET = "HISTORY_RESET"
+
+# Optional fourth handshake field: comma-separated capabilities.
+# "presence": the client gets one ONLINE_USERS snapshot on join and then
+# USER_JOINED|<nick>|... / USER_LEFT|<nick>|... deltas instead of full rosters.
+PRESENCE = "presence"
+USER_JOINED = "USER_JOINED"
+USER_LEFT = "USER_LEFT"
+
+# Rooms. Every client starts in DEFAULT_ROOM, or in the room named by the optional
+# fifth handshake field. Clients with the "rooms" capability get ROOM|<name> after
+# /join or /leave, followed by that room's history up to HISTORY_END.
+ROOMS = "rooms"
+ROOM = "ROOM"
+DEFAULT_ROOM = "general"
+
+# Paged history. "/history before|after <id> [<count>]" returns the room's public
+# messages next to that id, oldest first, as MSG lines between HISTORY_PAGE|<before|after>|<id>
+# and HISTORY_PAGE_END|<1 if there are more in that direction, else 0>; "after 0" starts
+# at the oldest message. The page is sent as one buffer, so live messages never interleave.
+HISTORY_PAGE = "HISTORY_PAGE"
+HISTORY_PAGE_END = "HISTORY_PAGE_END"
+
+# Compression. A client with the "deflate" capability may get the plain line
+# COMPRESSED|deflate as the very first thing the server sends; everything after
+# it is one raw deflate stream (RFC 1951) primed with DEFLATE_DICTIONARY, flushed
+# with Z_SYNC_FLUSH after every write, so each write decompresses completely on
+# arrival. Servers that do not compress never send the line. The client's own
+# messages stay uncompressed.
+DEFLATE = "deflate"
+COMPRESSED = "COMPRESSED"
+COMPRESSED_LINE = f"{COMPRESSED}|{DEFLATE}".encode('ascii')
+
+# A small window keeps the compressor of each connection at about 64 KiB;
+# chat lines rarely repeat anything further back than that
+DEFLATE_LEVEL = 6
+DEFLATE_WBITS = 13
+DEFLATE_MEMLEVEL = 6
+
+# Strings common in server output, the most frequent last. Part of the wire format:
+# never change it, add a new capability with a new dictionary instead.
+DEFLATE_DICTIONARY = (
+    b"HISTORY_PAGE|before|HISTORY_PAGE|after|HISTORY_PAGE_END|0\nHISTORY_PAGE_END|1\n"
+    b"HISTORY_RESET\nHISTORY_END\nROOM|general\nONLINE_USERS|USER_LEFT|USER_JOINED|"
+    b"Older messages: /pmhistory Private messages with  (newest first):\n"
+    b" left the chat\n joined the chat\n] System: ==> \"] (Private)  -> "
+    b"\nMSG|1\n[2026-01-01 12:00] \nMSG|"
+)
+
+
+class FrameTooLarge(ValueError):
+    """Raised when a peer sends a frame longer than MAX_FRAME_BYTES."""
+
+
+def encode_line(text):
+    """Encodes one message as a frame; embedded line breaks would split it, so they are flattened."""
+    if "\n" in text or "\r" in text:
+        text = text.replace("\r", " ").replace("\n", " ")
+    return text.encode('utf-8') + FRAME_DELIMITER
+
+
+def encode_lines(lines):
+    """Encodes several messages into one buffer so they go out in a single send."""
+    return b"".join(encode_line(line) for line in lines)
+
+
+class LineDecoder:
+    """
+    Incremental decoder for newline-delimited frames.
+    feed() returns the complete frames found so far and keeps the partial tail buffered;
+    the delimiter search resumes where the previous one stopped, so each byte is scanned once.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME_BYTES):
+        self.max_frame = max_frame
+        self._buffer = bytearray()
+        self._scan_from = 0
+
+    def feed(self, data):
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        start = 0
+        pos = buffer.find(FRAME_DELIMITER, self._scan_from)
+        if pos != -1:
+            view = memoryview(buffer)
+            try:
+                while pos != -1:
+                    end = pos - 1 if pos > start and buffer[pos - 1] == 0x0D else pos
+                    frames.append(bytes(view[start:end]))
+                    start = pos + 1
+                    pos = buffer.find(FRAME_DELIMITER, start)
+            finally:
+                view.release()
+            del buffer[:start]
+        self._scan_from = len(buffer)
+        if self._scan_from > self.max_frame:
+            raise FrameTooLarge(f"frame exceeds {self.max_frame} bytes")
+        return frames
+
+    def feed_text(self, data):
+        return [frame.decode('utf-8', errors='replace') for frame in self.feed(data)]
+
+    def pending(self):
+        """Number of buffered bytes that do not form a complete frame yet."""
+        return len(self._buffer)
+
+
+class LegacyDecoder:
+    """Treats every chunk as exactly one message, as pre-framing clients expect."""
+
+    def feed(self, data):
+        return [data] if data else []
+
+    def feed_text(self, data):
+        return [frame.decode('utf-8', errors='replace') for frame in self.feed(data)]
+
+    def pending(self):
+        return 0
+
+
+class DeflateEncoder:
+    """Compresses what the server writes to one connection; the first output is preceded by COMPRESSED_LINE."""
+
+    def __init__(self, level=DEFLATE_LEVEL):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -DEFLATE_WBITS, DEFLATE_MEMLEVEL,
+                                            zdict=DEFLATE_DICTIONARY)
+        self._header = COMPRESSED_LINE + FRAME_DELIMITER
+
+    def encode(self, data):
+        data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if self._header:
+            data = self._header + data
+            self._header = None
+        return data
+
+
+class InflatingDecoder:
+    """
+    LineDecoder for a client that asked for DEFLATE: when the server's first line is
+    COMPRESSED_LINE, everything after it is inflated before it is split into frames.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME_BYTES):
+        self.max_frame = max_frame
+        self._lines = LineDecoder(max_frame)
+        self._inflater = None
+        # Bytes received before the first line was complete; None once it was
+        self._head = bytearray()
+
+    def feed(self, data):
+        if self._inflater is not None:
+            return self._lines.feed(self._inflater.decompress(data))
+        if self._head is None:
+            return self._lines.feed(data)
+        self._head += data
+        end = self._head.find(FRAME_DELIMITER)
+        if end == -1:
+            if len(self._head) > self.max_frame:
+                raise FrameTooLarge(f"frame exceeds {self.max_frame} bytes")
+            return []
+        head, self._head = bytes(self._head), None
+        if head[:end] == COMPRESSED_LINE:
+            self._inflater = zlib.decompressobj(-zlib.MAX_WBITS, zdict=DEFLATE_DICTIONARY)
+            return self._lines.feed(self._inflater.decompress(head[end + 1:]))
+        return self._lines.feed(head)
+
+    def feed_text(self, data):
+        return [frame.decode('utf-8', errors='replace') for frame in self.feed(data)]
+
+    def pending(self):
+        return len(self._head) if self._head is not None else self._lines.pending()
+
+    @property
+    def compressed(self):
+        return self._inflater is not None
+
+
+def split_tagged(line):
+    """Splits a MSG|<id>|<line> frame into (id, line); untagged lines give (None, line)."""
+    if line.startswith(MSG + "|"):
+        parts = line.split("|", 2)
+        if len(parts) == 3:
+            try:
+                return int(parts[1]), parts[2]
+            except ValueError:
+                pass
+    return None, line
+
+
+def decoder_for_first_chunk(data):
+    """Picks the decoder for a new connection from the first chunk it sent."""
+    if FRAME_DELIMITER in data:
+        return LineDecoder()
+    return LegacyDecoder()
@@ -0,0 +1,112 @@
+"""
+Full-text search over public chat history.
+
+chat_messages_fts is an FTS5 index over chat_messages (external content, keyed
+by the message id). Triggers keep it in step with every insert, update and
+delete, so it needs no work from the writers; the migration that creates it
+backfills the rows already stored.
+
+A search covers the caller's room. Results are ordered by bm25 rank and returned SEARCH_PAGE_SIZE at a time.
+Scoring every match of a common word would take seconds on a large history,
+so only the SEARCH_RANK_WINDOW most recent matches are ranked; FTS5 finds
+those by walking the doclist backwards by rowid without scoring the rest.
+Prefix indexes keep short "abc*" queries from merging thousands of terms.
+"""
+from sqlalchemy import text
+
+from models import ChatMessage
+from protocol import DEFAULT_ROOM
+
+SEARCH_PAGE_SIZE = 20
+
+# Deep pages get slower and are rarely useful; refine the terms instead
+SEARCH_MAX_PAGE = 50
+
+# Most recent matches considered for ranking
+SEARCH_RANK_WINDOW = 10000
+
+SEARCH_USAGE = "Usage: /search [-p <page>] <terms>"
+
+FTS_TABLE = "chat_messages_fts"
+
+CREATE_STATEMENTS = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "username, message, content='chat_messages', content_rowid='id', prefix='2 3')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON chat_messages BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, username, message) VALUES (new.id, new.username, new.message); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON chat_messages BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, username, message) "
+    "VALUES ('delete', old.id, old.username, old.message); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE ON chat_messages BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, username, message) "
+    "VALUES ('delete', old.id, old.username, old.message); "
+    f"INSERT INTO {FTS_TABLE}(rowid, username, message) VALUES (new.id, new.username, new.message); END",
+)
+
+_SEARCH_QUERY = text(
+    f"SELECT chat_messages.id, chat_messages.timestamp, chat_messages.username, chat_messages.message "
+    f"FROM {FTS_TABLE} JOIN chat_messages ON chat_messages.id = {FTS_TABLE}.rowid "
+    f"WHERE {FTS_TABLE} MATCH :query AND chat_messages.room = :room AND {FTS_TABLE}.rowid >= ("
+    f"SELECT coalesce(min(rowid), 0) FROM (SELECT {FTS_TABLE}.rowid FROM {FTS_TABLE} "
+    f"JOIN chat_messages ON chat_messages.id = {FTS_TABLE}.rowid "
+    f"WHERE {FTS_TABLE} MATCH :query AND chat_messages.room = :room "
+    f"ORDER BY {FTS_TABLE}.rowid DESC LIMIT :window)) "
+    f"ORDER BY {FTS_TABLE}.rank LIMIT :limit OFFSET :offset"
+).columns(ChatMessage.id, ChatMessage.timestamp, ChatMessage.username, ChatMessage.message)
+
+
+def create_search_index(connection):
+    """Creates the FTS5 index and its triggers, and indexes the existing messages."""
+    for statement in CREATE_STATEMENTS:
+        connection.exec_driver_sql(statement)
+    connection.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def parse_search(message_text):
+    """
+    Splits "/search [-p <page>] <terms>" into (terms, page).
+    Returns None when the command is malformed.
+    """
+    parts = message_text.split()[1:]
+    page = 1
+    if len(parts) >= 2 and parts[0] == "-p":
+        try:
+            page = int(parts[1])
+        except ValueError:
+            return None
+        parts = parts[2:]
+    if not parts or not 1 <= page <= SEARCH_MAX_PAGE:
+        return None
+    return " ".join(parts), page
+
+
+def search_terms(terms):
+    """Splits user input into (word, prefix) pairs: every word must appear, a trailing * makes it a prefix."""
+    pairs = []
+    for word in terms.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            pairs.append((word, prefix))
+    return pairs
+
+
+def match_expression(terms):
+    """
+    Turns user input into an FTS5 query (see search_terms). Words are quoted,
+    so FTS5 operators are matched literally.
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' + ("*" if prefix else "")
+                    for word, prefix in search_terms(terms))
+
+
+def search_messages(session_db, terms, page=1, page_size=SEARCH_PAGE_SIZE, room=DEFAULT_ROOM):
+    """Returns (rows, more) for one page of the room's recent public messages matching terms, best match first."""
+    query = match_expression(terms)
+    if not query:
+        return [], False
+    rows = session_db.execute(
+        _SEARCH_QUERY,
+        {"query": query, "room": room, "window": SEARCH_RANK_WINDOW, "limit": page_size + 1, "offset": (page - 1) * page_size},
+    ).all()
+    return rows[:page_size], len(rows) > page_size
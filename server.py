@@ -1,8 +1,18 @@
+import atexit
 import colorlog
+import functools
 import logging
+import logging.handlers
+import os
+import queue
+import re
+import signal
 import socket
 import threading
+import time
+from collections import Counter, namedtuple
 from datetime import datetime, timedelta, timezone
+from itertools import islice
 
 # Configure colorlog for colored log output
 handler = colorlog.StreamHandler()
@@ -17,265 +27,1133 @@ handler.setFormatter(colorlog.ColoredFormatter(
         'CRITICAL': 'red',
     }
 ))
+# Client threads and the event loop only queue log records; a listener thread
+# writes them out, so a slow terminal never holds up the chat. The queue handler
+# sits on the root logger so the other server modules share it.
+queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+logging.getLogger().addHandler(queue_handler)
+logging.getLogger().setLevel(logging.INFO)
+
+# DEBUG traces every message and roster update; keep INFO outside of debugging
+LOG_LEVEL = logging.INFO
+
 logger = colorlog.getLogger(__name__)
-logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
+
+log_listener = None
+
+
+def _start_log_listener():
+    global log_listener
+    log_listener = logging.handlers.QueueListener(queue_handler.queue, handler)
+    log_listener.start()
+
+
+def _restart_log_listener():
+    # The listener thread does not survive fork; records queued before it stay with the parent
+    queue_handler.queue = queue.SimpleQueue()
+    _start_log_listener()
+
+
+def stop_log_listener():
+    """Writes out the queued records and stops the listener thread."""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
 
-from database import Session, engine, Base
-from models import ChatMessage, PrivateMessage
 
-Base.metadata.create_all(engine)
+_start_log_listener()
+atexit.register(stop_log_listener)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_log_listener)
+
+from connections import ClientConnection, OutboundQueue, DROP_OLDEST, outbound_counters
+from flood import FloodControl
+from metrics import Counter as MetricCounter, Gauge, Histogram, start_metrics_server
+from history import RoomHistory, PM_HISTORY_PAGE, HISTORY_CHUNK, HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX, HISTORY_WINDOW
+from persistence import MessageWriter
+from search import SEARCH_PAGE_SIZE, SEARCH_USAGE, parse_search
+from storage import open_storage
+from protocol import (
+    RECV_SIZE, HISTORY_END, HISTORY_RESET, ONLINE_USERS, USER_JOINED, USER_LEFT, PRESENCE, MSG, FrameTooLarge,
+    ROOM, ROOMS, DEFAULT_ROOM, HISTORY_PAGE, HISTORY_PAGE_END, DEFLATE, encode_line, encode_lines,
+    decoder_for_first_chunk,
+)
+
+# Message storage; the backend is chosen by storage.STORAGE_BACKEND
+storage = open_storage()
 
 HOST = '127.0.0.1'
 PORT = 9090
 
+# Port of the Prometheus metrics endpoint on localhost; None disables it
+METRICS_PORT = None
+
+# Admission control for reconnect storms: after a restart every client comes back at once.
+# Connections the kernel queues for us before accept(); a short queue drops handshakes
+ACCEPT_BACKLOG = 1024
+# Connections that may be in their handshake at once; further ones wait in the backlog
+MAX_HANDSHAKES = 64
+# Seconds a new connection has to send its handshake
+HANDSHAKE_TIMEOUT = 10
+# Joins replaying history and stored private messages at once; the others queue for a slot.
+# Below the database pool size, so commands and the message writer still get connections
+JOIN_CONCURRENCY = 4
+
+# Compress everything sent to clients with the deflate capability (protocol.DEFLATE).
+# Costs one compressor (about 64 KiB) per such client and CPU for every fanout
+COMPRESSION = True
+
+# Flood control: token buckets on public and private messages, as messages per second and
+# the burst allowed on top. A client over its limit is not disconnected; the server stops
+# reading from it until its messages fit again. None disables a limit.
+# Per user, so one client pasting a file cannot swamp the fanout and the database writer
+USER_MESSAGE_RATE = 5
+USER_MESSAGE_BURST = 20
+# Per process (each worker of a cluster has its own), below what the database writer sustains
+GLOBAL_MESSAGE_RATE = 2000
+GLOBAL_MESSAGE_BURST = 4000
+
 # Dictionary: client_socket -> username
 clients = {}
 
+# Dictionary: username -> client_socket, kept in step with clients for O(1) lookups
+sockets_by_username = {}
+
 # Dictionary to store users' timezones (username -> offset in seconds)
 user_timezones = {}
 
+# Dictionary: client_socket -> capabilities announced in the handshake
+client_capabilities = {}
+
+# Dictionary: client_socket -> room the client is in
+client_rooms = {}
+
+# Dictionary: room -> set of client sockets in it; public messages fan out to one set only
+room_members = {}
+
+# Guards client_rooms and room_members, changed from many client threads
+_rooms_lock = threading.Lock()
+
+# Held from numbering a public message until it is fanned out; see publish()
+_publish_lock = threading.Lock()
+
+# Room names: letters, digits, "-" and "_"
+ROOM_NAME = re.compile(r"^[A-Za-z0-9_-]{1,30}$")
+
+# Delay used to coalesce roster updates during bursts of joins and leaves
+ROSTER_INTERVAL = 0.25
+
+# Message bus to the other worker processes when running as a cluster (see cluster.py)
+bus = None
+
+# Dictionary: username -> worker id, for users connected to other workers of the cluster
+remote_users = {}
+
+# Dictionary: username -> room, for users connected to other workers of the cluster
+remote_rooms = {}
+
+# Sockets of clients that track message ids (they announced a last id in the handshake)
+resumable_clients = set()
+
+# Dictionary: client_socket -> OutboundQueue of live frames for a client that is still joining.
+# Fanout waits there until the client's history replay and roster snapshot are out (release_live)
+held_frames = {}
+_held_lock = threading.Lock()
+
+# Recent public messages of each room, pre-rendered for history replay
+recent_messages = RoomHistory()
+
+# Write-behind queue for public and private messages
+message_writer = MessageWriter(storage)
+
+RECV_PARSE_SECONDS = Histogram("chat_recv_parse_seconds", "Time to split one received chunk into messages.")
+FANOUT_SECONDS = Histogram("chat_fanout_seconds", "Time to render and queue one broadcast for its recipients.")
+HISTORY_REPLAY_MESSAGES = Histogram("chat_history_replay_messages", "Messages replayed per history request.",
+                                    buckets=(0, 10, 50, 100, 200, 500, 1000, 5000))
+
+Gauge("chat_connected_clients", "Clients connected to this process.", lambda: len(clients))
+Gauge("chat_remote_users", "Users connected to other workers of the cluster.", lambda: len(remote_users))
+Gauge("chat_rooms", "Rooms with members connected to this process.", lambda: len(room_members))
+Gauge("chat_write_queue_depth", "Messages waiting for the database writer.", lambda: message_writer.depth())
+Gauge("chat_outbound_queued_bytes", "Bytes queued for all clients of this process.",
+      lambda: sum(client_socket.depth() for client_socket in list(clients)))
+Gauge("chat_recent_history_messages", "Public messages held in memory for history replay.",
+      lambda: recent_messages.stats()[0])
+Gauge("chat_recent_history_bytes", "Encoded size of the in-memory history.", lambda: recent_messages.stats()[1])
+MetricCounter("chat_outbound_dropped_frames_total", "Frames dropped from slow clients' queues.",
+              lambda: outbound_counters["dropped"])
+MetricCounter("chat_outbound_evicted_clients_total", "Slow clients disconnected.", lambda: outbound_counters["evicted"])
+MetricCounter("chat_outbound_deflate_input_bytes_total", "Bytes compressed for clients with the deflate capability.",
+              lambda: outbound_counters["deflate_in"])
+MetricCounter("chat_outbound_deflate_output_bytes_total", "Compressed bytes written to those clients.",
+              lambda: outbound_counters["deflate_out"])
+MetricCounter("chat_messages_written_total", "Messages committed by the database writer.",
+              lambda: message_writer.written)
+MetricCounter("chat_messages_failed_total", "Messages the database writer had to drop.", lambda: message_writer.failed)
+Gauge("chat_handshakes_in_progress", "Connections waiting for their handshake.",
+      lambda: admission.counts["handshakes"])
+Gauge("chat_joins_waiting", "Joined clients queued for their history replay.", lambda: admission.counts["waiting"])
+MetricCounter("chat_throttled_messages_total", "Messages held back by the flood control limits.",
+              lambda: flood_control.counts["throttled"])
+MetricCounter("chat_throttle_delay_seconds_total", "Time throttled messages were held back.",
+              lambda: flood_control.counts["delay"])
+
+
+class Admission:
+    """
+    Slots for handshakes and history replays, sized from the settings above when
+    the server starts: threading semaphores in main(), asyncio ones in aio_server.serve().
+    """
+
+    def __init__(self):
+        self.handshake_slots = None
+        self.join_slots = None
+        self.counts = {"handshakes": 0, "waiting": 0}
+        self._lock = threading.Lock()
+
+    def count(self, name, amount):
+        with self._lock:
+            self.counts[name] += amount
+
+
+admission = Admission()
+
+
+flood_control = FloodControl()
+
 
 def format_offset(offset_seconds):
-    hours = offset_seconds // 3600
-    minutes = (abs(offset_seconds) % 3600) // 60
+    hours, remainder = divmod(abs(offset_seconds), 3600)
     sign = "+" if offset_seconds >= 0 else "-"
-    return f"{sign}{abs(hours):02d}:{minutes:02d}"
+    return f"{sign}{hours:02d}:{remainder // 60:02d}"
 
 
-def format_time(dt, username=None):
+@functools.lru_cache(maxsize=256)
+def tz_for_offset(offset_seconds):
+    return timezone(timedelta(seconds=offset_seconds))
+
+
+def format_time_at(dt, offset_seconds=None):
+    """Formats a UTC timestamp for a reader at the given UTC offset (None means UTC)."""
     if dt is None:
         return "Unknown time"
     try:
         dt_utc = dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
-        if username and username in user_timezones and user_timezones[username] is not None:
-            offset_seconds = user_timezones[username]
-            logger.info("User %s UTC offset: %s", username, format_offset(offset_seconds))
-            user_tz = timezone(timedelta(seconds=offset_seconds))
-            dt_local = dt_utc.astimezone(user_tz)
-            return dt_local.strftime("%Y-%m-%d %H:%M")
-        else:
-            return dt_utc.strftime("%Y-%m-%d %H:%M")
+        if offset_seconds is not None:
+            dt_utc = dt_utc.astimezone(tz_for_offset(offset_seconds))
+        return dt_utc.strftime("%Y-%m-%d %H:%M")
     except Exception as e:
-        logger.error('Error obtaining time for user "%s": %s', username, e)
+        logger.error('Error formatting time for UTC offset %s: %s', offset_seconds, e)
         return "Unknown time"
 
 
+def format_time(dt, username=None):
+    return format_time_at(dt, user_timezones.get(username) if username else None)
+
+
+def send_live(client_socket, data, droppable=True):
+    """Queues live traffic (fanout, private messages from others) for a client, holding it while the client joins."""
+    if client_socket in held_frames:
+        with _held_lock:
+            held = held_frames.get(client_socket)
+            if held is not None:
+                held.push(data, droppable)
+                return
+    client_socket.sendall(data, droppable=droppable)
+
+
+def release_live(client_socket):
+    """Ends the join of a client: sends the live frames held for it and stops holding them."""
+    with _held_lock:
+        held = held_frames.pop(client_socket, None)
+        if held is not None and len(held):
+            client_socket.sendall(held.take())
+
+
 def broadcast(message, exclude_client=None):
     """
-    Sends the message to all connected clients.
-    If sending fails for a client, removes it from the list and notifies others.
+    Queues the same message for all connected clients.
+    If queueing fails for a client (closed or evicted as a slow consumer),
+    removes it from the list and notifies others.
     """
+    data = encode_line(message)
     disconnected_sockets = []
     for client_socket in list(clients.keys()):
         if client_socket != exclude_client:
             try:
-                client_socket.sendall((message + "\n").encode('utf-8'))
+                send_live(client_socket, data)
             except Exception as e:
                 logger.error("Error sending message to client '%s': %s", clients.get(client_socket, "Unknown"), e)
                 disconnected_sockets.append(client_socket)
+    drop_disconnected(disconnected_sockets)
+
+
+def broadcast_timed(timestamp, body, message_id=None, exclude_client=None, room=None):
+    """
+    Queues a "[<time>] <body>" line for the members of room, or for all connected
+    clients when room is None, with the time in each reader's timezone. The line is
+    rendered and encoded once per distinct UTC offset, not once per recipient.
+    With message_id, resumable clients get the MSG-tagged form.
+    """
+    started = time.perf_counter()
+    rendered = {}
+    disconnected_sockets = []
+    if room is None:
+        recipients = list(clients)
+    else:
+        with _rooms_lock:
+            recipients = list(room_members.get(room, ()))
+    for client_socket in recipients:
+        username = clients.get(client_socket)
+        if client_socket == exclude_client or username is None:
+            continue
+        offset_seconds = user_timezones.get(username)
+        tagged = message_id is not None and client_socket in resumable_clients
+        key = (offset_seconds, tagged)
+        data = rendered.get(key)
+        if data is None:
+            line = f"[{format_time_at(timestamp, offset_seconds)}] {body}"
+            data = rendered[key] = encode_line(tagged_line(message_id, line) if tagged else line)
+        try:
+            send_live(client_socket, data)
+        except Exception as e:
+            logger.error("Error sending message to client '%s': %s", username, e)
+            disconnected_sockets.append(client_socket)
+    FANOUT_SECONDS.observe(time.perf_counter() - started)
+    drop_disconnected(disconnected_sockets)
+
+
+def broadcast_system(text, room=None):
+    """System message for everyone (or one room), not saved in the database."""
+    broadcast_timed(datetime.utcnow(), f"System: {text}", room=room)
 
-    # Process disconnected clients
+
+def announce(text, room=None):
+    """System message for every user (or one room), including those connected to other workers."""
+    if bus is not None:
+        bus.system(text, room)
+    else:
+        broadcast_system(text, room)
+
+
+def drop_disconnected(disconnected_sockets):
+    """Removes clients whose queue refused a message and notifies the others."""
     for sock in disconnected_sockets:
-        if sock in clients:
-            left_user = clients[sock]
+        left_user = unregister_client(sock)
+        if left_user is not None:
             logger.info("Client '%s' disconnected unexpectedly.", left_user)
-            del clients[sock]
-            left_text = f'==> "{left_user}" disconnected unexpectedly'
-            now = datetime.utcnow()
-            broadcast_line = f"[{format_time(now, username=left_user)}] System: {left_text}"
-            for cs in list(clients.keys()):
-                try:
-                    cs.sendall((broadcast_line + "\n").encode('utf-8'))
-                except Exception as e:
-                    logger.error("Error sending message to client '%s': %s", clients.get(cs, "Unknown"), e)
-            broadcast_online_users()
-
-
-def broadcast_online_users():
+            announce(f'==> "{left_user}" disconnected unexpectedly')
+            roster.changed()
+
+
+def roster_users():
+    """Connected users of the whole cluster, in join order."""
+    user_list = list(sockets_by_username)
+    user_list.extend(username for username in list(remote_users) if username not in sockets_by_username)
+    return user_list
+
+
+def roster_snapshot(user_list=None):
     """
-    Sends a system message with the current number of connected users.
+    Full list of connected users.
     Format: ONLINE_USERS|<number>|<nick1>|<nick2>|...
     """
-    user_list = list(clients.values())
-    n = len(user_list)
-    msg = "ONLINE_USERS|" + str(n)
-    for username in user_list:
-        msg += "|" + username
-    logger.debug("Broadcasting online users: %s", msg)
-    broadcast(msg)
+    if user_list is None:
+        user_list = roster_users()
+    return "|".join([ONLINE_USERS, str(len(user_list)), *user_list])
+
+
+class RosterNotifier:
+    """
+    Coalesces presence changes. After a join or leave it waits ROSTER_INTERVAL and
+    then sends one USER_JOINED/USER_LEFT delta to clients with the presence capability
+    and one full ONLINE_USERS roster to the others, however many users came and went
+    in the meantime. Joining clients get a full snapshot of their own right away
+    (snapshot_for), and the flush after it only tells them what changed since.
+    """
+
+    def __init__(self, interval=ROSTER_INTERVAL):
+        self.interval = interval
+        # Replaced by the asyncio engine with loop.call_later
+        self.schedule = self._schedule_timer
+        self._announced = set()
+        # client socket -> users listed in the snapshot it got on joining
+        self._snapshots = {}
+        self._pending = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _schedule_timer(delay, callback):
+        timer = threading.Timer(delay, callback)
+        timer.daemon = True
+        timer.start()
+
+    def changed(self):
+        with self._lock:
+            if self._pending:
+                return
+            self._pending = True
+        self.schedule(self.interval, self.flush)
+
+    def snapshot_for(self, client_socket):
+        """Encoded ONLINE_USERS snapshot for a joining client."""
+        user_list = roster_users()
+        with self._lock:
+            self._snapshots[client_socket] = set(user_list)
+        return encode_line(roster_snapshot(user_list))
+
+    @staticmethod
+    def _delta(joined, left):
+        delta = b""
+        if joined:
+            delta += encode_line("|".join([USER_JOINED, *sorted(joined)]))
+        if left:
+            delta += encode_line("|".join([USER_LEFT, *sorted(left)]))
+        return delta
+
+    def flush(self):
+        with self._lock:
+            self._pending = False
+            current = set(sockets_by_username)
+            current.update(list(remote_users))
+            joined = current - self._announced
+            left = self._announced - current
+            self._announced = current
+            snapshots, self._snapshots = self._snapshots, {}
+        if not joined and not left and not snapshots:
+            return
+
+        delta = self._delta(joined, left)
+        snapshot = encode_line(roster_snapshot())
+        logger.debug("Roster update: %d joined, %d left, %d online", len(joined), len(left), len(current))
+
+        disconnected_sockets = []
+        joining = {}
+        for client_socket in list(clients.keys()):
+            presence = PRESENCE in client_capabilities.get(client_socket, ())
+            data = delta if presence else snapshot
+            seen = snapshots.get(client_socket)
+            if client_socket in held_frames:
+                # Still joining: its snapshot lists the roster, and a later flush compares against it
+                if seen is not None:
+                    joining[client_socket] = seen
+                continue
+            if seen is not None:
+                if seen == current:
+                    continue
+                if presence:
+                    data = self._delta(current - seen, seen - current)
+            elif not joined and not left:
+                continue
+            try:
+                client_socket.sendall(data)
+            except Exception as e:
+                logger.error("Error sending roster to client '%s': %s", clients.get(client_socket, "Unknown"), e)
+                disconnected_sockets.append(client_socket)
+        if joining:
+            with self._lock:
+                for client_socket, seen in joining.items():
+                    self._snapshots.setdefault(client_socket, seen)
+        drop_disconnected(disconnected_sockets)
+
+
+roster = RosterNotifier()
+
+
+def log_outbound_stats():
+    """Debug summary of the outbound queues; the metrics endpoint exports the same numbers."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    queued = [client_socket.depth() for client_socket in list(clients.keys())]
+    logger.debug("Outbound queues: %d bytes queued (max %d), %d frames dropped, %d clients evicted.",
+                sum(queued), max(queued, default=0),
+                outbound_counters["dropped"], outbound_counters["evicted"])
+
+
+def parse_handshake(initial_message):
+    """
+    Parses the identification line sent by a client right after connecting.
+    Format: <username>|<utc offset in seconds>[|<last seen message id>[|<capability>,...[|<room>]]]
+    Returns (username, offset_seconds, last_id, capabilities, room); offset_seconds is None if it is
+    missing or invalid, last_id is None for clients that do not track message ids and 0 on a cold join.
+    """
+    parts = initial_message.split("|")
+    last_id = None
+    capabilities = frozenset()
+    room = DEFAULT_ROOM
+    if len(parts) in (2, 3, 4, 5):
+        username = parts[0].strip()
+        try:
+            offset_seconds = int(parts[1].strip())
+        except ValueError:
+            offset_seconds = None
+        if offset_seconds is not None and abs(offset_seconds) >= 24 * 3600:
+            offset_seconds = None
+        if len(parts) >= 3:
+            try:
+                last_id = max(int(parts[2].strip() or 0), 0)
+            except ValueError:
+                last_id = 0
+        if len(parts) >= 4:
+            capabilities = frozenset(cap.strip() for cap in parts[3].split(",") if cap.strip())
+        if len(parts) == 5 and ROOM_NAME.match(parts[4].strip()):
+            room = parts[4].strip()
+    else:
+        username = initial_message
+        offset_seconds = None
+    return username, offset_seconds, last_id, capabilities, room
+
+
+def register_client(client_socket, username, offset_seconds, resumable=False, capabilities=frozenset(),
+                    room=DEFAULT_ROOM):
+    # Nothing live reaches the client before its history and roster snapshot; see release_live()
+    held_frames[client_socket] = OutboundQueue(policy=DROP_OLDEST)
+    clients[client_socket] = username
+    sockets_by_username[username] = client_socket
+    user_timezones[username] = offset_seconds
+    client_capabilities[client_socket] = capabilities
+    if COMPRESSION and DEFLATE in capabilities:
+        # Nothing has been sent to the client yet
+        client_socket.start_compression()
+    if resumable:
+        resumable_clients.add(client_socket)
+    with _rooms_lock:
+        _enter_room(client_socket, room)
+    if bus is not None:
+        bus.joined(username, room)
+
+
+def _enter_room(client_socket, room):
+    # Callers hold _rooms_lock
+    client_rooms[client_socket] = room
+    room_members.setdefault(room, set()).add(client_socket)
+
+
+def _exit_room(client_socket):
+    # Callers hold _rooms_lock
+    room = client_rooms.pop(client_socket, None)
+    members = room_members.get(room)
+    if members is not None:
+        members.discard(client_socket)
+        if not members:
+            del room_members[room]
+    return room
+
+
+def move_to_room(client_socket, username, room):
+    """
+    Moves a client to another room and tells both rooms.
+    Returns the room it left, or None when it already was in room.
+    """
+    with _rooms_lock:
+        previous = client_rooms.get(client_socket)
+        if previous == room:
+            return None
+        _exit_room(client_socket)
+        _enter_room(client_socket, room)
+    if bus is not None:
+        bus.moved(username, room)
+    announce(f'==> "{username}" left #{previous}', room=previous)
+    announce(f'==> "{username}" joined #{room}', room=room)
+    return previous
+
+
+def room_list(client_socket):
+    """One line listing the rooms with people in them and their head count; the caller's room is marked."""
+    with _rooms_lock:
+        counts = Counter(client_rooms.values())
+        current = client_rooms.get(client_socket)
+    counts.update(list(remote_rooms.values()))
+    counts.setdefault(DEFAULT_ROOM, 0)
+    entries = [f"{'*' if room == current else ''}#{room} ({count})" for room, count in sorted(counts.items())]
+    return "Rooms: " + ", ".join(entries)
+
+
+def unregister_client(client_socket):
+    """
+    Removes the client from the online lists.
+    Returns the username of the removed client or None if it was not registered.
+    """
+    resumable_clients.discard(client_socket)
+    client_capabilities.pop(client_socket, None)
+    with _held_lock:
+        held_frames.pop(client_socket, None)
+    with _rooms_lock:
+        _exit_room(client_socket)
+    if client_socket not in clients:
+        return None
+    left_user = clients.pop(client_socket, None)
+    if left_user is None:
+        return None
+    if sockets_by_username.get(left_user) is client_socket:
+        del sockets_by_username[left_user]
+        if bus is not None:
+            bus.left(left_user)
+        flood_control.forget(left_user)
+    user_timezones.pop(left_user, None)
+    return left_user
+
+
+def find_client_socket(target):
+    return sockets_by_username.get(target)
+
+
+# Message handling is written once for both engines: the handlers below are generators
+# that yield the steps which may block, and each engine runs them its own way,
+# run_steps() here in the client's thread and aio_server.run_steps() on the event loop.
+# func(*args), which may block, such as a storage read
+Blocking = namedtuple("Blocking", "func args")
+# Queues record for the database writer and sends it back
+Save = namedtuple("Save", "record")
+# Waits until everything queued for client has been taken by its writer
+Drain = namedtuple("Drain", "client")
+Sleep = namedtuple("Sleep", "seconds")
+# Waits for a concurrent.futures.Future, such as the broker's answer to a message sent over the cluster bus
+Relay = namedtuple("Relay", "future")
+
+
+def after_writes(read):
+    """read, run once the messages queued so far are stored, so a client sees what it just sent."""
+    @functools.wraps(read)
+    def stored_read(*args):
+        message_writer.flush()
+        return read(*args)
+    return stored_read
+
+
+def render_history_page(page, tagged=False, username=None):
+    """Renders one page of history rows as a single buffer, in the user's timezone."""
+    if tagged:
+        return encode_lines(tagged_line(row.id, public_line(row, username=username)) for row in page)
+    return encode_lines(public_line(row, username=username) for row in page)
+
+
+def replay_renderer(username):
+    """render for RecentMessages.replay: None when the cached UTC lines fit the user."""
+    if not user_timezones.get(username):
+        return None
+    return functools.partial(render_history_page, username=username)
+
+
+def send_history(client_socket, last_id=None, room=DEFAULT_ROOM):
+    """
+    Streams the room's public history a joining client is missing, one page per send,
+    followed by HISTORY_END. Waits for each page to be taken by the writer before
+    queueing the next one. Steps for run_steps(); returns the number of replayed messages.
+    """
+    tagged = last_id is not None
+    username = clients.get(client_socket)
+    replay = recent_messages.replay(room, last_id, render=replay_renderer(username))
+    if replay is not None:
+        chunks, reset, sent = replay
+        if tagged and reset:
+            client_socket.sendall(encode_line(HISTORY_RESET))
+        for chunk in chunks:
+            client_socket.sendall(chunk)
+            yield Drain(client_socket)
+        client_socket.sendall(encode_line(HISTORY_END))
+        HISTORY_REPLAY_MESSAGES.observe(sent)
+        return sent
+
+    # Older than the in-memory window: page through storage
+    after_id, reset = yield Blocking(after_writes(storage.replay_start), (last_id, HISTORY_WINDOW, room))
+    if tagged and reset:
+        client_socket.sendall(encode_line(HISTORY_RESET))
+    sent = 0
+    while True:
+        page = yield Blocking(storage.fetch_page, (after_id, HISTORY_CHUNK, room))
+        if page:
+            client_socket.sendall(render_history_page(page, tagged, username))
+            yield Drain(client_socket)
+            sent += len(page)
+        if len(page) < HISTORY_CHUNK:
+            break
+        after_id = page[-1].id
+    client_socket.sendall(encode_line(HISTORY_END))
+    HISTORY_REPLAY_MESSAGES.observe(sent)
+    return sent
+
+
+def undelivered_reply(username):
+    """
+    Private messages stored for username while offline, encoded as one buffer.
+    Returns (data, count, last_id); data is empty when nothing is waiting.
+    """
+    count = 0
+    last_id = None
+
+    def lines():
+        nonlocal count, last_id
+        for row in storage.undelivered(username):
+            if not count:
+                yield "Private messages received while you were offline:"
+            yield private_line(row, username=username)
+            count += 1
+            last_id = row.id
+
+    data = encode_lines(lines())
+    return data, count, last_id
+
+
+def send_undelivered(client_socket, username):
+    """Pushes the stored private messages in a single send and flags them as delivered. Steps for run_steps()."""
+    data, count, last_id = yield Blocking(after_writes(undelivered_reply), (username,))
+    if count:
+        client_socket.sendall(data)
+        yield Drain(client_socket)
+        yield Blocking(storage.mark_delivered, (username, last_id))
+    return count
+
+
+def render_recent(row):
+    line = public_line(row)
+    return encode_line(line), encode_line(tagged_line(row.id, line))
+
+
+def load_recent_messages():
+    """Fills the in-memory history buffer of the default room from storage."""
+    recent_messages.room(DEFAULT_ROOM).fill(storage, render_recent, DEFAULT_ROOM)
+    count, size = recent_messages.stats()
+    logger.info("Loaded %d recent messages (%d bytes) into memory.", count, size)
+
+
+def public_line(msg, username=None):
+    return f"[{format_time(msg.timestamp, username=username)}] {msg.username}: {msg.message}"
+
+
+def tagged_line(message_id, line):
+    """Line carrying the message id, sent to resumable clients."""
+    return f"{MSG}|{message_id}|{line}"
+
+
+def publish(username, message_text, room=DEFAULT_ROOM):
+    """
+    Numbers a public message and fans it out in one step, so readers get ids in
+    increasing order; the caller queues the returned record for storage.
+    """
+    with _publish_lock:
+        msg = message_writer.new_public(username, message_text, room)
+        broadcast_public(msg)
+    return msg
+
+
+def broadcast_public(msg):
+    """Sends a saved public message to everyone in its room and keeps it for history replay."""
+    broadcast_timed(msg.timestamp, f"{msg.username}: {msg.message}", message_id=msg.id, room=msg.room)
+    recent_messages.append(msg.room, msg, *render_recent(msg))
+
+
+def private_line(msg, username=None):
+    t_str = format_time(msg.timestamp, username=username)
+    return f"[{t_str}] (Private) {msg.sender} -> {msg.receiver}: {msg.message}"
+
+
+def search_reply(terms, page, rows, more, username, room=DEFAULT_ROOM):
+    """
+    Lines answering a /search in a room: a header, one line per hit with its message id,
+    and a hint for the next page.
+    """
+    if not rows:
+        return [f"No messages found for '{terms}' in #{room}." if page == 1
+                else f"No more results for '{terms}' in #{room}."]
+    lines = [f"Search results for '{terms}' in #{room} (page {page}):"]
+    for row in rows:
+        lines.append(f"#{row.id} [{format_time(row.timestamp, username=username)}] {row.username}: {row.message}")
+    if more:
+        lines.append(f"More results: /search -p {page + 1} {terms}")
+    return lines
+
+
+HISTORY_PAGE_USAGE = "Usage: /history before|after <message_id> [count]"
+
+
+def parse_history_page(message_text):
+    """Splits "/history before|after <message_id> [count]" into (direction, message_id, count); None when malformed."""
+    parts = message_text.split()
+    if len(parts) not in (3, 4) or parts[1] not in ("before", "after"):
+        return None
+    try:
+        message_id = int(parts[2])
+        count = int(parts[3]) if len(parts) == 4 else HISTORY_PAGE_SIZE
+    except ValueError:
+        return None
+    if message_id < 0 or not 1 <= count <= HISTORY_PAGE_MAX:
+        return None
+    return parts[1], message_id, count
+
+
+def history_page_reply(username, room, direction, message_id, count):
+    """One page of the room's public history next to message_id, oldest first, framed and encoded for sending."""
+    if direction == "before":
+        rows = storage.fetch_page_before(message_id, count + 1, room)
+        more = len(rows) > count
+        rows = rows[1:] if more else rows
+    else:
+        rows = storage.fetch_page(message_id or None, count + 1, room, archived=True)
+        more = len(rows) > count
+        rows = rows[:count]
+    lines = [f"{HISTORY_PAGE}|{direction}|{message_id}"]
+    lines.extend(tagged_line(row.id, public_line(row, username=username)) for row in rows)
+    lines.append(f"{HISTORY_PAGE_END}|{int(more)}")
+    return encode_lines(lines)
+
+
+PM_HISTORY_USAGE = "Usage: /pmhistory <username> [before_id]"
+
+
+def parse_pm_history(message_text):
+    """Splits "/pmhistory <username> [before_id]" into (username, before_id); None when malformed."""
+    parts = message_text.split()
+    if len(parts) not in (2, 3):
+        return None
+    if len(parts) == 2:
+        return parts[1], None
+    try:
+        return parts[1], int(parts[2])
+    except ValueError:
+        return None
+
+
+def pm_history_reply(username, other, before_id=None):
+    """
+    One page of the private conversation between username and other, newest first,
+    encoded for sending. Rows are rendered as the query yields them.
+    """
+    def lines():
+        shown = 0
+        oldest_id = None
+        # One row past the page tells whether older messages exist
+        rows = iter(storage.conversation(username, other, before_id, PM_HISTORY_PAGE + 1))
+        for row in islice(rows, PM_HISTORY_PAGE):
+            if not shown:
+                yield f"Private messages with {other} (newest first):"
+            yield f"#{row.id} {private_line(row, username=username)}"
+            shown += 1
+            oldest_id = row.id
+        older = list(rows)
+        if not shown:
+            yield f"No {'older ' if before_id else ''}private messages with {other}."
+        elif older:
+            yield f"Older messages: /pmhistory {other} {oldest_id}"
+
+    return encode_lines(lines())
+
+
+def offline_notice(target):
+    return f"User {target} is offline; the message will be delivered when they connect."
+
+
+ROOM_COMMANDS = ("/join", "/leave", "/rooms")
+ROOM_USAGE = "Usage: /join <room>, /leave, /rooms"
+
+
+def is_room_command(message_text):
+    return message_text.split(maxsplit=1)[0] in ROOM_COMMANDS
+
+
+def change_room(client_socket, username, message_text):
+    """
+    Handles /join <room>, /leave (back to the default room) and /rooms.
+    Returns the room whose history the client should be sent next, or None.
+    """
+    parts = message_text.split()
+    if parts[0] == "/rooms":
+        client_socket.sendall(encode_line(room_list(client_socket)))
+        return None
+    if parts[0] == "/leave" and len(parts) == 1:
+        room = DEFAULT_ROOM
+    elif parts[0] == "/join" and len(parts) == 2 and ROOM_NAME.match(parts[1].lstrip("#")):
+        room = parts[1].lstrip("#")
+    else:
+        client_socket.sendall(encode_line(f"Error: {ROOM_USAGE}"))
+        return None
+    if move_to_room(client_socket, username, room) is None:
+        client_socket.sendall(encode_line(f"You are already in #{room}."))
+        return None
+    logger.debug("User '%s' moved to room '%s'", username, room)
+    if ROOMS in client_capabilities.get(client_socket, ()):
+        client_socket.sendall(encode_line(f"{ROOM}|{room}"))
+        return room
+    # Clients without room support only see the new room's live messages
+    client_socket.sendall(encode_line(f"You are now in #{room}."))
+    return None
+
+
+THROTTLE_NOTICE = "Slow down: your messages are being delayed."
+
+
+def throttle(client_socket, username):
+    """Holds the client's reader, and so its socket, until the next message fits the flood limits."""
+    wait, started = flood_control.user_delay(username)
+    if started:
+        client_socket.sendall(encode_line(THROTTLE_NOTICE))
+    if wait:
+        yield Sleep(wait)
+    wait = flood_control.global_delay()
+    if wait:
+        yield Sleep(wait)
+
+
+def process_message(client_socket, username, message_text):
+    """Handles one message received from a connected client. Steps for run_steps()."""
+    room = client_rooms.get(client_socket, DEFAULT_ROOM)
+    if is_room_command(message_text):
+        room = change_room(client_socket, username, message_text)
+        if room is not None:
+            yield from send_history(client_socket, 0 if client_socket in resumable_clients else None, room)
+        return
+
+    if message_text == "/history" or message_text.startswith("/history "):
+        parsed = parse_history_page(message_text)
+        if parsed is None:
+            client_socket.sendall(encode_line(f"Error: {HISTORY_PAGE_USAGE}"))
+            return
+        client_socket.sendall((yield Blocking(after_writes(history_page_reply), (username, room, *parsed))))
+        return
+
+    if message_text == "/pmhistory" or message_text.startswith("/pmhistory "):
+        parsed = parse_pm_history(message_text)
+        if parsed is None:
+            client_socket.sendall(encode_line(f"Error: {PM_HISTORY_USAGE}"))
+            return
+        client_socket.sendall((yield Blocking(after_writes(pm_history_reply), (username, *parsed))))
+        return
+
+    if message_text == "/search" or message_text.startswith("/search "):
+        parsed = parse_search(message_text)
+        if parsed is None:
+            client_socket.sendall(encode_line(f"Error: {SEARCH_USAGE}"))
+            return
+        terms, page = parsed
+        rows, more = yield Blocking(after_writes(storage.search), (terms, page, SEARCH_PAGE_SIZE, room))
+        client_socket.sendall(encode_lines(search_reply(terms, page, rows, more, username, room)))
+        return
+
+    # Everything below is stored and fanned out
+    yield from throttle(client_socket, username)
+
+    # Process private messages
+    if message_text.startswith("/pm "):
+        parts = message_text.split(" ", 2)
+        if len(parts) < 3:
+            client_socket.sendall(encode_line("Error: Usage /pm <username> <message>"))
+            return
+        target = parts[1]
+        if target == username:
+            client_socket.sendall(encode_line("Error: Cannot send a private message to yourself."))
+            return
+        private_text = parts[2]
+
+        if bus is not None:
+            # The broker knows every worker's users and routes the message; the
+            # client's next line waits for it, so its replies keep their order
+            yield Relay(bus.private(username, target, private_text))
+            return
+
+        target_socket = find_client_socket(target)
+        if target_socket:
+            new_private = yield Save(message_writer.new_private(username, target, private_text))
+            try:
+                send_live(target_socket, encode_line(private_line(new_private, username=target)), droppable=False)
+            except Exception as e:
+                logger.error("Error sending private message to '%s': %s", target, e)
+
+            client_socket.sendall(encode_line(private_line(new_private, username=username)))
+            logger.debug("Private message %d from '%s' to '%s'", new_private.id, username, target)
+        else:
+            new_private = yield Save(message_writer.new_private(username, target, private_text, delivered=False))
+            client_socket.sendall(encode_lines([private_line(new_private, username=username), offline_notice(target)]))
+            logger.debug("Private message %d from '%s' to offline '%s' stored", new_private.id, username, target)
+        return
+
+    if bus is not None:
+        # Numbered, stored and sent to every worker (this one included) by the broker
+        yield Relay(bus.publish(username, message_text, room))
+        return
+
+    # Process public messages (queued for the DB writer once fanned out)
+    new_msg = publish(username, message_text, room)
+    yield Save(new_msg)
+    logger.debug("Public message %d from '%s'", new_msg.id, username)
+
+
+def run_steps(steps):
+    """Runs the steps of a handler in the calling thread; returns its result."""
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as done:
+            return done.value
+        if isinstance(step, Blocking):
+            result = step.func(*step.args)
+        elif isinstance(step, Save):
+            message_writer.submit(step.record)
+            result = step.record
+        elif isinstance(step, Drain):
+            step.client.drain()
+            result = None
+        elif isinstance(step, Relay):
+            result = step.future.result()
+        else:
+            time.sleep(step.seconds)
+            result = None
+
+
+def read_handshake(client_socket):
+    """First chunk from a new connection, or b"" if none came within HANDSHAKE_TIMEOUT. Frees the handshake slot."""
+    try:
+        if not client_socket.wait_readable(HANDSHAKE_TIMEOUT):
+            logger.warning("No handshake within %s seconds. Closing connection.", HANDSHAKE_TIMEOUT)
+            return b""
+        return client_socket.recv(RECV_SIZE)
+    finally:
+        admission.count("handshakes", -1)
+        admission.handshake_slots.release()
 
 
 def handle_client(client_socket):
-    session_db = Session()
     username = None
     try:
-        # Read data for user identification (username and timezone offset)
-        data = client_socket.recv(1024)
+        # Read data for user identification (username and timezone offset).
+        # Framed clients may pipeline messages right behind the handshake.
+        data = read_handshake(client_socket)
         if not data:
             logger.warning("No data received for user identification. Closing connection.")
             client_socket.close()
             return
 
-        initial_message = data.decode('utf-8').strip()
-        parts = initial_message.split("|")
-        if len(parts) == 2:
-            username = parts[0].strip()
-            try:
-                offset_seconds = int(parts[1].strip())
-            except ValueError:
-                offset_seconds = None
-        else:
-            username = initial_message
-            offset_seconds = None
+        decoder = decoder_for_first_chunk(data)
+        frames = decoder.feed_text(data)
+        username, offset_seconds, last_id, capabilities, room = parse_handshake(frames[0].strip() if frames else "")
+        pending = frames[1:]
 
         if not username:
             logger.warning("Username is empty. Closing connection.")
             client_socket.close()
             return
 
-        clients[client_socket] = username
-        user_timezones[username] = offset_seconds
+        register_client(client_socket, username, offset_seconds,
+                        resumable=last_id is not None, capabilities=capabilities, room=room)
 
-        logger.info("New client connected: '%s'", username)
+        logger.info("New client connected: '%s' (UTC%s)", username,
+                    format_offset(offset_seconds) if offset_seconds is not None else "")
 
-        # Send public chat history
-        history = session_db.query(ChatMessage).order_by(ChatMessage.timestamp.asc()).all()
-        history_lines = []
-        for msg in history:
-            t_str = format_time(msg.timestamp)
-            line = f"[{t_str}] {msg.username}: {msg.message}"
-            history_lines.append(line)
-        history_text = "\n".join(history_lines) + "\n"
-        client_socket.sendall(history_text.encode('utf-8'))
-        client_socket.sendall("HISTORY_END\n".encode('utf-8'))
-        logger.debug("Chat history sent to client '%s'", username)
+        # Send the public chat history the client is missing, once a join slot is free
+        admission.count("waiting", 1)
+        with admission.join_slots:
+            admission.count("waiting", -1)
+            replayed = run_steps(send_history(client_socket, last_id, room))
+            logger.debug("Chat history sent to client '%s' (%d messages)", username, replayed)
+
+            stored = run_steps(send_undelivered(client_socket, username))
+            if stored:
+                logger.debug("Delivered %d stored private messages to '%s'", stored, username)
 
         # System message for joining, not saved in the database
-        join_text = f'==> "{username}" joined the chat'
-        now = datetime.utcnow()
-        t_str = format_time(now, username=username)
-        broadcast_line = f"[{t_str}] System: {join_text}"
-        broadcast(broadcast_line)
-        broadcast_online_users()
+        announce(f'==> "{username}" joined the chat')
+        client_socket.sendall(roster.snapshot_for(client_socket))
+        release_live(client_socket)
+        roster.changed()
 
         logger.info("User '%s' joined the chat.", username)
 
         # Main loop to receive messages from the client
         while True:
-            data = client_socket.recv(1024)
+            for frame in pending:
+                message_text = frame.strip()
+                if message_text:
+                    run_steps(process_message(client_socket, username, message_text))
+
+            data = client_socket.recv(RECV_SIZE)
             if not data:
                 logger.info("Client '%s' disconnected.", username)
                 break
+            started = time.perf_counter()
+            pending = decoder.feed_text(data)
+            RECV_PARSE_SECONDS.observe(time.perf_counter() - started)
 
-            message_text = data.decode('utf-8').strip()
-            if not message_text:
-                continue
-
-            # Process private messages
-            if message_text.startswith("/pm "):
-                parts = message_text.split(" ", 2)
-                if len(parts) < 3:
-                    error_msg = "Error: Usage /pm <username> <message>"
-                    client_socket.sendall((error_msg + "\n").encode('utf-8'))
-                    continue
-                target = parts[1]
-                if target == username:
-                    client_socket.sendall("Error: Cannot send a private message to yourself.\n".encode('utf-8'))
-                    continue
-                private_text = parts[2]
-
-                target_socket = None
-                for sock, uname in clients.items():
-                    if uname == target:
-                        target_socket = sock
-                        break
-                if target_socket:
-                    try:
-                        new_private = PrivateMessage(sender=username, receiver=target, message=private_text)
-                        session_db.add(new_private)
-                        session_db.commit()
-                        session_db.refresh(new_private)
-                    except Exception as e:
-                        logger.error("Error saving private message from '%s' to '%s': %s", username, target, e, exc_info=True)
-                        session_db.rollback()
-                        client_socket.sendall("Error saving private message to DB.\n".encode('utf-8'))
-                        continue
-
-                    t_str = format_time(new_private.timestamp, username=username)
-                    private_line = f"[{t_str}] (Private) {username} -> {target}: {private_text}"
-
-                    try:
-                        target_socket.sendall((private_line + "\n").encode('utf-8'))
-                    except Exception as e:
-                        logger.error("Error sending private message to '%s': %s", target, e)
-
-                    client_socket.sendall((private_line + "\n").encode('utf-8'))
-                    logger.debug("Private message from '%s' to '%s': %s", username, target, private_text)
-                else:
-                    client_socket.sendall((f"User {target} not found.\n").encode('utf-8'))
-                continue
-
-            # Process public messages (save to DB)
-            try:
-                new_msg = ChatMessage(username=username, message=message_text)
-                session_db.add(new_msg)
-                session_db.commit()
-                session_db.refresh(new_msg)
-            except Exception as e:
-                logger.error("Error saving public message from '%s': %s", username, e, exc_info=True)
-                session_db.rollback()
-                client_socket.sendall("Error saving message to DB.\n".encode('utf-8'))
-                continue
-
-            t_str = format_time(new_msg.timestamp, username=username)
-            broadcast_line = f"[{t_str}] {username}: {message_text}"
-            broadcast(broadcast_line)
-            logger.debug("Public message from '%s': %s", username, message_text)
-
+    except FrameTooLarge as e:
+        logger.warning("Closing connection of '%s': %s", username or "Unknown", e)
     except Exception as e:
         logger.error("Error in handle_client (user='%s'): %s", clients.get(client_socket, "Unknown"), e, exc_info=True)
     finally:
         client_socket.close()
-        if client_socket in clients:
-            left_user = clients[client_socket]
-            del clients[client_socket]
-            if left_user in user_timezones:
-                del user_timezones[left_user]
-
+        left_user = unregister_client(client_socket)
+        if left_user is not None:
             # System message for disconnection, not saved in the DB
-            left_text = f'==> "{left_user}" left the chat'
-            now = datetime.utcnow()
-            t_str = format_time(now, username=left_user)
-            broadcast_line = f"[{t_str}] System: {left_text}"
-            broadcast(broadcast_line)
-            broadcast_online_users()
+            announce(f'==> "{left_user}" left the chat')
+            roster.changed()
 
             logger.info("Client '%s' removed from list after disconnection.", left_user)
+            log_outbound_stats()
+
+
+def start_metrics(port):
+    """Starts the metrics endpoint when a port is configured."""
+    if port is None:
+        return
+    try:
+        start_metrics_server(port)
+    except OSError as e:
+        logger.error("Error starting the metrics endpoint on port %s: %s", port, e)
 
-        session_db.close()
+
+def stop_on_sigterm():
+    """Turns SIGTERM into KeyboardInterrupt so a terminated server shuts down cleanly."""
+    def handler(signum, frame):
+        # Only the first signal interrupts; the shutdown itself must not be cut short
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handler)
 
 
 def main():
+    stop_on_sigterm()
+    load_recent_messages()
+    message_writer.start()
+    start_metrics(METRICS_PORT)
+
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
         server_socket.bind((HOST, PORT))
     except Exception as e:
         logger.error("Error binding to port %s: %s", PORT, e)
+        message_writer.stop()
         return
 
-    server_socket.listen(5)
+    admission.handshake_slots = threading.BoundedSemaphore(MAX_HANDSHAKES)
+    admission.join_slots = threading.BoundedSemaphore(JOIN_CONCURRENCY)
+    flood_control.configure(USER_MESSAGE_RATE, USER_MESSAGE_BURST, GLOBAL_MESSAGE_RATE, GLOBAL_MESSAGE_BURST)
+    server_socket.listen(ACCEPT_BACKLOG)
     logger.info("Server running on %s:%s. Waiting for clients...", HOST, PORT)
 
-    while True:
-        try:
-            client_socket, addr = server_socket.accept()
+    try:
+        while True:
+            # Connections beyond MAX_HANDSHAKES stay in the kernel's backlog until a slot frees up
+            admission.handshake_slots.acquire()
+            try:
+                client_socket, addr = server_socket.accept()
+            except OSError as e:
+                admission.handshake_slots.release()
+                logger.error("Error accepting new connection: %s", e, exc_info=True)
+                continue
+            admission.count("handshakes", 1)
             logger.info("New connection: %s", addr)
-            client_thread = threading.Thread(target=handle_client, args=(client_socket,))
+            # Daemon threads, so a blocked recv() does not keep a stopped server alive
+            client_thread = threading.Thread(target=handle_client, args=(ClientConnection(client_socket),),
+                                             daemon=True)
             client_thread.start()
-        except Exception as e:
-            logger.error("Error accepting new connection: %s", e, exc_info=True)
+    except KeyboardInterrupt:
+        logger.info("Server stopped.")
+    finally:
+        server_socket.close()
+        # Commit whatever is still queued before exiting
+        message_writer.stop()
+        storage.close()
 
 
 if __name__ == "__main__":
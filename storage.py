@@ -0,0 +1,207 @@
+"""
+Message storage behind one interface, with interchangeable backends.
+
+The server only talks to a Storage. Rows it gets back have the attributes of the
+records in persistence.py: public rows id, timestamp, username, message; private
+rows id, timestamp, sender, receiver, message. Timestamps are naive UTC.
+
+The SQL backend also reads the rows that maintenance.py moved to the archive
+(archive.py) once a room's or conversation's rows in the database run out.
+
+Backends:
+  "sql" - SQLAlchemy over the SQLite database (models.py, history.py, search.py)
+  "log" - segmented append-only log files (logstore.py)
+
+STORAGE_BACKEND picks the backend when the server starts.
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from sqlalchemy import func
+
+from archive import Archive, PUBLIC_TABLE, PRIVATE_TABLE
+from database import Session, engine
+from history import (
+    HISTORY_CHUNK, HISTORY_PAGE_SIZE, HISTORY_WINDOW, PM_HISTORY_PAGE, replay_start, fetch_page, fetch_page_before,
+    fetch_recent, iter_conversation, iter_undelivered, mark_delivered,
+)
+from migrations import migrate
+from models import ChatMessage, PrivateMessage
+from protocol import DEFAULT_ROOM
+from search import SEARCH_PAGE_SIZE, search_messages
+
+SQL = "sql"
+LOG = "log"
+STORAGE_BACKEND = SQL
+
+
+class Storage(ABC):
+    """Interface of a storage backend. Methods may be called from several threads."""
+
+    @abstractmethod
+    def max_ids(self):
+        """Largest (public, private) message ids stored, 0 when there are none."""
+
+    @abstractmethod
+    def write(self, public_records, private_records):
+        """Stores one batch of PublicRecord and PrivateRecord, all or nothing."""
+
+    @abstractmethod
+    def replay_start(self, last_id=None, window=HISTORY_WINDOW, room=DEFAULT_ROOM):
+        """
+        Where history replay of a room for a joining client begins. Returns (after_id, reset):
+        rows after after_id are replayed (None means from the oldest row). reset is True when the
+        client's last seen message is unknown or older than the window.
+        """
+
+    @abstractmethod
+    def fetch_page(self, after_id=None, limit=HISTORY_CHUNK, room=DEFAULT_ROOM, archived=False):
+        """
+        Up to limit public rows of the room following after_id, oldest first. Archived rows
+        are only included when asked for: history replay starts within the stored rows.
+        """
+
+    @abstractmethod
+    def fetch_page_before(self, before_id, limit=HISTORY_PAGE_SIZE, room=DEFAULT_ROOM):
+        """Up to limit public rows of the room preceding before_id, oldest first, archived ones included."""
+
+    @abstractmethod
+    def recent(self, room, limit):
+        """The room's newest limit public rows, oldest first."""
+
+    @abstractmethod
+    def conversation(self, user, other, before_id=None, limit=PM_HISTORY_PAGE):
+        """
+        Up to limit private rows between user and other with ids below before_id, newest first,
+        archived ones included.
+        """
+
+    @abstractmethod
+    def undelivered(self, receiver):
+        """Private rows stored for receiver while they were offline, oldest first."""
+
+    @abstractmethod
+    def mark_delivered(self, receiver, up_to_id):
+        """Flags the rows stored for receiver up to up_to_id as delivered."""
+
+    @abstractmethod
+    def search(self, terms, page=1, page_size=SEARCH_PAGE_SIZE, room=DEFAULT_ROOM):
+        """(rows, more) for one page of the room's public rows matching terms, best match first."""
+
+    def after_fork(self):
+        """Called in both processes after fork(): drops connections they must not share."""
+
+    def close(self):
+        pass
+
+
+class SQLStorage(Storage):
+    """The SQLAlchemy models in messages.db and their archive; every call runs in a session of its own."""
+
+    def __init__(self):
+        migrate()
+        self.archive = Archive()
+
+    @contextmanager
+    def _session(self):
+        session_db = Session()
+        try:
+            yield session_db
+        except Exception:
+            session_db.rollback()
+            raise
+        finally:
+            session_db.close()
+
+    def max_ids(self):
+        # Archiving may have emptied a table; its ids must not be handed out again
+        self.archive.refresh()
+        with engine.connect() as connection:
+            return tuple(max(connection.execute(func.max(model.id).select()).scalar() or 0,
+                             self.archive.archived_through(table))
+                         for model, table in ((ChatMessage, PUBLIC_TABLE), (PrivateMessage, PRIVATE_TABLE)))
+
+    def write(self, public_records, private_records):
+        with engine.begin() as connection:
+            if public_records:
+                connection.execute(ChatMessage.__table__.insert(), [record._asdict() for record in public_records])
+            if private_records:
+                connection.execute(PrivateMessage.__table__.insert(),
+                                   [record._asdict() for record in private_records])
+
+    def replay_start(self, last_id=None, window=HISTORY_WINDOW, room=DEFAULT_ROOM):
+        with self._session() as session_db:
+            return replay_start(session_db, last_id, window, room)
+
+    def fetch_page(self, after_id=None, limit=HISTORY_CHUNK, room=DEFAULT_ROOM, archived=False):
+        rows = []
+        through = 0
+        if archived:
+            self.archive.refresh()
+            # Rows an interrupted archive run left in the table are read from the archive only
+            through = self.archive.archived_through(PUBLIC_TABLE)
+            if not after_id or after_id <= through:
+                rows = self.archive.oldest(PUBLIC_TABLE, (room,), after_id or None, limit)
+                if len(rows) == limit:
+                    return rows
+                # Every stored row is newer than the archived ones
+                after_id = None
+        with self._session() as session_db:
+            return rows + fetch_page(session_db, after_id, limit - len(rows), room, through)
+
+    def fetch_page_before(self, before_id, limit=HISTORY_PAGE_SIZE, room=DEFAULT_ROOM):
+        with self._session() as session_db:
+            rows = fetch_page_before(session_db, before_id, limit, room)
+        if len(rows) < limit:
+            # Empty when before_id is archived itself
+            before_id = rows[0].id if rows else before_id
+            rows = self.archive.newest(PUBLIC_TABLE, (room,), before_id, limit - len(rows)) + rows
+        return rows
+
+    def recent(self, room, limit):
+        with self._session() as session_db:
+            return fetch_recent(session_db, room, limit)
+
+    def conversation(self, user, other, before_id=None, limit=PM_HISTORY_PAGE):
+        self.archive.refresh()
+        through = self.archive.archived_through(PRIVATE_TABLE)
+        count = 0
+        with self._session() as session_db:
+            for row in iter_conversation(session_db, user, other, before_id, limit):
+                if row.id <= through:
+                    # Left in the table by an interrupted archive run; read from the archive below
+                    break
+                count += 1
+                before_id = row.id
+                yield row
+        if count < limit and through:
+            if before_id is None or before_id > through:
+                before_id = through + 1
+            yield from reversed(self.archive.newest(PRIVATE_TABLE, (user, other), before_id, limit - count))
+
+    def undelivered(self, receiver):
+        with self._session() as session_db:
+            yield from iter_undelivered(session_db, receiver)
+
+    def mark_delivered(self, receiver, up_to_id):
+        with self._session() as session_db:
+            mark_delivered(session_db, receiver, up_to_id)
+
+    def search(self, terms, page=1, page_size=SEARCH_PAGE_SIZE, room=DEFAULT_ROOM):
+        with self._session() as session_db:
+            return search_messages(session_db, terms, page, page_size, room)
+
+    def after_fork(self):
+        engine.dispose()
+
+
+def open_storage(backend=None):
+    """Opens the configured backend (STORAGE_BACKEND unless given)."""
+    backend = backend or STORAGE_BACKEND
+    if backend == SQL:
+        return SQLStorage()
+    if backend == LOG:
+        # Imported here: logstore builds on this module
+        from logstore import LogStorage
+        return LogStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,73 @@
+import functools
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import database
+import maintenance
+import storage
+from migrations import migrate
+
+
+def sqlite_engine(url, **kwargs):
+    engine = create_engine(url, connect_args={"check_same_thread": False}, **kwargs)
+    event.listen(engine, "connect", database._apply_pragmas)
+    return engine
+
+
+@pytest.fixture
+def sql_storage(tmp_path, monkeypatch):
+    """SQLStorage on a messages.db and archive in tmp_path instead of the working directory."""
+    engine = sqlite_engine(f"sqlite:///{tmp_path / 'messages.db'}")
+    Session = sessionmaker(bind=engine)
+    for module in (storage, maintenance):
+        monkeypatch.setattr(module, "engine", engine)
+        monkeypatch.setattr(module, "Session", Session)
+    monkeypatch.setattr(storage, "migrate", functools.partial(migrate, engine))
+    monkeypatch.chdir(tmp_path)
+    sql = storage.SQLStorage()
+    yield sql
+    sql.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def session_db():
+    """Session on an in-memory database migrated to the current schema."""
+    engine = sqlite_engine("sqlite://", poolclass=StaticPool)
+    migrate(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def server_module(tmp_path_factory):
+    """The server module, imported with its storage (the log backend) in a temporary directory."""
+    from logstore import LogStorage
+
+    directory = str(tmp_path_factory.mktemp("server") / "messages.log")
+    original = storage.open_storage
+    storage.open_storage = lambda backend=None: LogStorage(directory)
+    try:
+        import server
+    finally:
+        storage.open_storage = original
+    server.message_writer.start()
+    yield server
+    server.message_writer.stop()
+    server.storage.close()
+
+
+@pytest.fixture
+def server(server_module, monkeypatch):
+    """server with a roster that flushes only when the test calls flush(); clients are removed afterwards."""
+    roster = server_module.RosterNotifier()
+    roster.schedule = lambda delay, callback: None
+    monkeypatch.setattr(server_module, "roster", roster)
+    yield server_module
+    for client_socket in list(server_module.clients):
+        server_module.unregister_client(client_socket)
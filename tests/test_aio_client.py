@@ -0,0 +1,111 @@
+import asyncio
+
+import aio_client
+from aio_client import (
+    AsyncChatClient, Connected, Disconnected, History, Notice, PrivateMessage, PublicMessage, Roster, SystemMessage,
+    parse_chat_line, reconnect_delay,
+)
+
+
+class FakeReader:
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    async def read(self, size):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+def read_events(*lines):
+    async def collect():
+        client = AsyncChatClient("xavier", utc_offset=0, compress=False)
+        return [event async for event in client._read(FakeReader(("\n".join(lines) + "\n").encode()))], client
+
+    return asyncio.run(collect())
+
+
+def test_roster_frames_during_history_are_presence_events():
+    events, client = read_events(
+        "MSG|1|[2024-01-01 10:00] zed: hi",
+        "ONLINE_USERS|2|zed|xavier",
+        "USER_LEFT|zed",
+        "HISTORY_END",
+        "[2024-01-01 10:01] System: ==> \"zed\" left the chat",
+    )
+    assert events[:2] == [Roster(("zed", "xavier")), Roster(("xavier",))]
+    history = events[2]
+    assert isinstance(history, History)
+    assert [type(message) for message in history.messages] == [PublicMessage]
+    assert isinstance(events[3], SystemMessage)
+    assert not any(isinstance(event, Notice) for event in events)
+    assert list(client.users) == ["xavier"]
+    assert client.last_message_id == 1
+
+
+def test_live_messages_out_of_order_are_kept_and_repeats_dropped():
+    events, client = read_events(
+        "HISTORY_END",
+        "MSG|6|[2024-01-01 10:00] zed: six",
+        "MSG|5|[2024-01-01 10:00] zed: five",
+        "MSG|6|[2024-01-01 10:00] zed: six",
+    )
+    assert [event.id for event in events if isinstance(event, PublicMessage)] == [6, 5]
+    assert client.last_message_id == 6
+
+
+def test_parse_chat_line():
+    assert parse_chat_line("[2024-01-01 10:00] zed: a: b", 5) == PublicMessage(
+        5, "2024-01-01 10:00", "zed", "a: b", "[2024-01-01 10:00] zed: a: b")
+    assert parse_chat_line("[2024-01-01 10:00] System: ==> hi") == SystemMessage(
+        "2024-01-01 10:00", "==> hi", "[2024-01-01 10:00] System: ==> hi")
+    assert parse_chat_line("[2024-01-01 10:00] (Private) zed -> xavier: psst") == PrivateMessage(
+        "2024-01-01 10:00", "zed", "xavier", "psst", "[2024-01-01 10:00] (Private) zed -> xavier: psst")
+    for line in ("Rooms: #general (1)", "[no closing bracket", "[2024-01-01 10:00] no sender",
+                 "[2024-01-01 10:00] (Private) zed: no arrow"):
+        assert parse_chat_line(line) == Notice(line)
+
+
+def test_reconnect_delay_is_full_jitter_under_a_capped_ceiling(monkeypatch):
+    ceilings = []
+    monkeypatch.setattr(aio_client.random, "uniform", lambda low, high: ceilings.append((low, high)) or high)
+    delays = [reconnect_delay(attempt) for attempt in range(8)]
+    assert ceilings == [(0, min(aio_client.RECONNECT_MAX_DELAY, aio_client.RECONNECT_BASE_DELAY * 2 ** attempt))
+                        for attempt in range(8)]
+    assert delays == [1, 2, 4, 8, 16, 32, 60, 60]
+
+
+def test_reconnect_resumes_after_the_last_message(monkeypatch):
+    monkeypatch.setattr(aio_client, "reconnect_delay", lambda attempt: 0)
+    handshakes = []
+    # What the server sends on each connection before closing it
+    sessions = [
+        ["MSG|1|[2024-01-01 10:00] zed: one", "MSG|2|[2024-01-01 10:01] zed: two", "HISTORY_END"],
+        # Replay overlapping what was seen, and a live message repeated in the replay
+        ["MSG|2|[2024-01-01 10:01] zed: two", "MSG|3|[2024-01-01 10:02] zed: three",
+         "MSG|3|[2024-01-01 10:02] zed: three", "HISTORY_END", "MSG|4|[2024-01-01 10:03] zed: four"],
+    ]
+
+    async def serve(reader, writer):
+        handshakes.append((await reader.readline()).decode().strip())
+        writer.write(("\n".join(sessions.pop(0)) + "\n").encode())
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        listener = await asyncio.start_server(serve, "127.0.0.1", 0)
+        port = listener.sockets[0].getsockname()[1]
+        client = AsyncChatClient("xavier", port=port, utc_offset=0, compress=False)
+        events = []
+        async with listener:
+            async for event in client.events():
+                events.append(event)
+                if isinstance(event, Disconnected) and not sessions:
+                    client.close()
+        return client, events
+
+    client, events = asyncio.run(asyncio.wait_for(run(), 10))
+    assert [handshake.split("|")[2] for handshake in handshakes] == ["0", "2"]
+    histories = [[message.id for message in event.messages] for event in events if isinstance(event, History)]
+    assert histories == [[1, 2], [3]]
+    assert [event.id for event in events if isinstance(event, PublicMessage)] == [4]
+    assert [event.resumed for event in events if isinstance(event, Connected)] == [False, True]
+    assert client.last_message_id == 4
@@ -0,0 +1,83 @@
+import asyncio
+import socket
+
+import pytest
+
+
+class StalledTransport:
+    def __init__(self):
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+
+class StalledWriter:
+    """A stream writer whose peer has stopped reading: drain() never returns."""
+
+    def __init__(self):
+        self.transport = StalledTransport()
+        self.written = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.written += data
+
+    async def drain(self):
+        await asyncio.Event().wait()
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def aio_server(server_module):
+    import aio_server
+    return aio_server
+
+
+def test_writer_gives_up_on_a_peer_that_stops_reading(aio_server, monkeypatch):
+    monkeypatch.setattr(aio_server, "SEND_TIMEOUT", 0.05)
+
+    async def stall():
+        writer = StalledWriter()
+        client = aio_server.AsyncClient(None, writer)
+        client.sendall(b"hello\n")
+        await asyncio.wait_for(client.drain(), 1)
+        return client, writer
+
+    client, writer = asyncio.run(stall())
+    assert writer.written == b"hello\n"
+    assert writer.transport.aborted and writer.closed
+    with pytest.raises(ConnectionResetError):
+        client.sendall(b"anyone?\n")
+
+
+def test_accepts_wait_for_a_handshake_slot(aio_server, monkeypatch):
+    monkeypatch.setitem(aio_server.admission.counts, "handshakes", 0)
+    accepted = []
+
+    async def on_connect(conn, addr):
+        accepted.append(conn)
+
+    monkeypatch.setattr(aio_server, "_on_connect", on_connect)
+
+    async def storm():
+        monkeypatch.setattr(aio_server.admission, "handshake_slots", asyncio.Semaphore(1))
+        listen_sock = socket.create_server(("127.0.0.1", 0))
+        listen_sock.setblocking(False)
+        port = listen_sock.getsockname()[1]
+        serving = asyncio.ensure_future(aio_server.accept_clients(listen_sock))
+        peers = [socket.create_connection(("127.0.0.1", port)) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        held_back = len(accepted)
+        # The first connection finishes its handshake
+        aio_server.admission.handshake_slots.release()
+        await asyncio.sleep(0.1)
+        serving.cancel()
+        for sock in peers + accepted + [listen_sock]:
+            sock.close()
+        return held_back
+
+    assert asyncio.run(storm()) == 1
+    assert len(accepted) == 2
@@ -0,0 +1,36 @@
+import gzip
+import json
+from datetime import datetime
+
+from archive import Archive, PUBLIC_TABLE, encode_row
+from persistence import PublicRecord
+
+
+def public(message_id, month=1):
+    return PublicRecord(message_id, datetime(2024, month, 1 + message_id), "alice", f"message {message_id}",
+                        "general")
+
+
+def test_rows_span_partitions(tmp_path):
+    archive = Archive(str(tmp_path))
+    archive.append(PUBLIC_TABLE, [public(1), public(2), public(3, month=2)])
+    reader = Archive(str(tmp_path))
+    assert [row.id for row in reader.rows(PUBLIC_TABLE)] == [1, 2, 3]
+    assert [key for key, _ in reader.partitions(PUBLIC_TABLE)] == ["2024-01", "2024-02"]
+    assert reader.archived_through(PUBLIC_TABLE) == 3
+    assert [row.id for row in reader.newest(PUBLIC_TABLE, ("general",), limit=2)] == [2, 3]
+
+
+def test_resume_after_uncommitted_append(tmp_path):
+    archive = Archive(str(tmp_path))
+    archive.append(PUBLIC_TABLE, [public(1), public(2)])
+    # A run that crashed after writing its batch but before committing the manifest
+    with open(archive.path(PUBLIC_TABLE, "2024-01"), "ab") as f:
+        f.write(gzip.compress(b"".join(json.dumps(encode_row(public(message_id))).encode() + b"\n"
+                                       for message_id in (3, 4))))
+    reader = Archive(str(tmp_path))
+    reader.refresh()
+    assert [row.id for row in reader.rows(PUBLIC_TABLE)] == [1, 2]
+    # The next run archives the same rows again; the uncommitted tail is cut off first
+    reader.append(PUBLIC_TABLE, [public(3), public(4)])
+    assert [row.id for row in Archive(str(tmp_path)).rows(PUBLIC_TABLE)] == [1, 2, 3, 4]
@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+
+import pytest
+
+client = pytest.importorskip("client")
+
+
+def run_command(msg):
+    """process_command on a stand-in for the window; returns (lines sent, messages shown)."""
+    sent, shown = [], []
+    window = SimpleNamespace(
+        current_users=("alice", "bob"),
+        connection=SimpleNamespace(send_line=sent.append),
+        display_message=lambda text, tag=None: shown.append(text),
+        call=lambda func, *args, on_error=None: func(*args),
+        clear_chat=lambda: shown.append("cleared"),
+    )
+    client.ChatClient.process_command(window, msg)
+    return sent, shown
+
+
+@pytest.mark.parametrize("msg", ["/pmhistory bob", "/pmhistory bob 42", "/pmhistory", "/search -p 2 apple",
+                                 "/join lab", "/leave", "/rooms"])
+def test_server_commands_are_sent(msg):
+    assert run_command(msg) == ([msg], [])
+
+
+def test_pm():
+    assert run_command("/pm bob hello there") == (["/pm bob hello there"], [])
+    assert run_command("/pm bob") == ([], ["Error: Usage /pm <username> <message>"])
+
+
+def test_local_commands():
+    assert run_command("/who") == ([], ["Users: alice, bob"])
+    assert run_command("/clear") == ([], ["cleared"])
+    assert run_command("/pmx bob hi") == ([], ["Unknown command. Use /help"])
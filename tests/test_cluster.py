@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import json
+import threading
+from datetime import datetime
+
+import pytest
+
+from persistence import MessageWriter, PrivateRecord, PublicRecord
+from test_server import FakeClient
+
+
+class FullWriter(MessageWriter):
+    """A message writer whose queue is full until release is set."""
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.release = threading.Event()
+        self.submitted = []
+
+    def new_public(self, username, message_text, room):
+        return PublicRecord(next(self.ids), datetime.utcnow(), username, message_text, room)
+
+    def new_private(self, sender, receiver, message_text, delivered=True):
+        return PrivateRecord(next(self.ids), datetime.utcnow(), sender, receiver, message_text, delivered)
+
+    def submit(self, record, block=True):
+        if not block and not self.release.is_set():
+            return False
+        self.release.wait()
+        self.submitted.append(record)
+        return True
+
+
+class BusWriter:
+    """A worker's end of the bus, used as the broker's queue to it or as its stream writer."""
+
+    def __init__(self):
+        self.events = []
+        self.closed = False
+
+    def write(self, data):
+        self.events.append(json.loads(data))
+
+    def sendall(self, data, droppable=False):
+        self.write(data)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def cluster(server_module):
+    import cluster
+    return cluster
+
+
+def test_full_writer_queue_does_not_stop_the_broker(cluster):
+    message_writer = FullWriter()
+    broker = cluster.Broker(message_writer)
+    buses = {1: BusWriter(), 2: BusWriter()}
+    broker.workers.update(buses)
+
+    async def run():
+        publish = asyncio.ensure_future(
+            broker.dispatch(1, {"op": "pub", "user": "alice", "text": "hi", "room": "general"}))
+        await asyncio.sleep(0.05)
+        # The broker still serves other workers while the record waits for room in the queue
+        await broker.dispatch(2, {"op": "sys", "text": "hello", "room": None})
+        assert not publish.done()
+        message_writer.release.set()
+        await asyncio.wait_for(publish, 1)
+
+    asyncio.run(run())
+    assert [record.message for record in message_writer.submitted] == ["hi"]
+    assert [event["op"] for event in buses[2].events] == ["pub", "sys"]
+
+
+@pytest.mark.parametrize("hello", [b"", b"not json\n", b"{}\n"])
+def test_worker_gone_before_hello_is_cleaned_up(cluster, hello):
+    broker = cluster.Broker(FullWriter())
+    bus = BusWriter()
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(hello)
+        reader.feed_eof()
+        await broker.handle_worker(reader, bus)
+
+    asyncio.run(run())
+    assert bus.closed
+    assert broker.workers == {}
+
+
+class StalledBus:
+    """A stream writer to a worker that has stopped reading."""
+
+    def __init__(self):
+        self.transport = self
+        self.aborted = False
+
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        await asyncio.Event().wait()
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        pass
+
+
+def test_stalled_worker_is_cut_off(cluster, monkeypatch):
+    monkeypatch.setattr(cluster, "BUS_HIGH_WATER", 1000)
+    broker = cluster.Broker(FullWriter())
+    stalled = StalledBus()
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b'{"worker": 1}\n')
+        handler = asyncio.ensure_future(broker.handle_worker(reader, stalled))
+        await asyncio.sleep(0)
+        for number in range(100):
+            broker.fanout({"op": "sys", "text": f"busy {number}", "room": None})
+        assert stalled.aborted
+        reader.feed_eof()
+        await asyncio.wait_for(handler, 1)
+
+    asyncio.run(run())
+    assert broker.workers == {}
+
+
+def test_broker_answers_carry_the_sender_and_its_number(cluster):
+    broker = cluster.Broker(FullWriter())
+    broker.message_writer.release.set()
+    buses = {1: BusWriter(), 2: BusWriter()}
+    broker.workers.update(buses)
+    broker.presence["bob"] = 2
+
+    async def run():
+        await broker.dispatch(1, {"op": "pub", "user": "alice", "text": "hi", "room": "general", "seq": 7})
+        await broker.dispatch(1, {"op": "pm", "from": "alice", "to": "bob", "text": "psst", "seq": 8})
+
+    asyncio.run(run())
+    assert [(event["op"], event["origin"], event["seq"]) for event in buses[1].events] == [("pub", 1, 7), ("pm", 1, 8)]
+    assert [(event["op"], event["origin"], event["seq"]) for event in buses[2].events] == [("pub", 1, 7), ("pm", 1, 8)]
+
+
+def test_worker_waits_for_the_broker_before_the_next_line(cluster, server, monkeypatch):
+    bus_writer = BusWriter()
+    bus = cluster.WorkerBus(1, None, bus_writer)
+    monkeypatch.setattr(server, "bus", bus)
+    client = FakeClient()
+    server.register_client(client, "olga", 0, capabilities=frozenset({"rooms"}), room="relay")
+    server.release_live(client)
+    client.lines()
+
+    steps = server.process_message(client, "olga", "hello")
+    relay = next(steps)
+    assert isinstance(relay, server.Relay)
+    sent = bus_writer.events[-1]
+    assert (sent["op"], sent["text"]) == ("pub", "hello")
+    # Another worker's message with the same number does not count
+    bus.apply({"op": "pub", "id": 899, "ts": "2024-01-01T10:00:00", "user": "pete", "text": "hi", "room": "relay",
+               "origin": 2, "seq": sent["seq"]})
+    assert not relay.future.done()
+    bus.apply({"op": "pub", "id": 900, "ts": "2024-01-01T10:01:00", "user": "olga", "text": "hello", "room": "relay",
+               "origin": 1, "seq": sent["seq"]})
+    assert relay.future.done()
+    # The echo went out before the client's next line is handled
+    assert client.lines() == ["[2024-01-01 10:00] pete: hi", "[2024-01-01 10:01] olga: hello"]
+
+
+def test_waiting_clients_fail_when_the_bus_closes(cluster):
+    bus = cluster.WorkerBus(1, None, BusWriter())
+    future = bus.private("olga", "pete", "hi")
+
+    async def run():
+        bus.reader = asyncio.StreamReader()
+        bus.reader.feed_eof()
+        await bus.run()
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())
+    with pytest.raises(ConnectionError):
+        future.result()
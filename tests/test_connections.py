@@ -0,0 +1,37 @@
+import os
+import resource
+import socket
+
+import pytest
+
+from connections import ClientConnection
+
+HIGH_FD = 1103
+
+
+@pytest.fixture
+def high_fd_pair():
+    """A connected socket pair whose server end sits on a file descriptor above 1023."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard <= HIGH_FD:
+        pytest.skip("file descriptor limit too low")
+    if soft != resource.RLIM_INFINITY and soft <= HIGH_FD:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (HIGH_FD + 1, hard))
+    left, right = socket.socketpair()
+    os.dup2(left.fileno(), HIGH_FD)
+    left.close()
+    high = socket.socket(fileno=HIGH_FD)
+    yield high, right
+    high.close()
+    right.close()
+    resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def test_wait_readable_on_a_high_file_descriptor(high_fd_pair):
+    high, peer = high_fd_pair
+    connection = ClientConnection(high)
+    assert not connection.wait_readable(0.01)
+    peer.sendall(b"hello")
+    assert connection.wait_readable(1)
+    assert connection.recv(5) == b"hello"
+    connection.close()
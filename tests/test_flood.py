@@ -0,0 +1,167 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from flood import FloodControl, TokenBucket
+
+REPO = Path(__file__).resolve().parent.parent
+
+# Starts one engine on the given port with a per-user limit of 20 messages per second, burst 5
+LAUNCHER = """
+import asyncio, sys
+import server
+engine, port = sys.argv[1], int(sys.argv[2])
+server.PORT = port
+server.USER_MESSAGE_RATE, server.USER_MESSAGE_BURST = 20, 5
+server.GLOBAL_MESSAGE_RATE = None
+if engine == "threaded":
+    server.main()
+else:
+    import aio_server
+    server.stop_on_sigterm()
+    server.load_recent_messages()
+    server.message_writer.start()
+    try:
+        asyncio.run(aio_server.serve(port=port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.message_writer.stop()
+        server.storage.close()
+"""
+
+
+def test_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=10, burst=5)
+    assert [bucket.reserve(100.0) for _ in range(5)] == [0.0] * 5
+    waits = [bucket.reserve(100.0) for _ in range(3)]
+    assert waits == pytest.approx([0.1, 0.2, 0.3])
+
+
+def test_bucket_refills_while_idle():
+    bucket = TokenBucket(rate=10, burst=5)
+    for _ in range(8):
+        bucket.reserve(100.0)
+    assert not bucket.idle(100.5)
+    assert bucket.idle(100.8)
+    # A full bucket allows a whole burst again, and no more
+    assert [bucket.reserve(101.0) for _ in range(5)] == [0.0] * 5
+    assert bucket.reserve(101.0) == pytest.approx(0.1)
+
+
+def test_bucket_partial_refill():
+    bucket = TokenBucket(rate=10, burst=5)
+    for _ in range(5):
+        bucket.reserve(100.0)
+    # Two tokens come back in 0.2 seconds
+    assert bucket.reserve(100.2) == 0.0
+    assert bucket.reserve(100.2) == 0.0
+    assert bucket.reserve(100.2) == pytest.approx(0.1)
+
+
+def test_flood_control_disabled():
+    control = FloodControl()
+    control.configure(None, None, None, None)
+    assert [control.user_delay("alice") for _ in range(100)] == [(0.0, False)] * 100
+    assert control.global_delay() == 0.0
+
+
+def test_flood_control_throttles_per_user():
+    control = FloodControl()
+    control.configure(10, 2, None, None)
+    assert control.user_delay("alice") == (0.0, False)
+    assert control.user_delay("alice") == (0.0, False)
+    wait, started = control.user_delay("alice")
+    assert wait > 0 and started
+    assert control.user_delay("alice")[1] is False
+    # Other users have their own bucket
+    assert control.user_delay("bob") == (0.0, False)
+    assert control.counts["throttled"] == 2
+
+
+def test_flood_control_keeps_bucket_of_throttled_user():
+    control = FloodControl()
+    control.configure(1, 1, None, None)
+    control.user_delay("alice")
+    control.user_delay("alice")
+    control.forget("alice")
+    # Reconnecting right away does not bring a fresh burst
+    assert control.user_delay("alice")[0] > 0
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+@pytest.fixture(params=["threaded", "aio"])
+def chat_server(request, tmp_path):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=str(REPO))
+    process = subprocess.Popen([sys.executable, "-c", LAUNCHER, request.param, str(port)], cwd=tmp_path, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                pytest.fail(f"{request.param} server did not start")
+            time.sleep(0.1)
+    yield port
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class LineReader:
+    def __init__(self, port, handshake):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.sock.sendall(f"{handshake}\n".encode())
+        self.buffer = b""
+
+    def until(self, predicate, timeout=10):
+        """Returns (line, arrival time) for every line up to the first one matching predicate."""
+        self.sock.settimeout(timeout)
+        lines = []
+        while True:
+            *done, self.buffer = self.buffer.split(b"\n")
+            for position, raw in enumerate(done):
+                line = raw.decode()
+                lines.append((line, time.monotonic()))
+                if predicate(line):
+                    self.buffer = b"\n".join(done[position + 1:] + [self.buffer])
+                    return lines
+            data = self.sock.recv(65536)
+            assert data, "server closed the connection"
+            self.buffer += data
+
+
+def test_throttle_delays_flood_without_disconnecting(chat_server):
+    alice = LineReader(chat_server, "alice|0|0||general")
+    alice.until(lambda line: line == "HISTORY_END")
+    started = time.monotonic()
+    alice.sock.sendall(b"".join(f"flood {i}\n".encode() for i in range(25)))
+    lines = alice.until(lambda line: line.endswith("flood 24"))
+    arrivals = {line.rsplit(": ", 1)[-1]: at - started for line, at in lines if ": flood " in line}
+    assert len(arrivals) == 25
+    # The burst goes through at once, the other 20 messages at 20 per second
+    assert arrivals["flood 4"] < 0.5
+    assert 0.8 < arrivals["flood 24"] < 3
+    assert any(line.startswith("Slow down") for line, _ in lines)
+    # The client is still connected once the flood has drained
+    alice.sock.sendall(b"after the flood\n")
+    alice.until(lambda line: line.endswith("after the flood"))
+    alice.sock.close()
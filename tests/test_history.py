@@ -0,0 +1,207 @@
+from datetime import datetime, timedelta, timezone
+
+from history import RecentMessages, RoomHistory, fetch_page, fetch_page_before, replay_start
+from models import ChatMessage
+from persistence import PublicRecord
+
+START = datetime(2024, 1, 1, 10, 0)
+
+
+def row(message_id, message="hi"):
+    return PublicRecord(message_id, START + timedelta(minutes=message_id), "alice", message)
+
+
+def render(row):
+    line = f"[{row.timestamp:%H:%M}] {row.username}: {row.message}"
+    return f"{line}\n".encode(), f"MSG|{row.id}|{line}\n".encode()
+
+
+def buffer_with(ids, size=100, max_bytes=1 << 20):
+    buffer = RecentMessages(size, max_bytes)
+    for message_id in ids:
+        buffer.append(row(message_id), *render(row(message_id)))
+    return buffer
+
+
+def replayed_ids(replay):
+    chunks, _, _ = replay
+    return [int(line.split(b"|")[1]) for chunk in chunks for line in chunk.splitlines()]
+
+
+class FakeStorage:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def recent(self, room, limit):
+        return self.rows[-limit:]
+
+
+def test_out_of_order_appends_are_kept_sorted():
+    buffer = buffer_with([1, 2, 5, 3, 4, 7, 6])
+    assert replayed_ids(buffer.replay(last_id=0, window=7)) == [1, 2, 3, 4, 5, 6, 7]
+    assert replayed_ids(buffer.replay(last_id=4, window=10)) == [5, 6, 7]
+
+
+def test_eviction_by_count():
+    buffer = buffer_with(range(1, 11), size=4)
+    assert buffer.stats()[0] == 4
+    assert replayed_ids(buffer.replay(last_id=0, window=4)) == [7, 8, 9, 10]
+
+
+def test_eviction_by_bytes():
+    entry_bytes = sum(map(len, render(row(10)))) + len("alice") + len("hi")
+    buffer = buffer_with(range(10, 20), max_bytes=3 * entry_bytes)
+    assert buffer.stats() == (3, 3 * entry_bytes)
+    assert replayed_ids(buffer.replay(last_id=0, window=3)) == [17, 18, 19]
+
+
+def test_resume_inside_buffer():
+    buffer = buffer_with(range(1, 11))
+    chunks, reset, count = buffer.replay(last_id=7, window=5, chunk=2)
+    assert not reset and count == 3
+    assert [len(chunk.splitlines()) for chunk in chunks] == [2, 1]
+    assert buffer.replay(last_id=10, window=5) == ([], False, 0)
+
+
+def test_last_id_older_than_buffer_resets_to_window():
+    buffer = buffer_with(range(1, 11), size=5)
+    chunks, reset, count = buffer.replay(last_id=2, window=3)
+    assert reset and count == 3
+    assert replayed_ids((chunks, reset, count)) == [8, 9, 10]
+
+
+def test_too_many_missed_messages_reset_to_window():
+    buffer = buffer_with(range(1, 21))
+    _, reset, count = buffer.replay(last_id=5, window=4)
+    assert reset and count == 4
+
+
+def test_incomplete_buffer_defers_to_storage():
+    # A room buffer starts empty: it does not know what the database holds
+    buffer = buffer_with(range(1, 4))
+    assert buffer.replay(last_id=0, window=10) is None
+    assert buffer.replay(last_id=None, window=10) is None
+    assert replayed_ids(buffer.replay(last_id=1, window=10)) == [2, 3]
+
+
+def test_complete_buffer_serves_short_history():
+    buffer = RecentMessages(size=10)
+    buffer.fill(FakeStorage([row(1), row(2)]), render)
+    chunks, reset, count = buffer.replay(last_id=None, window=5)
+    assert reset and count == 2
+    assert b"".join(chunks) == render(row(1))[0] + render(row(2))[0]
+    # Evicting a message means the buffer no longer holds everything
+    buffer = RecentMessages(size=2)
+    buffer.fill(FakeStorage([row(1), row(2)]), render)
+    assert buffer.replay(last_id=None, window=5) is None
+
+
+def test_render_for_reader_in_other_timezone():
+    buffer = buffer_with([1, 2, 3])
+    tokyo = timezone(timedelta(hours=9))
+    calls = []
+
+    def render_rows(rows, tagged):
+        calls.append(tagged)
+        return b"".join(f"[{r.timestamp.replace(tzinfo=timezone.utc).astimezone(tokyo):%H:%M}] {r.message}\n".encode()
+                        for r in rows)
+
+    chunks, reset, count = buffer.replay(last_id=1, window=10, render=render_rows)
+    assert (chunks, reset, count) == ([b"[19:02] hi\n[19:03] hi\n"], False, 2)
+    assert calls == [True]
+    chunks, _, _ = buffer.replay(last_id=0, window=1, chunk=1, render=render_rows)
+    assert chunks == [b"[19:03] hi\n"]
+
+
+def test_room_history_keeps_rooms_apart():
+    history = RoomHistory(max_rooms=2, size=10)
+    history.append("general", row(1), *render(row(1)))
+    history.append("lab", row(2), *render(row(2)))
+    assert replayed_ids(history.replay("general", last_id=0, window=1)) == [1]
+    assert replayed_ids(history.replay("lab", last_id=0, window=1)) == [2]
+    # A third room drops the least recently used buffer
+    history.append("games", row(3), *render(row(3)))
+    assert history.stats() == (2, history.room("lab").stats()[1] + history.room("games").stats()[1])
+    assert history.replay("general", last_id=0, window=1) is None
+
+
+def insert_public(session_db, rows):
+    """rows: (id, minute, room); minutes after START, so several rows can share a timestamp."""
+    session_db.execute(ChatMessage.__table__.insert(), [
+        {"id": message_id, "timestamp": START + timedelta(minutes=minute), "username": "alice",
+         "message": f"message {message_id}", "room": room}
+        for message_id, minute, room in rows])
+    session_db.commit()
+
+
+# In (timestamp, id) order general is 1, 2, 3, 5, 4, 6: 2, 3 and 5 share a timestamp and 4 came later
+PAGED_ROWS = [(1, 0, "general"), (2, 1, "general"), (3, 1, "general"), (4, 2, "general"), (5, 1, "general"),
+              (6, 3, "general"), (7, 1, "lab"), (8, 5, "lab")]
+
+
+def test_fetch_page_orders_by_timestamp_then_id(session_db):
+    insert_public(session_db, PAGED_ROWS)
+    assert [row.id for row in fetch_page(session_db, None, 10)] == [1, 2, 3, 5, 4, 6]
+    assert [row.id for row in fetch_page(session_db, 3, 2)] == [5, 4]
+    assert [row.id for row in fetch_page(session_db, 5, 10)] == [4, 6]
+    assert fetch_page(session_db, 6, 10) == []
+    assert [row.id for row in fetch_page(session_db, None, 10, "lab")] == [7, 8]
+
+
+def test_fetch_pages_cover_the_room_once(session_db):
+    insert_public(session_db, PAGED_ROWS)
+    seen, after_id = [], None
+    while True:
+        page = fetch_page(session_db, after_id, 2)
+        seen += [row.id for row in page]
+        if len(page) < 2:
+            break
+        after_id = page[-1].id
+    assert seen == [1, 2, 3, 5, 4, 6]
+
+
+def test_fetch_page_before(session_db):
+    insert_public(session_db, PAGED_ROWS)
+    assert [row.id for row in fetch_page_before(session_db, 4, 3)] == [2, 3, 5]
+    assert [row.id for row in fetch_page_before(session_db, 3, 10)] == [1, 2]
+    assert fetch_page_before(session_db, 1, 10) == []
+    assert [row.id for row in fetch_page_before(session_db, 8, 10, "lab")] == [7]
+
+
+def test_replay_start(session_db):
+    insert_public(session_db, PAGED_ROWS)
+    # The newest three messages are 5, 4 and 6, so the window starts after 3
+    assert replay_start(session_db, None, 3) == (3, True)
+    assert replay_start(session_db, 0, 3) == (3, True)
+    assert replay_start(session_db, 5, 3) == (5, False)
+    assert replay_start(session_db, 3, 3) == (3, False)
+    assert replay_start(session_db, 6, 3) == (6, False)
+    # Seen too long ago, unknown, or from another room: replay the window
+    assert replay_start(session_db, 2, 3) == (3, True)
+    assert replay_start(session_db, 99, 3) == (3, True)
+    assert replay_start(session_db, 7, 3) == (3, True)
+    assert replay_start(session_db, 7, 1, "lab") == (7, False)
+
+
+def test_replay_start_window_larger_than_room(session_db):
+    insert_public(session_db, PAGED_ROWS)
+    assert replay_start(session_db, None, 10) == (None, True)
+    assert replay_start(session_db, 1, 10) == (1, False)
+    assert replay_start(session_db, 8, 10) == (None, True)
+    assert replay_start(session_db, None, 10, "empty") == (None, True)
+
+
+def test_iter_conversation_pages(session_db):
+    from history import iter_conversation
+    from models import PrivateMessage
+
+    session_db.execute(PrivateMessage.__table__.insert(), [
+        {"id": message_id, "timestamp": START, "sender": sender, "receiver": receiver, "message": f"m{message_id}"}
+        for message_id, sender, receiver in
+        [(1, "alice", "bob"), (2, "bob", "alice"), (3, "alice", "carol"), (4, "alice", "bob"), (5, "bob", "alice")]])
+    session_db.commit()
+    assert [row.id for row in iter_conversation(session_db, "alice", "bob", limit=2)] == [5, 4]
+    assert [row.id for row in iter_conversation(session_db, "bob", "alice", 4, limit=2)] == [2, 1]
+    assert [row.id for row in iter_conversation(session_db, "alice", "bob", 2, limit=2)] == [1]
+    assert list(iter_conversation(session_db, "alice", "bob", 1)) == []
+    assert [row.id for row in iter_conversation(session_db, "carol", "alice")] == [3]
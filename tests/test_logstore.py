@@ -0,0 +1,89 @@
+import os
+from datetime import datetime, timedelta
+
+import logstore
+from logstore import LogStorage, PUBLIC, encode_record
+from persistence import PrivateRecord, PublicRecord
+
+START = datetime(2024, 1, 1, 10, 0)
+
+
+def public(message_id, room="general"):
+    return PublicRecord(message_id, START + timedelta(seconds=message_id), "alice", f"message {message_id}", room)
+
+
+def messages(storage, room="general"):
+    return [row.message for row in storage.recent(room, 100)]
+
+
+def active_segment(directory):
+    return os.path.join(directory, max(name for name in os.listdir(directory) if name.endswith(".log")))
+
+
+def test_reopen_keeps_written_records(tmp_path):
+    directory = str(tmp_path / "log")
+    storage = LogStorage(directory)
+    storage.write([public(1), public(2), public(3, "lab")],
+                  [PrivateRecord(4, START, "alice", "bob", "psst", delivered=False)])
+    storage.close()
+    storage = LogStorage(directory)
+    assert messages(storage) == ["message 1", "message 2"]
+    assert messages(storage, "lab") == ["message 3"]
+    assert [row.message for row in storage.undelivered("bob")] == ["psst"]
+    assert storage.max_ids() == (3, 4)
+    storage.close()
+
+
+def test_torn_tail_is_cut_off(tmp_path):
+    directory = str(tmp_path / "log")
+    storage = LogStorage(directory)
+    storage.write([public(1), public(2)], [])
+    storage.close()
+    path = active_segment(directory)
+    intact = os.path.getsize(path)
+    # A crash in the middle of the next batch leaves half a record behind
+    record = encode_record(PUBLIC, 3, START, b"general", b"alice", b"message 3")
+    with open(path, "ab") as f:
+        f.write(record[:len(record) // 2])
+    storage = LogStorage(directory)
+    assert messages(storage) == ["message 1", "message 2"]
+    assert os.path.getsize(path) == intact
+    # Appends continue right after the last complete record
+    storage.write([public(3)], [])
+    storage.close()
+    storage = LogStorage(directory)
+    assert messages(storage) == ["message 1", "message 2", "message 3"]
+    storage.close()
+
+
+def test_corrupt_tail_record_is_cut_off(tmp_path):
+    directory = str(tmp_path / "log")
+    storage = LogStorage(directory)
+    storage.write([public(1)], [])
+    storage.write([public(2)], [])
+    storage.close()
+    path = active_segment(directory)
+    with open(path, "r+b") as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xFF]))
+    storage = LogStorage(directory)
+    assert messages(storage) == ["message 1"]
+    assert storage.max_ids() == (1, 0)
+    storage.close()
+
+
+def test_sealed_segment_without_index_is_indexed_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(logstore, "SEGMENT_BYTES", 200)
+    directory = str(tmp_path / "log")
+    storage = LogStorage(directory)
+    for message_id in range(1, 11):
+        storage.write([public(message_id)], [])
+    storage.close()
+    indexes = [name for name in os.listdir(directory) if name.endswith(".idx")]
+    assert indexes
+    os.remove(os.path.join(directory, indexes[0]))
+    storage = LogStorage(directory)
+    assert messages(storage) == [f"message {message_id}" for message_id in range(1, 11)]
+    storage.close()
@@ -0,0 +1,53 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics
+from metrics import Counter, Gauge, Histogram
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    """An empty registry, so only the metrics made by the test are rendered."""
+    monkeypatch.setattr(metrics, "_registry", {})
+
+
+def test_histogram_buckets_are_cumulative_and_inclusive():
+    histogram = Histogram("test_seconds", "Test latency.", buckets=(1.0, 0.1, 0.5))
+    for value in (0.05, 0.1, 0.3, 0.5, 2):
+        histogram.observe(value)
+    assert histogram.render() == [
+        "# HELP test_seconds Test latency.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="0.5"} 4',
+        'test_seconds_bucket{le="1.0"} 4',
+        'test_seconds_bucket{le="+Inf"} 5',
+        "test_seconds_sum 2.95",
+        "test_seconds_count 5",
+    ]
+
+
+def test_render_reads_callbacks_and_skips_failing_ones():
+    depth = [3]
+    Gauge("test_depth", "Queue depth.", lambda: depth[0])
+    Counter("test_total", "Things done.", lambda: 1 / 0)
+    depth[0] = 4
+    assert metrics.render() == "# HELP test_depth Queue depth.\n# TYPE test_depth gauge\ntest_depth 4\n"
+
+
+def test_endpoint_serves_metrics():
+    Counter("test_messages_total", "Messages.", lambda: 12)
+    httpd = metrics.start_metrics_server(0)
+    port = httpd.server_address[1]
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+            assert response.headers["Content-Type"] == metrics.CONTENT_TYPE
+            assert response.read().decode().splitlines()[-1] == "test_messages_total 12"
+        with pytest.raises(urllib.error.HTTPError) as missing:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/other", timeout=5)
+        assert missing.value.code == 404
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
@@ -0,0 +1,71 @@
+from sqlalchemy import create_engine, inspect
+
+from migrations import MIGRATIONS, SCHEMA_VERSION, migrate, schema_version
+from protocol import DEFAULT_ROOM
+
+# The tables as the first release created them: no indexes, no later columns
+BASELINE_SCHEMA = (
+    "CREATE TABLE chat_messages (id INTEGER NOT NULL PRIMARY KEY, username VARCHAR(50), "
+    "message VARCHAR(500), timestamp DATETIME)",
+    "CREATE TABLE private_messages (id INTEGER NOT NULL PRIMARY KEY, sender VARCHAR(50), "
+    "receiver VARCHAR(50), message VARCHAR(500), timestamp DATETIME)",
+    "INSERT INTO chat_messages VALUES (1, 'alice', 'hello world', '2024-01-01 10:00:00')",
+    "INSERT INTO private_messages VALUES (1, 'alice', 'bob', 'psst', '2024-01-01 10:01:00')",
+)
+
+
+def baseline_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'messages.db'}")
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.exec_driver_sql(statement)
+    return engine
+
+
+def index_names(engine, table):
+    return {index["name"] for index in inspect(engine).get_indexes(table)}
+
+
+def test_baseline_database_upgrades_through_every_step(tmp_path):
+    engine = baseline_engine(tmp_path)
+    migrate(bind=engine)
+    with engine.connect() as connection:
+        assert schema_version(connection) == SCHEMA_VERSION
+        assert connection.exec_driver_sql("SELECT delivered FROM private_messages").scalar() == 1
+        assert connection.exec_driver_sql(
+            "SELECT rowid FROM chat_messages_fts WHERE chat_messages_fts MATCH 'hello'").scalar() == 1
+    assert {'ix_private_messages_sender_timestamp', 'ix_private_messages_receiver_timestamp',
+            'ix_private_messages_conversation', 'ix_private_messages_undelivered'} <= index_names(
+        engine, 'private_messages')
+    assert {'ix_chat_messages_timestamp_id', 'ix_chat_messages_room_timestamp_id'} <= index_names(
+        engine, 'chat_messages')
+
+
+def test_rooms_added_to_existing_messages(tmp_path):
+    engine = baseline_engine(tmp_path)
+    migrate(bind=engine)
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT room FROM chat_messages").scalar() == DEFAULT_ROOM
+
+
+def test_steps_before_rooms_do_not_need_the_room_column(tmp_path):
+    engine = baseline_engine(tmp_path)
+    with engine.begin() as connection:
+        for step in MIGRATIONS[:-1]:
+            step(connection)
+    assert 'ix_chat_messages_room_timestamp_id' not in index_names(engine, 'chat_messages')
+
+
+def test_migrate_is_idempotent(tmp_path):
+    engine = baseline_engine(tmp_path)
+    migrate(bind=engine)
+    migrate(bind=engine)
+    with engine.connect() as connection:
+        assert schema_version(connection) == SCHEMA_VERSION
+
+
+def test_new_database_gets_latest_schema(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'messages.db'}")
+    migrate(bind=engine)
+    with engine.connect() as connection:
+        assert schema_version(connection) == SCHEMA_VERSION
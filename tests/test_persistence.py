@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import persistence
+from persistence import MessageWriter
+
+
+class RecordingStorage:
+    """Keeps each write's records; writes containing a message in bad fail."""
+
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.batches = []
+        self.attempts = 0
+
+    def max_ids(self):
+        return 10, 20
+
+    def write(self, public_records, private_records):
+        self.attempts += 1
+        records = public_records + private_records
+        if any(record.message in self.bad for record in records):
+            raise RuntimeError("constraint failed")
+        self.batches.append([record.message for record in records])
+
+
+@pytest.fixture
+def writer_for():
+    writers = []
+
+    def make(storage, **kwargs):
+        writer = MessageWriter(storage, **kwargs)
+        writer.start()
+        writers.append(writer)
+        return writer
+
+    yield make
+    for writer in writers:
+        writer.stop()
+
+
+def test_ids_continue_from_storage(writer_for):
+    writer = writer_for(RecordingStorage())
+    assert writer.new_public("alice", "a").id == 11
+    assert writer.new_public("alice", "b").id == 12
+    assert writer.new_private("alice", "bob", "c").id == 21
+
+
+def test_full_batch_is_written_without_waiting_for_the_interval(writer_for):
+    storage = RecordingStorage()
+    writer = writer_for(storage, batch_size=3, flush_interval=60)
+    started = time.monotonic()
+    for text in ("a", "b", "c"):
+        writer.submit(writer.new_public("alice", text))
+    writer.flush()
+    assert time.monotonic() - started < 5
+    assert storage.batches == [["a", "b", "c"]]
+
+
+def test_partial_batch_is_written_after_the_interval(writer_for):
+    storage = RecordingStorage()
+    writer = writer_for(storage, batch_size=100, flush_interval=0.05)
+    writer.submit(writer.new_public("alice", "a"))
+    writer.submit(writer.new_private("alice", "bob", "b"))
+    writer.flush()
+    assert storage.batches == [["a", "b"]]
+    assert (writer.written, writer.batches) == (2, 1)
+
+
+def test_stop_writes_out_the_queue():
+    storage = RecordingStorage()
+    writer = MessageWriter(storage, batch_size=100, flush_interval=60)
+    writer.start()
+    for text in ("a", "b"):
+        writer.submit(writer.new_public("alice", text))
+    writer.stop()
+    assert storage.batches == [["a", "b"]]
+
+
+def test_failing_batch_is_retried_then_written_row_by_row(writer_for, monkeypatch):
+    monkeypatch.setattr(persistence.time, "sleep", lambda seconds: None)
+    storage = RecordingStorage(bad={"b"})
+    writer = writer_for(storage, batch_size=3, flush_interval=60)
+    for text in ("a", "b", "c"):
+        writer.submit(writer.new_public("alice", text))
+    writer.flush()
+    assert storage.attempts == persistence.WRITE_RETRIES + 3
+    assert storage.batches == [["a"], ["c"]]
+    assert (writer.written, writer.failed) == (2, 1)
+
+
+def test_submit_without_blocking_on_a_full_queue():
+    writer = MessageWriter(RecordingStorage(), queue_size=1)
+    writer.public_ids.load(0)
+    assert writer.submit(writer.new_public("alice", "a"), block=False)
+    assert not writer.submit(writer.new_public("alice", "b"), block=False)
+    assert writer.depth() == 1
+
+
+
+def test_submit_async_waits_for_room_off_the_loop():
+    writer = MessageWriter(RecordingStorage(), queue_size=1)
+    writer.public_ids.load(0)
+    writer.submit(writer.new_public("alice", "a"))
+
+    async def run():
+        pending = asyncio.ensure_future(writer.submit_async(writer.new_public("alice", "b")))
+        # The loop keeps running while the record waits for room in the queue
+        await asyncio.sleep(0.05)
+        assert not pending.done()
+        writer._queue.get_nowait()
+        await asyncio.wait_for(pending, 1)
+
+    asyncio.run(run())
+    assert writer.depth() == 1
+
+def test_flush_waits_for_the_write_in_progress(writer_for):
+    storage = RecordingStorage()
+    release = threading.Event()
+    write = storage.write
+
+    def slow_write(public_records, private_records):
+        release.wait()
+        write(public_records, private_records)
+
+    storage.write = slow_write
+    writer = writer_for(storage, batch_size=1, flush_interval=0)
+    writer.submit(writer.new_public("alice", "a"))
+    flushed = threading.Event()
+    flusher = threading.Thread(target=lambda: (writer.flush(), flushed.set()))
+    flusher.start()
+    writer.submit(writer.new_public("alice", "b"))
+    assert not flushed.wait(0.05)
+    release.set()
+    flusher.join(5)
+    assert flushed.is_set()
+    assert ["a"] in storage.batches
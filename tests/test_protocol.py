@@ -0,0 +1,81 @@
+import pytest
+
+from protocol import (
+    MSG, DeflateEncoder, FrameTooLarge, InflatingDecoder, LegacyDecoder, LineDecoder, decoder_for_first_chunk,
+    encode_line, encode_lines, split_tagged,
+)
+
+
+def test_split_tagged():
+    assert split_tagged(f"{MSG}|42|[10:00] alice: hi|there") == (42, "[10:00] alice: hi|there")
+    assert split_tagged("[10:00] alice: hi") == (None, "[10:00] alice: hi")
+
+
+def test_split_tagged_malformed():
+    assert split_tagged(f"{MSG}|42") == (None, f"{MSG}|42")
+    assert split_tagged(f"{MSG}|x|text") == (None, f"{MSG}|x|text")
+
+
+def test_encode_line_flattens_line_breaks():
+    assert encode_line("a\nb\r\nc") == b"a b  c\n"
+    assert encode_lines(["one", "two"]) == b"one\ntwo\n"
+
+
+def test_line_decoder_pipelined_frames():
+    decoder = LineDecoder()
+    assert decoder.feed(b"one\ntwo\r\nthree\n") == [b"one", b"two", b"three"]
+    assert decoder.pending() == 0
+
+
+def test_line_decoder_split_frames():
+    decoder = LineDecoder()
+    assert decoder.feed(b"hel") == []
+    assert decoder.feed(b"lo\r") == []
+    assert decoder.pending() == 6
+    assert decoder.feed(b"\nwor") == [b"hello"]
+    assert decoder.feed_text("ld é\n".encode()) == ["world é"]
+    assert decoder.feed(b"") == []
+
+
+def test_line_decoder_frame_too_large():
+    decoder = LineDecoder(max_frame=8)
+    assert decoder.feed(b"12345678\n") == [b"12345678"]
+    decoder.feed(b"1234")
+    with pytest.raises(FrameTooLarge):
+        decoder.feed(b"56789")
+
+
+def test_decoder_for_first_chunk():
+    assert isinstance(decoder_for_first_chunk(b"alice|0\n"), LineDecoder)
+    legacy = decoder_for_first_chunk(b"alice|0")
+    assert isinstance(legacy, LegacyDecoder)
+    assert legacy.feed(b"hi\nthere") == [b"hi\nthere"]
+
+
+def test_inflating_decoder_round_trip():
+    encoder = DeflateEncoder()
+    stream = encoder.encode(encode_lines(["HISTORY_END", "[10:00] alice: hi"]))
+    stream += encoder.encode(encode_line("[10:01] bob: hello") * 50)
+    decoder = InflatingDecoder()
+    frames = []
+    # One byte at a time, so the header and the deflate blocks are split everywhere
+    for position in range(len(stream)):
+        frames += decoder.feed_text(stream[position:position + 1])
+    assert decoder.compressed
+    assert frames == ["HISTORY_END", "[10:00] alice: hi"] + ["[10:01] bob: hello"] * 50
+    assert decoder.pending() == 0
+
+
+def test_inflating_decoder_plain_stream():
+    decoder = InflatingDecoder()
+    assert decoder.feed(b"Usern") == []
+    assert decoder.pending() == 5
+    assert decoder.feed(b"ame taken\nnext\npart") == [b"Username taken", b"next"]
+    assert not decoder.compressed
+    assert decoder.feed(b"ial\n") == [b"partial"]
+
+
+def test_inflating_decoder_header_too_large():
+    decoder = InflatingDecoder(max_frame=8)
+    with pytest.raises(FrameTooLarge):
+        decoder.feed(b"123456789")
@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import logstore
+import search
+from logstore import LogStorage
+from persistence import PublicRecord
+from search import parse_search
+
+START = datetime(2024, 1, 1, 10, 0)
+
+
+@pytest.fixture(params=["sql", "log"])
+def storage(request, tmp_path):
+    if request.param == "sql":
+        return request.getfixturevalue("sql_storage")
+    log = LogStorage(str(tmp_path / "log"))
+    request.addfinalizer(log.close)
+    return log
+
+
+def write(storage, messages):
+    """messages: (room, text) in id order."""
+    storage.write([PublicRecord(message_id, START + timedelta(seconds=message_id), "alice", text, room)
+                   for message_id, (room, text) in enumerate(messages, 1)], [])
+
+
+def found(result):
+    rows, more = result
+    return sorted(row.id for row in rows), more
+
+
+def test_pages_and_more_flag(storage):
+    write(storage, [("general", f"apple {i}") for i in range(25)] + [("general", "pear")])
+    first, second, third = (storage.search("apple", page, 10) for page in (1, 2, 3))
+    assert [len(rows) for rows, _ in (first, second, third)] == [10, 10, 5]
+    assert [more for _, more in (first, second, third)] == [True, True, False]
+    ids = [row.id for rows, _ in (first, second, third) for row in rows]
+    assert sorted(ids) == list(range(1, 26))
+    assert storage.search("apple", 4, 10) == ([], False)
+    assert found(storage.search("apple", 1, 25)) == (list(range(1, 26)), False)
+
+
+def test_search_is_scoped_to_the_room(storage):
+    write(storage, [("general", "apple pie"), ("lab", "apple juice"), ("lab", "pear"), ("general", "apples")])
+    assert found(storage.search("apple", room="general")) == ([1], False)
+    assert found(storage.search("apple", room="lab")) == ([2], False)
+    assert found(storage.search("appl*", room="general")) == ([1, 4], False)
+    assert found(storage.search("pear", room="general")) == ([], False)
+    assert found(storage.search("apple", room="empty")) == ([], False)
+
+
+def test_every_term_must_match(storage):
+    write(storage, [("general", "apple pie"), ("general", "apple juice"), ("general", "pie crust")])
+    assert found(storage.search("apple pie")) == ([1], False)
+    assert found(storage.search("alice juice")) == ([2], False)
+    # Operators and quotes are searched for literally, not parsed
+    assert found(storage.search('pie OR "juice')) == ([], False)
+    assert storage.search("*") == ([], False)
+
+
+def test_only_recent_matches_are_searched(storage, monkeypatch):
+    monkeypatch.setattr(search, "SEARCH_RANK_WINDOW", 3)
+    monkeypatch.setattr(logstore, "LOG_SEARCH_SCAN", 3)
+    write(storage, [("general", "apple")] * 5 + [("general", "pear")])
+    rows, more = storage.search("apple")
+    assert not more
+    assert {row.id for row in rows} <= {3, 4, 5}
+    assert 5 in {row.id for row in rows}
+
+
+def test_parse_search():
+    assert parse_search("/search apple pie") == ("apple pie", 1)
+    assert parse_search("/search -p 3 apple") == ("apple", 3)
+    assert parse_search("/search -p x apple") is None
+    assert parse_search("/search -p 2") is None
+    assert parse_search(f"/search -p {search.SEARCH_MAX_PAGE + 1} apple") is None
+    assert parse_search("/search") is None
@@ -0,0 +1,451 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from persistence import PrivateRecord
+
+
+class FakeClient:
+    """Stands in for a connection: keeps what the server sends it."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.drains = 0
+
+    def sendall(self, data, droppable=False):
+        self.data += data
+
+    def drain(self):
+        self.drains += 1
+
+    def start_compression(self):
+        pass
+
+    def depth(self):
+        return len(self.data)
+
+    def close(self):
+        pass
+
+    def lines(self):
+        """Lines received since the last call."""
+        lines = self.data.decode().splitlines()
+        self.data.clear()
+        return lines
+
+
+def join(server, username, room="general", capabilities=frozenset({"presence", "rooms"}), offset_seconds=0,
+         resumable=True):
+    """Registers a client and runs its join the way handle_client() does."""
+    client = FakeClient()
+    server.register_client(client, username, offset_seconds, resumable=resumable, capabilities=capabilities,
+                           room=room)
+    server.run_steps(server.send_history(client, 0, room))
+    server.run_steps(server.send_undelivered(client, username))
+    client.sendall(server.roster.snapshot_for(client))
+    server.release_live(client)
+    return client
+
+
+def leave(server, client):
+    server.unregister_client(client)
+
+
+def send(server, client, text):
+    server.run_steps(server.process_message(client, server.clients[client], text))
+    server.message_writer.flush()
+
+
+def store_for(server, receiver, *texts):
+    """Stores private messages for an offline receiver; returns their ids."""
+    records = [server.message_writer.new_private("alice", receiver, text, delivered=False) for text in texts]
+    server.storage.write([], records)
+    return [record.id for record in records]
+
+
+def body(line):
+    """A chat line without its "[date time] " prefix."""
+    return line.split("] ", 1)[1] if line.startswith("[") else line
+
+
+def test_private_message_to_offline_user_waits_for_them(server):
+    alice = join(server, "alice")
+    alice.lines()
+    send(server, alice, "/pm carol are you there?")
+    assert [body(line) for line in alice.lines()] == [
+        "(Private) alice -> carol: are you there?", server.offline_notice("carol")]
+    assert [row.message for row in server.storage.undelivered("carol")] == ["are you there?"]
+
+    carol = join(server, "carol")
+    received = [body(line) for line in carol.lines()]
+    assert "Private messages received while you were offline:" in received
+    assert "(Private) alice -> carol: are you there?" in received
+    assert list(server.storage.undelivered("carol")) == []
+
+    # Delivered once only
+    leave(server, carol)
+    carol = join(server, "carol")
+    assert not any("are you there?" in line for line in carol.lines())
+
+
+def test_private_message_to_online_user_is_not_stored(server):
+    alice, dave = join(server, "alice"), join(server, "dave")
+    alice.lines(), dave.lines()
+    send(server, alice, "/pm dave hi")
+    assert [body(line) for line in dave.lines()] == ["(Private) alice -> dave: hi"]
+    assert list(server.storage.undelivered("dave")) == []
+
+
+def test_marked_delivered_only_after_the_send_drained(server):
+    ids = store_for(server, "erin", "one", "two")
+    client = FakeClient()
+    steps = server.send_undelivered(client, "erin")
+    lookup = next(steps)
+    assert isinstance(lookup, server.Blocking)
+    drain = steps.send(lookup.func(*lookup.args))
+    assert drain == server.Drain(client)
+    assert [body(line) for line in client.lines()][1:] == [
+        "(Private) alice -> erin: one", "(Private) alice -> erin: two"]
+    # Queued, but not yet taken by the writer: still waiting for delivery
+    assert [row.id for row in server.storage.undelivered("erin")] == ids
+    mark = steps.send(None)
+    assert mark == server.Blocking(server.storage.mark_delivered, ("erin", ids[-1]))
+    mark.func(*mark.args)
+    with pytest.raises(StopIteration) as done:
+        steps.send(None)
+    assert done.value.value == 2
+    assert list(server.storage.undelivered("erin")) == []
+
+
+def test_not_marked_delivered_when_the_client_is_gone(server):
+    ids = store_for(server, "frank", "lost?")
+    client = FakeClient()
+    steps = server.send_undelivered(client, "frank")
+    lookup = next(steps)
+    steps.send(lookup.func(*lookup.args))
+    with pytest.raises(ConnectionResetError):
+        steps.throw(ConnectionResetError("gone"))
+    assert [row.id for row in server.storage.undelivered("frank")] == ids
+
+
+def test_iter_undelivered_and_mark_delivered(session_db):
+    from history import iter_undelivered, mark_delivered
+    from models import PrivateMessage
+
+    now = datetime(2024, 1, 1)
+    session_db.execute(PrivateMessage.__table__.insert(), [
+        PrivateRecord(message_id, now, "alice", receiver, f"m{message_id}", delivered)._asdict()
+        for message_id, receiver, delivered in
+        [(1, "bob", False), (2, "carol", False), (3, "bob", True), (4, "bob", False), (5, "bob", False)]])
+    session_db.commit()
+    assert [row.id for row in iter_undelivered(session_db, "bob")] == [1, 4, 5]
+    mark_delivered(session_db, "bob", 4)
+    assert [row.id for row in iter_undelivered(session_db, "bob")] == [5]
+    assert [row.id for row in iter_undelivered(session_db, "carol")] == [2]
+
+
+
+def test_pm_history_pages(server, monkeypatch):
+    monkeypatch.setattr(server, "PM_HISTORY_PAGE", 2)
+    ids = store_for(server, "hank", "one", "two", "three")
+
+    def reply(*before_id):
+        return server.pm_history_reply("hank", "alice", *before_id).decode().splitlines()
+
+    newest = reply()
+    assert newest[0] == "Private messages with alice (newest first):"
+    assert [line.split()[0] for line in newest[1:3]] == [f"#{ids[2]}", f"#{ids[1]}"]
+    assert newest[3] == f"Older messages: /pmhistory alice {ids[1]}"
+    older = reply(ids[1])
+    assert [line.split()[0] for line in older[1:]] == [f"#{ids[0]}"]
+    # Exactly one page left: no hint
+    assert reply(ids[2]) == newest[:1] + newest[2:3] + [older[1]]
+    assert reply(ids[0]) == ["No older private messages with alice."]
+    assert server.pm_history_reply("hank", "nobody") == b"No private messages with nobody.\n"
+
+
+def test_pm_history_sees_a_message_still_queued(server, monkeypatch):
+    # The writer holds the message for a while before storing it
+    monkeypatch.setattr(server.message_writer, "flush_interval", 0.3)
+    ivan = join(server, "ivan")
+    ivan.lines()
+    server.run_steps(server.process_message(ivan, "ivan", "/pm judy are you there?"))
+    ivan.lines()
+    server.run_steps(server.process_message(ivan, "ivan", "/pmhistory judy"))
+    assert [body(line.split(" ", 1)[1]) for line in ivan.lines()[1:]] == ["(Private) ivan -> judy: are you there?"]
+    # Stored for judy, who was offline: delivered when she joins
+    judy = join(server, "judy")
+    assert "(Private) ivan -> judy: are you there?" in [body(line) for line in judy.lines()]
+
+
+
+def test_broadcast_renders_once_per_timezone(server, monkeypatch):
+    format_time_at = server.format_time_at
+    rendered = []
+
+    def counting_format_time_at(dt, offset_seconds=None):
+        rendered.append(offset_seconds)
+        return format_time_at(dt, offset_seconds)
+
+    monkeypatch.setattr(server, "format_time_at", counting_format_time_at)
+    utc = [join(server, name, "zones") for name in ("uma", "vic")]
+    tokyo = [join(server, name, "zones", offset_seconds=9 * 3600) for name in ("wes", "xia")]
+    plain = join(server, "yan", "zones", offset_seconds=9 * 3600, resumable=False)
+    for client in utc + tokyo + [plain]:
+        client.lines()
+    rendered.clear()
+
+    server.broadcast_timed(datetime(2024, 1, 1, 22, 30), "uma: hi", message_id=41, room="zones")
+    assert sorted(rendered) == [0, 9 * 3600, 9 * 3600]
+    assert [client.lines() for client in utc] == [["MSG|41|[2024-01-01 22:30] uma: hi"]] * 2
+    assert [client.lines() for client in tokyo] == [["MSG|41|[2024-01-02 07:30] uma: hi"]] * 2
+    assert plain.lines() == ["[2024-01-02 07:30] uma: hi"]
+
+def test_concurrent_public_messages_arrive_in_id_order(server, monkeypatch):
+    new_public = server.message_writer.new_public
+
+    def slow_new_public(*args):
+        record = new_public(*args)
+        # Another sender gets the next id before this one is fanned out
+        time.sleep(0.001)
+        return record
+
+    monkeypatch.setattr(server.message_writer, "new_public", slow_new_public)
+    reader = join(server, "kate", "order")
+    senders = [join(server, name, "order") for name in ("liam", "mia", "noah")]
+    reader.lines()
+
+    def chatter(client):
+        for number in range(20):
+            server.run_steps(server.process_message(client, server.clients[client], f"n{number}"))
+
+    threads = [threading.Thread(target=chatter, args=(client,)) for client in senders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ids = [int(line.split("|")[1]) for line in reader.lines() if line.startswith("MSG|")]
+    assert len(ids) == 60
+    assert ids == sorted(ids)
+
+def chat_bodies(client):
+    """Bodies of the chat lines received since the last call, tags and protocol lines left out."""
+    bodies = []
+    for line in client.lines():
+        if line.startswith("MSG|"):
+            line = line.split("|", 2)[2]
+        if line.startswith("["):
+            bodies.append(body(line))
+    return bodies
+
+
+def test_public_messages_stay_in_their_room(server):
+    alice, bob = join(server, "alice", "attic"), join(server, "bob", "basement")
+    alice.lines(), bob.lines()
+    send(server, alice, "up here")
+    send(server, bob, "down here")
+    assert chat_bodies(alice) == ["alice: up here"]
+    assert chat_bodies(bob) == ["bob: down here"]
+
+
+def test_join_replays_the_new_room_only(server):
+    alice, bob = join(server, "alice", "kitchen"), join(server, "bob", "garden")
+    send(server, alice, "kitchen 1")
+    send(server, bob, "garden 1")
+    send(server, bob, "garden 2")
+    alice.lines(), bob.lines()
+
+    send(server, alice, "/join garden")
+    lines = alice.lines()
+    assert body(lines[0]) == 'System: ==> "alice" joined #garden'
+    assert lines[1] == "ROOM|garden"
+    replay = lines[2:lines.index("HISTORY_END")]
+    assert [body(line.split("|", 2)[2]) for line in replay if line.startswith("MSG|")] == [
+        "bob: garden 1", "bob: garden 2"]
+    assert chat_bodies(bob) == ['System: ==> "alice" joined #garden']
+
+    # Live traffic follows the move
+    carol = join(server, "carol", "kitchen")
+    carol.lines()
+    send(server, carol, "anyone?")
+    send(server, bob, "garden 3")
+    assert chat_bodies(alice) == ["bob: garden 3"]
+
+
+def test_joining_with_a_room_replays_that_room(server):
+    dave = join(server, "dave", "cellar")
+    send(server, dave, "cellar 1")
+    leave(server, dave)
+    erin = join(server, "erin", "loft")
+    send(server, erin, "loft 1")
+    frank = join(server, "frank", "cellar")
+    assert chat_bodies(frank)[:1] == ["dave: cellar 1"]
+    assert "erin: loft 1" not in chat_bodies(frank)
+
+
+def test_room_commands(server):
+    alice, bob = join(server, "alice", "den"), join(server, "bob", "den")
+    alice.lines(), bob.lines()
+    send(server, alice, "/join study")
+    alice.lines()
+    send(server, alice, "/rooms")
+    rooms = alice.lines()[0]
+    assert "#den (1)" in rooms and "*#study (1)" in rooms and "#general (0)" in rooms
+    send(server, alice, "/join study")
+    assert alice.lines() == ["You are already in #study."]
+    send(server, alice, "/join no/such")
+    assert alice.lines() == [f"Error: {server.ROOM_USAGE}"]
+    send(server, alice, "/leave")
+    assert "ROOM|general" in alice.lines()
+    assert server.client_rooms[alice] == "general"
+    assert chat_bodies(bob) == ['System: ==> "alice" left #den']
+
+
+class SlowDeleteDict(dict):
+    """Widens the window between a room emptying and its set being dropped."""
+
+    def __delitem__(self, key):
+        time.sleep(0.001)
+        super().__delitem__(key)
+
+
+def test_concurrent_room_moves_keep_members_consistent(server, monkeypatch):
+    monkeypatch.setattr(server, "room_members", SlowDeleteDict(server.room_members))
+    clients = [join(server, name, "den") for name in ("alice", "bob", "carol", "dave")]
+
+    def bounce(client, username):
+        for _ in range(50):
+            server.move_to_room(client, username, "study")
+            server.move_to_room(client, username, "den")
+
+    threads = [threading.Thread(target=bounce, args=(client, server.clients[client])) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert server.room_members.get("den") == set(clients)
+    assert "study" not in server.room_members
+
+
+def test_client_without_rooms_capability_gets_no_replay(server):
+    grace = join(server, "grace", "hall", capabilities=frozenset())
+    grace.lines()
+    send(server, grace, "/join porch")
+    lines = grace.lines()
+    assert lines[-1] == "You are now in #porch."
+    assert "HISTORY_END" not in lines
+    assert server.client_rooms[grace] == "porch"
+
+
+@pytest.fixture
+def scheduled(server):
+    """Flushes the roster scheduled, in order; the test runs them."""
+    calls = []
+    server.roster.schedule = lambda delay, callback: calls.append(callback)
+    return calls
+
+
+def online(server, *usernames, capabilities=frozenset({"presence"})):
+    """Joins users and announces them; every client starts from an empty buffer."""
+    joined = [join(server, username, capabilities=capabilities) for username in usernames]
+    server.roster.changed()
+    server.roster.flush()
+    for client in server.clients:
+        client.lines()
+    return joined
+
+
+def roster_lines(client):
+    return [line for line in client.lines() if line.startswith(("ONLINE_USERS", "USER_JOINED", "USER_LEFT"))]
+
+
+def test_roster_coalesces_joins_into_one_flush(server, scheduled):
+    alice, = online(server, "alice")
+    bob, = online(server, "bob", capabilities=frozenset())
+    scheduled.clear()
+
+    carol = join(server, "carol")
+    server.roster.changed()
+    dave = join(server, "dave", capabilities=frozenset())
+    server.roster.changed()
+    assert len(scheduled) == 1
+    assert roster_lines(carol) == ["ONLINE_USERS|3|alice|bob|carol"]
+    assert roster_lines(dave) == ["ONLINE_USERS|4|alice|bob|carol|dave"]
+
+    scheduled.pop()()
+    assert roster_lines(alice) == ["USER_JOINED|carol|dave"]
+    assert roster_lines(bob) == ["ONLINE_USERS|4|alice|bob|carol|dave"]
+    # Only what changed since the snapshot they joined with
+    assert roster_lines(carol) == ["USER_JOINED|dave"]
+    assert roster_lines(dave) == []
+
+
+def test_roster_leave(server, scheduled):
+    alice, carol = online(server, "alice", "carol")
+    bob, = online(server, "bob", capabilities=frozenset())
+    scheduled.clear()
+
+    leave(server, carol)
+    server.roster.changed()
+    scheduled.pop()()
+    assert roster_lines(alice) == ["USER_LEFT|carol"]
+    assert roster_lines(bob) == ["ONLINE_USERS|2|alice|bob"]
+
+    # Someone who came and went within one interval is never announced
+    erin = join(server, "erin")
+    server.roster.changed()
+    leave(server, erin)
+    scheduled.pop()()
+    assert roster_lines(alice) == [] and roster_lines(bob) == []
+
+
+def test_roster_join_during_pending_flush(server, scheduled):
+    alice, = online(server, "alice")
+    bob, = online(server, "bob", capabilities=frozenset())
+    scheduled.clear()
+
+    carol = join(server, "carol")
+    server.roster.changed()
+    leave(server, bob)
+    server.roster.changed()
+    # Joins while the flush for carol and bob is pending; its snapshot is already current
+    frank = join(server, "frank", capabilities=frozenset())
+    server.roster.changed()
+    assert len(scheduled) == 1
+    assert roster_lines(carol) == ["ONLINE_USERS|3|alice|bob|carol"]
+    assert roster_lines(frank) == ["ONLINE_USERS|3|alice|carol|frank"]
+
+    scheduled.pop()()
+    assert roster_lines(alice) == ["USER_JOINED|carol|frank", "USER_LEFT|bob"]
+    assert roster_lines(carol) == ["USER_JOINED|frank", "USER_LEFT|bob"]
+    assert roster_lines(frank) == []
+
+    # The next change schedules a new flush
+    leave(server, carol)
+    server.roster.changed()
+    scheduled.pop()()
+    assert roster_lines(frank) == ["ONLINE_USERS|2|alice|frank"]
+
+
+def test_roster_skips_clients_still_joining(server, scheduled):
+    alice, = online(server, "alice")
+    scheduled.clear()
+
+    gina = FakeClient()
+    server.register_client(gina, "gina", 0, resumable=True, capabilities=frozenset({"presence"}))
+    snapshot = server.roster.snapshot_for(gina)
+    server.roster.changed()
+    scheduled.pop()()
+    assert gina.lines() == []
+    assert roster_lines(alice) == ["USER_JOINED|gina"]
+
+    gina.sendall(snapshot)
+    server.release_live(gina)
+    assert roster_lines(gina) == ["ONLINE_USERS|2|alice|gina"]
+    # Its snapshot is kept, so the flush after the release sends only what changed since
+    leave(server, alice)
+    server.roster.changed()
+    scheduled.pop()()
+    assert roster_lines(gina) == ["USER_LEFT|alice"]
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from archive import PRIVATE_TABLE, PUBLIC_TABLE
+from maintenance import archive_table, export_rows
+from persistence import PrivateRecord, PublicRecord
+from storage import Storage
+
+START = datetime(2024, 1, 1, 10, 0)
+
+
+def public(message_id, room="general"):
+    return PublicRecord(message_id, START + timedelta(minutes=message_id), "alice", f"message {message_id}", room)
+
+
+def private(message_id):
+    return PrivateRecord(message_id, START + timedelta(minutes=message_id), "alice", "bob", f"psst {message_id}")
+
+
+def interrupted_archive_run(storage):
+    """Six public and six private rows, the first three of each archived but still in the database."""
+    storage.write([public(message_id) for message_id in range(1, 7)],
+                  [private(message_id) for message_id in range(1, 7)])
+    storage.archive.append(PUBLIC_TABLE, [public(message_id) for message_id in range(1, 4)])
+    storage.archive.append(PRIVATE_TABLE, [private(message_id) for message_id in range(1, 4)])
+
+
+def ids(rows):
+    return [row.id for row in rows]
+
+
+def test_fetch_page_reads_leftover_rows_once(sql_storage):
+    interrupted_archive_run(sql_storage)
+    assert ids(sql_storage.fetch_page(None, 10, archived=True)) == [1, 2, 3, 4, 5, 6]
+    assert ids(sql_storage.fetch_page(1, 10, archived=True)) == [2, 3, 4, 5, 6]
+    assert ids(sql_storage.fetch_page(None, 2, archived=True)) == [1, 2]
+    assert ids(sql_storage.fetch_page(3, 10, archived=True)) == [4, 5, 6]
+
+
+def test_fetch_page_before_reads_leftover_rows_once(sql_storage):
+    interrupted_archive_run(sql_storage)
+    assert ids(sql_storage.fetch_page_before(6, 10)) == [1, 2, 3, 4, 5]
+
+
+def test_conversation_reads_leftover_rows_once(sql_storage):
+    interrupted_archive_run(sql_storage)
+    assert ids(sql_storage.conversation("alice", "bob", limit=10)) == [6, 5, 4, 3, 2, 1]
+    assert ids(sql_storage.conversation("bob", "alice", before_id=5, limit=3)) == [4, 3, 2]
+    assert ids(sql_storage.conversation("alice", "bob", before_id=3, limit=10)) == [2, 1]
+
+
+def test_export_reads_leftover_rows_once(sql_storage):
+    interrupted_archive_run(sql_storage)
+    assert ids(export_rows(PUBLIC_TABLE, archive=sql_storage.archive)) == [1, 2, 3, 4, 5, 6]
+    assert ids(export_rows(PRIVATE_TABLE, START + timedelta(minutes=2), START + timedelta(minutes=5),
+                           archive=sql_storage.archive)) == [2, 3, 4]
+
+
+def test_archive_run_resumes(sql_storage):
+    interrupted_archive_run(sql_storage)
+    moved = archive_table(sql_storage.archive, PUBLIC_TABLE, START + timedelta(minutes=5), pause=0)
+    assert moved == 1
+    assert sql_storage.archive.archived_through(PUBLIC_TABLE) == 4
+    assert ids(sql_storage.fetch_page(None, 10)) == [5, 6]
+    assert ids(sql_storage.fetch_page(None, 10, archived=True)) == [1, 2, 3, 4, 5, 6]
+    assert sql_storage.max_ids() == (6, 6)
+
+
+def test_backend_missing_a_method_cannot_be_created():
+    class Incomplete(Storage):
+        def max_ids(self):
+            return 0, 0
+
+    with pytest.raises(TypeError, match="search"):
+        Incomplete()